@@ -0,0 +1,270 @@
+import os
+import math
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional
+from sqlalchemy import Integer, case, cast, func
+from sqlalchemy.orm import Session
+from sqlalchemy.exc import IntegrityError
+from app.models import JobTest, TestQuestion, QuestionAnswer, TestResult, TestScoreSummary, QuestionScoreSummary
+
+# Câu hỏi có |độ lệch phân phối điểm| từ mức này (và đủ số câu trả lời) được xem là lệch
+ANALYTICS_SKEW_THRESHOLD = float(os.getenv("ANALYTICS_SKEW_THRESHOLD", "1.0"))
+ANALYTICS_MIN_ANSWERS = int(os.getenv("ANALYTICS_MIN_ANSWERS", "10"))
+
+PERCENTILES = (25, 50, 75, 90)
+HISTOGRAM_SIZE = 101
+
+
+# --------- Đánh dấu ---------
+def mark_scores_changed(db: Session, test_id: Optional[int] = None, question_ids: Iterable[int] = ()) -> None:
+    """
+    Đánh dấu thống kê của test / các câu hỏi cần tính lại (chưa commit). Gọi ngay trước commit lưu điểm:
+    dashboard chỉ tính lại các dòng có thay đổi sau lần tính trước.
+    """
+    now = datetime.utcnow()
+    if test_id is not None:
+        (db.query(TestScoreSummary)
+           .filter(TestScoreSummary.test_id == test_id)
+           .update({"changed_at": now}, synchronize_session=False))
+    question_ids = list(question_ids)
+    if question_ids:
+        (db.query(QuestionScoreSummary)
+           .filter(QuestionScoreSummary.question_id.in_(question_ids))
+           .update({"changed_at": now}, synchronize_session=False))
+
+
+# --------- Tính lại ---------
+def _histograms(rows) -> Dict[int, List[int]]:
+    histograms = {}
+    for key, bucket, count in rows:
+        histogram = histograms.setdefault(key, [0] * HISTOGRAM_SIZE)
+        histogram[min(max(int(bucket), 0), HISTOGRAM_SIZE - 1)] += count
+    return histograms
+
+def _save_summaries(db: Session, model, key: str, values: Dict[int, dict]) -> None:
+    existing = {getattr(row, key): row for row in db.query(model).filter(getattr(model, key).in_(list(values)))}
+    for summary_id, row_values in values.items():
+        row = existing.get(summary_id)
+        if row is not None:
+            for name, value in row_values.items():
+                setattr(row, name, value)
+            continue
+        try:
+            with db.begin_nested():
+                db.add(model(**{key: summary_id}, **row_values))
+        except IntegrityError:
+            # Request khác vừa tạo dòng thống kê này, lần đọc sau sẽ tính lại nếu cần
+            pass
+    db.commit()
+
+def refresh_test_summaries(db: Session, test_ids: List[int]) -> None:
+    """Tính lại thống kê của các test bằng aggregate SQL trên test_results (index test_id)."""
+    if not test_ids:
+        return
+    started = datetime.utcnow()
+    score = TestResult.percentage
+    graded = score.isnot(None)
+    moments = (
+        db.query(
+            TestResult.test_id,
+            func.count(TestResult.result_id),
+            func.count(score),
+            func.sum(case((graded & TestResult.passed.is_(True), 1), else_=0)),
+            func.sum(score), func.sum(score * score), func.sum(score * score * score),
+            func.sum(case((graded, TestResult.time_taken_seconds))), func.count(case((graded, TestResult.time_taken_seconds))),
+        )
+        .filter(TestResult.test_id.in_(test_ids))
+        .group_by(TestResult.test_id)
+        .all()
+    )
+    # Bucket theo phần nguyên của điểm (Postgres làm tròn khi cast, SQLite cắt bỏ: lệch tối đa 1 điểm)
+    bucket = cast(score, Integer)
+    histograms = _histograms(
+        db.query(TestResult.test_id, bucket, func.count())
+        .filter(TestResult.test_id.in_(test_ids), graded)
+        .group_by(TestResult.test_id, bucket)
+    )
+
+    values = {
+        test_id: {"results_count": 0, "graded_count": 0, "passed_count": 0, "score_sum": 0.0, "score_sq_sum": 0.0,
+                  "score_cube_sum": 0.0, "time_sum": 0.0, "time_count": 0}
+        for test_id in test_ids
+    }
+    for test_id, results, graded_count, passed, s1, s2, s3, time_sum, time_count in moments:
+        values[test_id] = {
+            "results_count": results, "graded_count": graded_count, "passed_count": int(passed or 0),
+            "score_sum": float(s1 or 0), "score_sq_sum": float(s2 or 0), "score_cube_sum": float(s3 or 0),
+            "time_sum": float(time_sum or 0), "time_count": time_count,
+        }
+    for test_id, row_values in values.items():
+        row_values.update(histogram=histograms.get(test_id, [0] * HISTOGRAM_SIZE), refreshed_at=started)
+    _save_summaries(db, TestScoreSummary, "test_id", values)
+
+def refresh_question_summaries(db: Session, question_ids: List[int]) -> None:
+    """Tính lại thống kê của các câu hỏi bằng aggregate SQL trên question_answers (index question_id)."""
+    if not question_ids:
+        return
+    started = datetime.utcnow()
+    score = QuestionAnswer.ai_score
+    graded = (QuestionAnswer.question_id.in_(question_ids), score.isnot(None))
+    moments = (
+        db.query(
+            QuestionAnswer.question_id,
+            func.count(score),
+            func.sum(case((QuestionAnswer.is_correct.is_(True), 1), else_=0)),
+            func.sum(score), func.sum(score * score), func.sum(score * score * score),
+            func.sum(QuestionAnswer.time_taken_seconds), func.count(QuestionAnswer.time_taken_seconds),
+        )
+        .filter(*graded)
+        .group_by(QuestionAnswer.question_id)
+        .all()
+    )
+    bucket = cast(score, Integer)
+    histograms = _histograms(
+        db.query(QuestionAnswer.question_id, bucket, func.count())
+        .filter(*graded)
+        .group_by(QuestionAnswer.question_id, bucket)
+    )
+    test_ids = dict(
+        db.query(TestQuestion.question_id, TestQuestion.test_id).filter(TestQuestion.question_id.in_(question_ids))
+    )
+
+    values = {
+        question_id: {"answers_count": 0, "correct_count": 0, "score_sum": 0.0, "score_sq_sum": 0.0,
+                      "score_cube_sum": 0.0, "time_sum": 0.0, "time_count": 0}
+        for question_id in question_ids
+    }
+    for question_id, answers, correct, s1, s2, s3, time_sum, time_count in moments:
+        values[question_id] = {
+            "answers_count": answers, "correct_count": int(correct or 0),
+            "score_sum": float(s1 or 0), "score_sq_sum": float(s2 or 0), "score_cube_sum": float(s3 or 0),
+            "time_sum": float(time_sum or 0), "time_count": time_count,
+        }
+    for question_id, row_values in values.items():
+        row_values.update(test_id=test_ids.get(question_id), refreshed_at=started,
+                          histogram=histograms.get(question_id, [0] * HISTOGRAM_SIZE))
+    _save_summaries(db, QuestionScoreSummary, "question_id", values)
+
+def refresh_stale_summaries(db: Session, test_ids: List[int]) -> None:
+    """Tính lại thống kê (của test và các câu hỏi của test) chưa có hoặc có điểm thay đổi sau lần tính trước."""
+    stale_tests = [
+        test_id for test_id, in db.query(JobTest.test_id)
+        .outerjoin(TestScoreSummary, TestScoreSummary.test_id == JobTest.test_id)
+        .filter(JobTest.test_id.in_(test_ids),
+                TestScoreSummary.refreshed_at.is_(None) | (TestScoreSummary.changed_at >= TestScoreSummary.refreshed_at))
+    ]
+    stale_questions = [
+        question_id for question_id, in db.query(TestQuestion.question_id)
+        .outerjoin(QuestionScoreSummary, QuestionScoreSummary.question_id == TestQuestion.question_id)
+        .filter(TestQuestion.test_id.in_(test_ids),
+                QuestionScoreSummary.refreshed_at.is_(None)
+                | (QuestionScoreSummary.changed_at >= QuestionScoreSummary.refreshed_at))
+    ]
+    refresh_test_summaries(db, stale_tests)
+    refresh_question_summaries(db, stale_questions)
+
+
+# --------- Báo cáo ---------
+def score_stats(count: int, s1: float, s2: float, s3: float, histogram: List[int]) -> dict:
+    """Mean, độ lệch chuẩn, độ lệch phân phối (skewness) từ tổng các lũy thừa; percentile (nearest-rank) từ histogram."""
+    if not count:
+        return {"mean": None, "stddev": None, "skewness": None, **{f"p{p}": None for p in PERCENTILES}}
+    mean = s1 / count
+    variance = max(0.0, s2 / count - mean ** 2)
+    stddev = math.sqrt(variance)
+    skewness = None
+    if count >= 3 and stddev > 1e-9:
+        skewness = (s3 / count - 3 * mean * s2 / count + 2 * mean ** 3) / stddev ** 3
+
+    percentiles = {}
+    total = sum(histogram)
+    for p in PERCENTILES:
+        rank, cumulative = max(1, math.ceil(p / 100 * total)), 0
+        for bucket, bucket_count in enumerate(histogram):
+            cumulative += bucket_count
+            if cumulative >= rank:
+                percentiles[f"p{p}"] = bucket
+                break
+        else:
+            percentiles[f"p{p}"] = None
+    return {
+        "mean": round(mean, 2), "stddev": round(stddev, 2),
+        "skewness": round(skewness, 3) if skewness is not None else None, **percentiles,
+    }
+
+def _skew(stats: dict, count: int) -> Optional[str]:
+    """left: dồn về điểm cao (có thể quá dễ), right: dồn về điểm thấp (có thể quá khó)."""
+    skewness = stats["skewness"]
+    if skewness is None or count < ANALYTICS_MIN_ANSWERS or abs(skewness) < ANALYTICS_SKEW_THRESHOLD:
+        return None
+    return "left" if skewness < 0 else "right"
+
+def _test_report(test: JobTest, summary: Optional[TestScoreSummary]) -> dict:
+    graded = summary.graded_count if summary else 0
+    return {
+        "test_id": test.test_id,
+        "job_id": test.job_id,
+        "test_name": test.test_name,
+        "results": summary.results_count if summary else 0,
+        "graded": graded,
+        "pass_rate": round(summary.passed_count / graded, 4) if graded else None,
+        "score": score_stats(graded, summary.score_sum, summary.score_sq_sum, summary.score_cube_sum, summary.histogram)
+                 if summary else score_stats(0, 0, 0, 0, []),
+        "avg_time_taken_seconds": round(summary.time_sum / summary.time_count, 1) if summary and summary.time_count else None,
+        "refreshed_at": summary.refreshed_at.isoformat() if summary and summary.refreshed_at else None,
+    }
+
+def _question_report(question: TestQuestion, summary: Optional[QuestionScoreSummary]) -> dict:
+    answers = summary.answers_count if summary else 0
+    stats = (score_stats(answers, summary.score_sum, summary.score_sq_sum, summary.score_cube_sum, summary.histogram)
+             if summary else score_stats(0, 0, 0, 0, []))
+    return {
+        "question_id": question.question_id,
+        "test_id": question.test_id,
+        "order_index": question.order_index,
+        "question_text": question.question_text,
+        "answers": answers,
+        "pass_rate": round(summary.correct_count / answers, 4) if answers else None,
+        "score": stats,
+        "avg_time_taken_seconds": round(summary.time_sum / summary.time_count, 1) if summary and summary.time_count else None,
+        "skew": _skew(stats, answers),
+    }
+
+def tests_analytics(db: Session, test_ids: List[int]) -> List[dict]:
+    """Thống kê của các test kèm từng câu hỏi và danh sách câu hỏi có phân phối điểm lệch."""
+    refresh_stale_summaries(db, test_ids)
+    tests = (db.query(JobTest, TestScoreSummary)
+               .outerjoin(TestScoreSummary, TestScoreSummary.test_id == JobTest.test_id)
+               .filter(JobTest.test_id.in_(test_ids))
+               .order_by(JobTest.test_id)
+               .all())
+    questions = (db.query(TestQuestion, QuestionScoreSummary)
+                   .outerjoin(QuestionScoreSummary, QuestionScoreSummary.question_id == TestQuestion.question_id)
+                   .filter(TestQuestion.test_id.in_(test_ids))
+                   .order_by(TestQuestion.order_index, TestQuestion.question_id)
+                   .all())
+    by_test = {}
+    for question, summary in questions:
+        by_test.setdefault(question.test_id, []).append(_question_report(question, summary))
+
+    reports = []
+    for test, summary in tests:
+        report = _test_report(test, summary)
+        report["questions"] = by_test.get(test.test_id, [])
+        report["skewed_questions"] = [q["question_id"] for q in report["questions"] if q["skew"]]
+        reports.append(report)
+    return reports
+
+def job_analytics(db: Session, job_id: int) -> dict:
+    test_ids = [test_id for test_id, in db.query(JobTest.test_id).filter(JobTest.job_id == job_id)]
+    return {"job_id": job_id, "tests": tests_analytics(db, test_ids) if test_ids else []}
+
+def question_analytics(db: Session, question_id: int) -> Optional[dict]:
+    question = db.query(TestQuestion).filter(TestQuestion.question_id == question_id).first()
+    if question is None:
+        return None
+    summary = db.get(QuestionScoreSummary, question_id)
+    if summary is None or summary.refreshed_at is None or (summary.changed_at and summary.changed_at >= summary.refreshed_at):
+        refresh_question_summaries(db, [question_id])
+        summary = db.get(QuestionScoreSummary, question_id, populate_existing=True)
+    return _question_report(question, summary)
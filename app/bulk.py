@@ -0,0 +1,133 @@
+import os
+import uuid
+import asyncio
+from datetime import datetime
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional
+from fastapi import HTTPException
+from fastapi.concurrency import run_in_threadpool
+from app.db import ReadSessionLocal
+from app.llm import PRIORITY_BULK
+from app.models import Job
+from app.utils import get_job, format_stream_event
+
+# Số job được sinh câu hỏi song song trong một batch
+BULK_GENERATION_CONCURRENCY = int(os.getenv("BULK_GENERATION_CONCURRENCY", "4"))
+# Số batch đã xong được giữ lại để tra cứu
+BULK_BATCH_RETENTION = int(os.getenv("BULK_BATCH_RETENTION", "100"))
+
+# (job, replace, priority) -> response của route sinh đơn lẻ (main.generate_job_questions_once)
+GenerateJobQuestions = Callable[[Job, bool, int], Awaitable[dict]]
+
+
+class BulkGenerationBatch:
+    """
+    Một lần sinh câu hỏi hàng loạt cho nhiều job.
+    Mỗi job đi qua cùng đường sinh với route đơn lẻ (`generate`: pool, job gần trùng, single_flight,
+    advisory lock khi ghi). Kết quả từng job được thêm vào `results` ngay khi job đó xong,
+    client có thể theo dõi qua `stream()` (NDJSON hoặc SSE).
+    """
+
+    def __init__(self, job_ids: List[int], generate: GenerateJobQuestions, replace: bool = False):
+        self.batch_id = uuid.uuid4().hex
+        self.job_ids = list(dict.fromkeys(job_ids))
+        self.generate = generate
+        self.replace = replace
+        self.status = "queued"
+        self.results: List[dict] = []
+        self.created_at = datetime.utcnow()
+        self.finished_at: Optional[datetime] = None
+        self._changed = asyncio.Condition()
+        self._task: Optional[asyncio.Task] = None
+
+    def summary(self) -> dict:
+        return {
+            "batch_id": self.batch_id,
+            "status": self.status,
+            "total": len(self.job_ids),
+            "completed": len(self.results),
+            "failed": sum(1 for r in self.results if r["status"] != "ok"),
+            "created_at": self.created_at.isoformat(),
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+        }
+
+    async def _add_result(self, item: dict) -> None:
+        async with self._changed:
+            self.results.append(item)
+            self._changed.notify_all()
+
+    async def _generate_one(self, job_id: int, semaphore: asyncio.Semaphore) -> None:
+        async with semaphore:
+            try:
+                # Đọc JD từ replica nếu có (threadpool, không chặn event loop)
+                job = await run_in_threadpool(_read_job, job_id)
+                if job is None:
+                    item = {"job_id": job_id, "status": "not_found"}
+                else:
+                    response = await self.generate(job, self.replace, PRIORITY_BULK)
+                    item = {
+                        "job_id": job_id,
+                        "status": "ok",
+                        "test_id": response["test_id"],
+                        "source": response["source"],
+                        "questions": response["questions_saved"],
+                    }
+            except HTTPException as e:
+                item = {"job_id": job_id, "status": "failed", "error": e.detail}
+            except Exception as e:
+                item = {"job_id": job_id, "status": "failed", "error": str(e)}
+
+        await self._add_result(item)
+
+    async def run(self, concurrency: int = BULK_GENERATION_CONCURRENCY) -> None:
+        self.status = "running"
+        semaphore = asyncio.Semaphore(max(1, concurrency))
+        await asyncio.gather(*(self._generate_one(job_id, semaphore) for job_id in self.job_ids))
+        async with self._changed:
+            self.status = "completed"
+            self.finished_at = datetime.utcnow()
+            self._changed.notify_all()
+
+    async def stream(self, fmt: str = "ndjson") -> AsyncIterator[str]:
+        """Phát lại các kết quả đã có rồi tiếp tục phát kết quả mới cho đến khi batch xong."""
+        sent = 0
+        while True:
+            async with self._changed:
+                await self._changed.wait_for(lambda: len(self.results) > sent or self.status == "completed")
+                pending = self.results[sent:]
+                done = self.status == "completed"
+
+            for item in pending:
+                sent += 1
+                yield format_stream_event("result", {**item, "completed": sent, "total": len(self.job_ids)}, fmt)
+
+            if done and sent == len(self.results):
+                yield format_stream_event("done", self.summary(), fmt)
+                return
+
+
+def _read_job(job_id: int) -> Optional[Job]:
+    read_db = ReadSessionLocal()
+    try:
+        return get_job(read_db, job_id)
+    finally:
+        read_db.close()
+
+
+# --------- Registry (trong process) ---------
+# Trạng thái batch chỉ nằm trong bộ nhớ của process đã nhận batch: chạy một worker uvicorn cho app
+# (xem readme); với nhiều worker, GET/stream của batch rơi vào worker khác hoặc sau restart trả 404
+_batches: Dict[str, BulkGenerationBatch] = {}
+
+def submit_bulk_generation(job_ids: List[int], generate: GenerateJobQuestions,
+                           replace: bool = False) -> BulkGenerationBatch:
+    finished = [b for b in _batches.values() if b.status == "completed"]
+    for old in finished[:max(0, len(finished) - BULK_BATCH_RETENTION + 1)]:
+        del _batches[old.batch_id]
+
+    batch = BulkGenerationBatch(job_ids, generate, replace=replace)
+    _batches[batch.batch_id] = batch
+    batch._task = asyncio.create_task(batch.run())
+    return batch
+
+def get_bulk_batch(batch_id: str) -> Optional[BulkGenerationBatch]:
+    return _batches.get(batch_id)
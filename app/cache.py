@@ -0,0 +1,192 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Iterator, Optional
+
+QUESTION_CACHE_BACKEND = os.getenv("QUESTION_CACHE_BACKEND", "memory")  # memory | sqlite | none
+QUESTION_CACHE_PATH = os.getenv("QUESTION_CACHE_PATH", "question_cache.sqlite3")
+QUESTION_CACHE_TTL_SECONDS = int(os.getenv("QUESTION_CACHE_TTL_SECONDS", "86400"))
+QUESTION_CACHE_MAXSIZE = int(os.getenv("QUESTION_CACHE_MAXSIZE", "1000"))
+
+
+# --------- Keys ---------
+def normalize_text(text: str) -> str:
+    return re.sub(r"\s+", " ", (text or "").strip().lower())
+
+def content_key(*parts: str) -> str:
+    """Hash sha256 của các thành phần (đã chuẩn hóa) tạo nên một cache key."""
+    raw = "\x1f".join(str(p) for p in parts)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+# --------- Backends ---------
+class MemoryCache:
+    """Cache trong process, có TTL và loại bỏ theo LRU."""
+
+    def __init__(self, maxsize: int = QUESTION_CACHE_MAXSIZE, ttl: int = QUESTION_CACHE_TTL_SECONDS):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[0] < time.time():
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def set(self, key: str, value: Any) -> None:
+        with self._lock:
+            self._data[key] = (time.time() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "backend": "memory",
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+        }
+
+
+class SQLiteCache:
+    """
+    Cache dùng chung giữa nhiều worker process trên cùng máy (file SQLite),
+    có TTL và loại bỏ theo LRU. Giá trị được lưu dưới dạng JSON.
+    """
+
+    def __init__(self, path: str = QUESTION_CACHE_PATH, maxsize: int = QUESTION_CACHE_MAXSIZE,
+                 ttl: int = QUESTION_CACHE_TTL_SECONDS):
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache_entries ("
+                " key TEXT PRIMARY KEY, value TEXT NOT NULL,"
+                " expires_at REAL NOT NULL, last_access REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_cache_entries_last_access ON cache_entries (last_access)")
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        conn = sqlite3.connect(self.path, timeout=5)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def get(self, key: str) -> Optional[Any]:
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT value, expires_at FROM cache_entries WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or row[1] < now:
+                if row is not None:
+                    conn.execute("DELETE FROM cache_entries WHERE key = ?", (key,))
+                self.misses += 1
+                return None
+            conn.execute("UPDATE cache_entries SET last_access = ? WHERE key = ?", (now, key))
+        self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, key: str, value: Any) -> None:
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO cache_entries (key, value, expires_at, last_access) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value, ensure_ascii=False), now + self.ttl, now),
+            )
+            conn.execute("DELETE FROM cache_entries WHERE expires_at < ?", (now,))
+            conn.execute(
+                "DELETE FROM cache_entries WHERE key IN ("
+                " SELECT key FROM cache_entries ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+                (self.maxsize,),
+            )
+
+    def delete(self, key: str) -> None:
+        with self._connect() as conn:
+            conn.execute("DELETE FROM cache_entries WHERE key = ?", (key,))
+
+    def clear(self) -> None:
+        with self._connect() as conn:
+            conn.execute("DELETE FROM cache_entries")
+
+    def stats(self) -> dict:
+        with self._connect() as conn:
+            size = conn.execute("SELECT COUNT(*) FROM cache_entries").fetchone()[0]
+        total = self.hits + self.misses
+        return {
+            "backend": "sqlite",
+            "size": size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+        }
+
+
+class NullCache:
+    """Tắt cache (QUESTION_CACHE_BACKEND=none)."""
+
+    hits = 0
+    misses = 0
+
+    def get(self, key: str) -> Optional[Any]:
+        return None
+
+    def set(self, key: str, value: Any) -> None:
+        pass
+
+    def delete(self, key: str) -> None:
+        pass
+
+    def clear(self) -> None:
+        pass
+
+    def stats(self) -> dict:
+        return {"backend": "none", "size": 0, "hits": 0, "misses": 0, "hit_ratio": 0.0}
+
+
+def make_cache(backend: str, path: str, maxsize: int, ttl: int):
+    if backend == "sqlite":
+        return SQLiteCache(path, maxsize=maxsize, ttl=ttl)
+    if backend == "none":
+        return NullCache()
+    return MemoryCache(maxsize=maxsize, ttl=ttl)
+
+
+# Cache bộ câu hỏi sinh từ JD
+question_cache = make_cache(
+    QUESTION_CACHE_BACKEND, QUESTION_CACHE_PATH, QUESTION_CACHE_MAXSIZE, QUESTION_CACHE_TTL_SECONDS
+)
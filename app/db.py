@@ -1,7 +1,12 @@
 import os
+import time
+import hashlib
 from dotenv import load_dotenv
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import Session, sessionmaker, declarative_base
+from sqlalchemy.pool import NullPool
+from app.metrics import DB_SESSION_SECONDS, instrument_engine
 
 load_dotenv()
 
@@ -11,15 +16,120 @@ DB_PASSWORD = os.getenv("DB_PASSWORD")
 DB_HOST = os.getenv("DB_HOST")
 DB_PORT = os.getenv("DB_PORT")
 
-DATABASE_URL = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+# DATABASE_URL (nếu có) được ưu tiên, ví dụ sqlite:///bench.sqlite3 khi chạy benchmark
+DATABASE_URL = os.getenv("DATABASE_URL") or f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+# Replica chỉ đọc cho các route tra cứu (để trống = đọc từ primary)
+DATABASE_REPLICA_URL = os.getenv("DATABASE_REPLICA_URL", "")
 
-engine = create_engine(DATABASE_URL, pool_pre_ping=True)
+# --------- Connection pool ---------
+# Số connection tối đa mỗi process = DB_POOL_SIZE + DB_MAX_OVERFLOW (nhân với số worker uvicorn)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT_SECONDS = float(os.getenv("DB_POOL_TIMEOUT_SECONDS", "30"))
+DB_POOL_RECYCLE_SECONDS = int(os.getenv("DB_POOL_RECYCLE_SECONDS", "1800"))
+# Hủy câu SQL chạy quá lâu (0 = không giới hạn)
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "0"))
+# Chạy sau PgBouncer ở chế độ transaction pooling: không giữ pool trong process,
+# không dùng prepared statement, statement_timeout đặt bằng SET LOCAL cho từng transaction
+DB_PGBOUNCER = os.getenv("DB_PGBOUNCER", "false").lower() in ("1", "true", "yes")
+
+
+def make_engine(url: str):
+    backend = make_url(url).get_backend_name()
+    if backend != "postgresql":
+        # SQLite (benchmark/dev): dùng pool mặc định của dialect
+        return create_engine(url, pool_pre_ping=True)
+
+    connect_args = {}
+    if DB_PGBOUNCER:
+        if make_url(url).get_driver_name() == "psycopg":
+            connect_args["prepare_threshold"] = None
+        engine = create_engine(url, poolclass=NullPool, connect_args=connect_args)
+    else:
+        if DB_STATEMENT_TIMEOUT_MS:
+            connect_args["options"] = f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"
+        engine = create_engine(
+            url,
+            pool_pre_ping=True,
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+            pool_timeout=DB_POOL_TIMEOUT_SECONDS,
+            pool_recycle=DB_POOL_RECYCLE_SECONDS,
+            connect_args=connect_args,
+        )
+
+    if DB_PGBOUNCER and DB_STATEMENT_TIMEOUT_MS:
+        # PgBouncer không nhận tham số "options" lúc kết nối; SET LOCAL chỉ sống trong transaction
+        @event.listens_for(engine, "begin")
+        def _set_statement_timeout(conn):
+            # Chạy thẳng trên DBAPI cursor: execute qua Connection trong sự kiện "begin" sẽ tự mở lại transaction
+            cursor = conn.connection.dbapi_connection.cursor()
+            try:
+                cursor.execute(f"SET LOCAL statement_timeout = {DB_STATEMENT_TIMEOUT_MS}")
+            finally:
+                cursor.close()
+
+    return engine
+
+
+engine = make_engine(DATABASE_URL)
+instrument_engine(engine)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+if DATABASE_REPLICA_URL:
+    read_engine = make_engine(DATABASE_REPLICA_URL)
+    instrument_engine(read_engine)
+else:
+    read_engine = engine
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=read_engine)
+
 Base = declarative_base()
 
 def get_db():
     db = SessionLocal()
+    opened_at = time.perf_counter()
     try:
         yield db
     finally:
         db.close()
+        DB_SESSION_SECONDS.observe(time.perf_counter() - opened_at)
+
+def get_read_db():
+    """Session cho route chỉ đọc: dùng replica nếu có DATABASE_REPLICA_URL (có thể trễ vài giây so với primary)."""
+    db = ReadSessionLocal()
+    opened_at = time.perf_counter()
+    try:
+        yield db
+    finally:
+        db.close()
+        DB_SESSION_SECONDS.observe(time.perf_counter() - opened_at)
+
+def release_connection(db: Session) -> None:
+    """
+    Commit và trả connection về pool nhưng không expire các object đã nạp: đọc thuộc tính sau đó
+    không mở lại transaction. Gọi trước mỗi lần chờ lâu (LLM, client của stream) để session
+    không giữ connection trong lúc chờ; lần ghi tiếp theo tự lấy connection mới trong thời gian ngắn.
+    """
+    expire_on_commit = db.expire_on_commit
+    db.expire_on_commit = False
+    try:
+        db.commit()
+    finally:
+        db.expire_on_commit = expire_on_commit
+
+# --------- Advisory lock ---------
+def lock_key(*parts) -> int:
+    """Khóa advisory 64-bit (có dấu) từ tên thao tác + id, ví dụ lock_key("evaluate_test_result", 42)."""
+    digest = hashlib.sha256(":".join(str(part) for part in parts).encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big", signed=True)
+
+def advisory_xact_lock(db: Session, *parts) -> None:
+    """
+    Khóa pg_advisory_xact_lock trong transaction hiện tại của session, nhả khi commit/rollback
+    (dùng được cả sau PgBouncer transaction pooling): các lần ghi cùng thao tác + id trên mọi
+    process/worker chạy tuần tự. Chỉ dùng quanh phần ghi ngắn, không giữ qua lúc chờ LLM.
+    Với CSDL khác Postgres (SQLite dev/benchmark) không khóa.
+    """
+    if db.get_bind().dialect.name != "postgresql":
+        return
+    db.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": lock_key(*parts)})
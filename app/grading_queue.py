@@ -0,0 +1,171 @@
+import os
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import List, Optional
+from sqlalchemy import and_, or_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from app.db import SessionLocal, release_connection
+from app.llm import PRIORITY_BULK
+from app.models import GradingJob
+from app.utils import evaluate_test_result_once
+
+logger = logging.getLogger(__name__)
+
+GRADING_WORKERS = int(os.getenv("GRADING_WORKERS", "2"))
+GRADING_MAX_ATTEMPTS = int(os.getenv("GRADING_MAX_ATTEMPTS", "3"))
+GRADING_POLL_INTERVAL_SECONDS = float(os.getenv("GRADING_POLL_INTERVAL_SECONDS", "1"))
+GRADING_RETRY_DELAY_SECONDS = float(os.getenv("GRADING_RETRY_DELAY_SECONDS", "10"))
+# Job "running" quá thời gian này được coi là worker đã chết và được nhận lại
+GRADING_LOCK_TIMEOUT_SECONDS = float(os.getenv("GRADING_LOCK_TIMEOUT_SECONDS", "600"))
+
+
+# --------- Enqueue / status ---------
+def job_status(job: GradingJob) -> dict:
+    return {
+        "result_id": job.result_id,
+        "status": job.status,
+        "attempts": job.attempts,
+        "last_error": job.last_error,
+        "created_at": job.created_at,
+        "updated_at": job.updated_at,
+    }
+
+def enqueue_grading(db: Session, result_id: int) -> GradingJob:
+    """
+    Đưa bài làm vào hàng đợi chấm. Idempotent: nếu đã có job đang chờ/đang chấm/đã chấm
+    thì trả về job đó; chỉ job "failed" mới được đưa lại vào hàng đợi.
+    """
+    job = db.query(GradingJob).filter(GradingJob.result_id == result_id).first()
+    if job is None:
+        job = GradingJob(result_id=result_id, status="queued", attempts=0, run_after=datetime.utcnow())
+        db.add(job)
+        try:
+            db.commit()
+        except IntegrityError:
+            # Request khác vừa tạo job cho cùng result_id
+            db.rollback()
+            job = db.query(GradingJob).filter(GradingJob.result_id == result_id).first()
+        return job
+
+    if job.status == "failed":
+        job.status = "queued"
+        job.attempts = 0
+        job.last_error = None
+        job.run_after = datetime.utcnow()
+        db.commit()
+    return job
+
+def get_grading_status(db: Session, result_ids: List[int]) -> List[GradingJob]:
+    return db.query(GradingJob).filter(GradingJob.result_id.in_(result_ids)).all()
+
+
+# --------- Worker ---------
+def claim_next_job(db: Session) -> Optional[GradingJob]:
+    """Nhận một job đến hạn (khóa bằng FOR UPDATE SKIP LOCKED để nhiều worker/process chạy song song)."""
+    now = datetime.utcnow()
+    job = (
+        db.query(GradingJob)
+        .filter(or_(
+            and_(GradingJob.status == "queued", GradingJob.run_after <= now),
+            and_(GradingJob.status == "running",
+                 GradingJob.locked_at < now - timedelta(seconds=GRADING_LOCK_TIMEOUT_SECONDS)),
+        ))
+        .order_by(GradingJob.run_after)
+        .with_for_update(skip_locked=True)
+        .first()
+    )
+    if job is None:
+        db.rollback()
+        return None
+
+    job.status = "running"
+    job.attempts += 1
+    job.locked_at = now
+    # Commit không expire job: caller đọc id mà không mở lại transaction
+    release_connection(db)
+    return job
+
+async def process_job(job_id: int, result_id: int) -> None:
+    """
+    Chấm bài của job đã nhận rồi cập nhật trạng thái job. Không giữ session trong lúc chờ LLM:
+    evaluate_test_result_once dùng session riêng, job được cập nhật trong một session mới sau đó.
+    """
+    try:
+        # Gộp với request chấm cùng bài đang chạy (API hoặc worker ở process khác)
+        result = await evaluate_test_result_once(result_id, priority=PRIORITY_BULK)
+        error = result.get("error")
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+
+    db = SessionLocal()
+    try:
+        job = db.get(GradingJob, job_id)
+        if job is not None:
+            finish_job(job, error)
+            db.commit()
+    finally:
+        db.close()
+
+def finish_job(job: GradingJob, error: Optional[str]) -> None:
+    if error is None:
+        job.status = "graded"
+        job.last_error = None
+    elif job.attempts < GRADING_MAX_ATTEMPTS:
+        job.status = "queued"
+        job.last_error = error
+        job.run_after = datetime.utcnow() + timedelta(seconds=GRADING_RETRY_DELAY_SECONDS * 2 ** (job.attempts - 1))
+    else:
+        job.status = "failed"
+        job.last_error = error
+    job.locked_at = None
+
+async def run_worker(stop: asyncio.Event) -> None:
+    while not stop.is_set():
+        claimed = None
+        db = SessionLocal()
+        try:
+            job = claim_next_job(db)
+            if job is not None:
+                claimed = (job.job_id, job.result_id)
+        except Exception:
+            db.rollback()
+            logger.exception("Grading worker error")
+        finally:
+            # Trả connection trước khi chờ LLM
+            db.close()
+
+        if claimed is not None:
+            try:
+                await process_job(*claimed)
+            except Exception:
+                logger.exception("Grading worker error", extra={"result_id": claimed[1]})
+        else:
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=GRADING_POLL_INTERVAL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+
+
+class GradingQueue:
+    """Quản lý các worker chấm bài chạy nền trong process (khởi động/dừng cùng app)."""
+
+    def __init__(self, workers: int = GRADING_WORKERS):
+        self.workers = workers
+        self._stop: Optional[asyncio.Event] = None
+        self._tasks: List[asyncio.Task] = []
+
+    def start(self) -> None:
+        self._stop = asyncio.Event()
+        self._tasks = [asyncio.create_task(run_worker(self._stop)) for _ in range(self.workers)]
+
+    async def stop(self) -> None:
+        if self._stop is None:
+            return
+        self._stop.set()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+
+grading_queue = GradingQueue()
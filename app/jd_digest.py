@@ -0,0 +1,192 @@
+import os
+import re
+import math
+from datetime import datetime
+from typing import List, Optional
+from sqlalchemy.orm import Session
+from sqlalchemy.exc import IntegrityError
+from app.cache import normalize_text, content_key
+from app.models import Job, JobDigest
+from app.utils import detect_language
+
+# Ngân sách token (ước lượng) của phần tóm tắt JD trong prompt sinh câu hỏi; 0 = không giới hạn
+JD_DIGEST_MAX_TOKENS = int(os.getenv("JD_DIGEST_MAX_TOKENS", "600"))
+
+# Đổi cách tóm tắt thì tăng version: mọi digest được tính lại ở lần dùng tiếp theo
+DIGEST_VERSION = "digest-v1"
+# Câu dài hơn số từ này bị cắt thành nhiều đoạn (JD viết liền một khối không bị bỏ cả đoạn)
+MAX_SENTENCE_WORDS = 50
+
+_WORD = re.compile(r"\w+")
+_SENTENCE_END = re.compile(r"(?<=[.!?;])\s+|\n+")
+_BULLET = re.compile(r"^\s*(?:[-*•·+]|\d+[.)])\s*")
+
+SENIORITY_KEYWORDS = {
+    "entry": ("intern", "fresher", "entry", "junior", "graduate", "thực tập"),
+    "mid": ("mid", "middle", "intermediate", "associate", "experienced"),
+    "senior": ("senior", "lead", "principal", "staff", "expert", "manager", "head", "director", "architect"),
+}
+
+LABELS = {
+    "vi": {
+        "title": "Vị trí",
+        "seniority": "Mức độ kinh nghiệm",
+        "experience": "Số năm kinh nghiệm",
+        "years": "năm",
+        "requirements": "Yêu cầu",
+        "responsibilities": "Trách nhiệm",
+        "description": "Mô tả",
+        "entry": "Ít kinh nghiệm (dưới 2 năm)",
+        "mid": "Kinh nghiệm trung bình (2–5 năm)",
+        "senior": "Kinh nghiệm cao (Senior, trên 5 năm)",
+    },
+    "en": {
+        "title": "Title",
+        "seniority": "Seniority",
+        "experience": "Experience",
+        "years": "years",
+        "requirements": "Requirements",
+        "responsibilities": "Responsibilities",
+        "description": "Description",
+        "entry": "Entry-level (under 2 years)",
+        "mid": "Mid-level (2–5 years)",
+        "senior": "Senior-level (5+ years)",
+    },
+}
+
+# Thứ tự ưu tiên khi hết ngân sách: yêu cầu nói rõ nhất cần hỏi gì, mô tả chung ít thông tin nhất
+SECTIONS = ("requirements", "responsibilities", "description")
+
+
+def estimate_tokens(text: str) -> int:
+    """Ước lượng số token (không phụ thuộc tokenizer của model): lấy mức cao hơn giữa ~4 ký tự và ~0.75 từ một token."""
+    if not text:
+        return 0
+    return max(math.ceil(len(text) / 4), math.ceil(len(_WORD.findall(text)) * 4 / 3))
+
+def seniority_level(experience_level: Optional[str], min_years: Optional[int], max_years: Optional[int]) -> Optional[str]:
+    """entry | mid | senior theo experience_level, không khớp thì theo số năm kinh nghiệm; None nếu không rõ."""
+    level = normalize_text(experience_level or "")
+    for seniority, keywords in SENIORITY_KEYWORDS.items():
+        if level and any(keyword in level for keyword in keywords):
+            return seniority
+    years = min_years if min_years is not None else max_years
+    if years is None:
+        return None
+    if years < 2:
+        return "entry"
+    return "mid" if years < 5 else "senior"
+
+def _experience_years(min_years: Optional[int], max_years: Optional[int], unit: str) -> Optional[str]:
+    if min_years is not None and max_years is not None and max_years > min_years:
+        return f"{min_years}–{max_years} {unit}"
+    if min_years is not None:
+        return f"{min_years}+ {unit}"
+    if max_years is not None:
+        return f"≤{max_years} {unit}"
+    return None
+
+def split_sentences(text: str) -> List[str]:
+    sentences = []
+    for part in _SENTENCE_END.split(text or ""):
+        part = re.sub(r"\s+", " ", _BULLET.sub("", part)).strip()
+        if not _WORD.search(part):
+            continue
+        words = part.split(" ")
+        sentences.extend(" ".join(words[i:i + MAX_SENTENCE_WORDS]) for i in range(0, len(words), MAX_SENTENCE_WORDS))
+    return sentences
+
+
+# --------- Tóm tắt ---------
+def build_digest(job: Job, lang: str, max_tokens: int = JD_DIGEST_MAX_TOKENS) -> dict:
+    """
+    Tóm tắt JD từ các trường của job: tiêu đề, mức độ kinh nghiệm tường minh, rồi các câu của
+    yêu cầu / trách nhiệm / mô tả (bỏ câu trùng giữa các phần) lấy lần lượt từng phần một câu
+    đến khi hết ngân sách, để phần nào cũng có mặt. Job không có nội dung thì summary rỗng.
+    """
+    labels = LABELS.get(lang, LABELS["en"])
+    seniority = seniority_level(job.experience_level, job.min_experience_years, job.max_experience_years)
+
+    seen = set()
+    sections = []
+    for name in SECTIONS:
+        sentences = []
+        for sentence in split_sentences(getattr(job, name)):
+            key = normalize_text(sentence)
+            if key not in seen:
+                seen.add(key)
+                sentences.append(sentence)
+        sections.append((name, sentences))
+    if not any(sentences for _, sentences in sections):
+        return {"seniority": seniority, "summary": "", "token_estimate": 0}
+
+    header = []
+    if job.title:
+        header.append(f"{labels['title']}: {job.title.strip()}")
+    if seniority:
+        header.append(f"{labels['seniority']}: {labels[seniority]}")
+    years = _experience_years(job.min_experience_years, job.max_experience_years, labels["years"])
+    if years:
+        header.append(f"{labels['experience']}: {years}")
+
+    budget = max_tokens - estimate_tokens("\n".join(header)) if max_tokens > 0 else math.inf
+    picked = {name: [] for name, _ in sections}
+    # Mỗi vòng lấy câu tiếp theo của từng phần; phần có câu không vừa ngân sách thì dừng lấy
+    pending = [(name, iter(sentences)) for name, sentences in sections if sentences]
+    while pending:
+        still_pending = []
+        for name, sentences in pending:
+            sentence = next(sentences, None)
+            if sentence is None:
+                continue
+            cost = estimate_tokens(sentence) + 1
+            if not picked[name]:
+                cost += estimate_tokens(labels[name]) + 1
+            if cost > budget:
+                continue
+            budget -= cost
+            picked[name].append(sentence)
+            still_pending.append((name, sentences))
+        pending = still_pending
+
+    lines = list(header)
+    for name, _ in sections:
+        if picked[name]:
+            lines.append(f"{labels[name]}:")
+            lines.extend(f"- {sentence}" for sentence in picked[name])
+    summary = "\n".join(lines)
+    return {"seniority": seniority, "summary": summary, "token_estimate": estimate_tokens(summary)}
+
+def _digest_hash(job: Job, max_tokens: int) -> str:
+    return content_key(
+        DIGEST_VERSION, max_tokens, job.title or "", job.description or "", job.requirements or "",
+        job.responsibilities or "", job.experience_level or "", job.min_experience_years, job.max_experience_years,
+    )
+
+def get_job_digest(db: Session, job: Job, max_tokens: int = JD_DIGEST_MAX_TOKENS) -> JobDigest:
+    """
+    Digest đã lưu của job; tính lại (và commit) chỉ khi các trường của job, DIGEST_VERSION
+    hoặc ngân sách token đã đổi so với lần tính trước.
+    """
+    digest_hash = _digest_hash(job, max_tokens)
+    row = db.get(JobDigest, job.job_id)
+    if row is not None and row.content_hash == digest_hash:
+        return row
+
+    text = "\n".join(part for part in (job.description, job.requirements, job.responsibilities) if part)
+    lang = detect_language(text)
+    values = {"content_hash": digest_hash, "lang": lang, "updated_at": datetime.utcnow(),
+              **build_digest(job, lang, max_tokens)}
+    if row is None:
+        row = JobDigest(job_id=job.job_id, **values)
+        try:
+            with db.begin_nested():
+                db.add(row)
+        except IntegrityError:
+            # Process khác vừa lưu digest của job này (cùng nội dung)
+            row = db.get(JobDigest, job.job_id, populate_existing=True)
+    else:
+        for key, value in values.items():
+            setattr(row, key, value)
+    db.commit()
+    return row
@@ -0,0 +1,108 @@
+import os
+import threading
+import unicodedata
+from typing import Dict, List, Optional
+from langdetect.detector_factory import DetectorFactory, PROFILES_DIRECTORY
+from langdetect.lang_detect_exception import LangDetectException
+from .cache import MemoryCache, content_key, normalize_text
+
+# Danh sách profile langdetect cần nạp, ví dụ "en,vi" (để trống = tất cả)
+LANGUAGE_PROFILES = os.getenv("LANGUAGE_PROFILES", "")
+LANGUAGE_CACHE_MAXSIZE = int(os.getenv("LANGUAGE_CACHE_MAXSIZE", "10000"))
+# Tối thiểu số ký tự đặc trưng tiếng Việt để kết luận "vi" mà không cần chạy langdetect
+VI_FAST_PATH_MIN_CHARS = int(os.getenv("VI_FAST_PATH_MIN_CHARS", "2"))
+
+# Ký tự chỉ xuất hiện trong tiếng Việt (ă, ơ, ư, đ và các nguyên âm có dấu nặng/hỏi/ngã đặc trưng)
+VI_CHARS = frozenset(
+    "ăắằẳẵặơớờởỡợưứừửữựđ"
+    "ạảấầẩẫậẹẻẽếềểễệỉịọỏốồổỗộụủỳỵỷỹĩũ"
+)
+
+
+class LanguageDetector:
+    """
+    Nhận diện ngôn ngữ vi/en cho việc chọn prompt:
+    - profile langdetect được nạp một lần (warm_up lúc khởi động app), seed cố định nên kết quả ổn định;
+    - đường tắt rẻ: văn bản có dấu tiếng Việt đặc trưng -> "vi" ngay;
+    - ghi nhớ kết quả theo hash văn bản và theo question_id.
+    """
+
+    def __init__(self, profiles: str = LANGUAGE_PROFILES, cache_maxsize: int = LANGUAGE_CACHE_MAXSIZE):
+        self.profiles = [p.strip() for p in profiles.split(",") if p.strip()]
+        self._factory: Optional[DetectorFactory] = None
+        self._lock = threading.Lock()
+        self._by_text = MemoryCache(maxsize=cache_maxsize, ttl=10 ** 9)
+        self._by_question = MemoryCache(maxsize=cache_maxsize, ttl=10 ** 9)
+
+    def warm_up(self) -> None:
+        if self._factory is not None:
+            return
+        with self._lock:
+            if self._factory is not None:
+                return
+            factory = DetectorFactory()
+            factory.seed = 0
+            if self.profiles:
+                json_profiles = []
+                for name in self.profiles:
+                    with open(os.path.join(PROFILES_DIRECTORY, name), encoding="utf-8") as f:
+                        json_profiles.append(f.read())
+                factory.load_json_profile(json_profiles)
+            else:
+                factory.load_profile(PROFILES_DIRECTORY)
+            self._factory = factory
+
+    @staticmethod
+    def fast_path(text: str) -> Optional[str]:
+        normalized = unicodedata.normalize("NFC", text).lower()
+        count = 0
+        for ch in normalized:
+            if ch in VI_CHARS:
+                count += 1
+                if count >= VI_FAST_PATH_MIN_CHARS:
+                    return "vi"
+        return None
+
+    def _detect_uncached(self, text: str) -> Optional[str]:
+        lang = self.fast_path(text)
+        if lang:
+            return lang
+        self.warm_up()
+        try:
+            detector = self._factory.create()
+            detector.append(text)
+            return "vi" if detector.detect() == "vi" else "en"
+        except LangDetectException:
+            return None
+
+    def detect(self, text: str, default: str = "en") -> str:
+        if not text or not text.strip():
+            return default
+        key = content_key(normalize_text(text))
+        lang = self._by_text.get(key)
+        if lang is None:
+            lang = self._detect_uncached(text) or ""
+            self._by_text.set(key, lang)
+        return lang or default
+
+    def detect_many(self, texts: List[str], default: str = "en") -> List[str]:
+        """Nhận diện cho cả một lô văn bản; văn bản trùng nhau chỉ được xử lý một lần."""
+        seen: Dict[str, str] = {}
+        results = []
+        for text in texts:
+            if text not in seen:
+                seen[text] = self.detect(text, default)
+            results.append(seen[text])
+        return results
+
+    def detect_question(self, question_id: int, text: str, default: str = "en") -> str:
+        key = content_key(normalize_text(text))
+        cached = self._by_question.get(question_id)
+        if cached and cached[0] == key:
+            return cached[1]
+        lang = self.detect(text, default)
+        self._by_question.set(question_id, (key, lang))
+        return lang
+
+
+language_detector = LanguageDetector()
@@ -0,0 +1,379 @@
+import os
+import json
+import time
+import heapq
+import random
+import asyncio
+import logging
+import itertools
+from email.utils import parsedate_to_datetime
+from typing import AsyncIterator, List, Optional
+import httpx
+from .metrics import LLM_QUEUE_SECONDS, LLM_REQUEST_SECONDS, LLM_RETRIES, observe_llm_tokens
+
+logger = logging.getLogger(__name__)
+
+LLM_API_URL = os.getenv("LLM_API_URL", "https://api.groq.com/openai/v1/chat/completions")
+LLM_MODEL_NAME = os.getenv("LLM_MODEL_NAME", "llama3-8b-8192")
+GROQ_API_KEY = os.getenv("GROQ_API_KEY", "")
+
+# --------- Connection pool / limits ---------
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", "30"))
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "100"))
+LLM_MAX_KEEPALIVE = int(os.getenv("LLM_MAX_KEEPALIVE", "20"))
+# Số request LLM đang chạy đồng thời tối đa trên toàn process
+LLM_MAX_IN_FLIGHT = int(os.getenv("LLM_MAX_IN_FLIGHT", "50"))
+
+# --------- Rate limit / retry ---------
+# Giới hạn của provider (0 = không giới hạn)
+LLM_REQUESTS_PER_MINUTE = float(os.getenv("LLM_REQUESTS_PER_MINUTE", "30"))
+LLM_TOKENS_PER_MINUTE = float(os.getenv("LLM_TOKENS_PER_MINUTE", "30000"))
+# Số token dự trù cho phần model trả lời khi ước lượng trước một request
+LLM_COMPLETION_TOKENS_ESTIMATE = int(os.getenv("LLM_COMPLETION_TOKENS_ESTIMATE", "512"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "4"))
+LLM_BACKOFF_BASE_SECONDS = float(os.getenv("LLM_BACKOFF_BASE_SECONDS", "1"))
+LLM_BACKOFF_MAX_SECONDS = float(os.getenv("LLM_BACKOFF_MAX_SECONDS", "30"))
+
+# Làn ưu tiên: số nhỏ được phục vụ trước
+PRIORITY_INTERACTIVE = 0   # chấm một câu trả lời, sinh câu hỏi cho một JD
+PRIORITY_DEFAULT = 1       # chấm cả bài test
+PRIORITY_BULK = 2          # sinh câu hỏi hàng loạt, hàng đợi chấm nền
+
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+# Gửi response_format (JSON mode) cho các lời gọi cần JSON; provider/model không hỗ trợ
+# (HTTP 400 nhắc tới response_format) thì tự tắt và gửi lại không kèm response_format
+LLM_JSON_MODE = os.getenv("LLM_JSON_MODE", "true").lower() in ("1", "true", "yes")
+
+
+class LLMError(Exception):
+    """Lỗi khi gọi LLM API (HTTP lỗi, timeout, mất kết nối, response sai định dạng)."""
+
+
+class TokenBucket:
+    """Token bucket nạp lại liên tục theo `rate_per_minute`, dung lượng tối đa bằng lượng của một phút."""
+
+    def __init__(self, rate_per_minute: float):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = rate_per_minute
+        self.tokens = rate_per_minute
+        self.updated_at = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self, amount: float) -> float:
+        """Số giây cần chờ để có đủ `amount` (0 nếu có ngay)."""
+        if self.rate <= 0:
+            return 0.0
+        self._refill()
+        amount = min(amount, self.capacity)
+        return 0.0 if self.tokens >= amount else (amount - self.tokens) / self.rate
+
+    def consume(self, amount: float) -> None:
+        if self.rate <= 0:
+            return
+        self._refill()
+        self.tokens -= amount
+
+
+class LLMScheduler:
+    """
+    Điều phối mọi lời gọi LLM trong process: giới hạn số request đang chạy,
+    token bucket cho request/phút và token/phút, tạm dừng khi provider trả Retry-After,
+    và phục vụ theo làn ưu tiên (PRIORITY_*), cùng làn thì theo thứ tự đến.
+    """
+
+    def __init__(
+        self,
+        max_in_flight: int = LLM_MAX_IN_FLIGHT,
+        requests_per_minute: float = LLM_REQUESTS_PER_MINUTE,
+        tokens_per_minute: float = LLM_TOKENS_PER_MINUTE,
+    ):
+        self.max_in_flight = max_in_flight
+        self.request_bucket = TokenBucket(requests_per_minute)
+        self.token_bucket = TokenBucket(tokens_per_minute)
+        self.in_flight = 0
+        self._paused_until = 0.0
+        self._waiters: list = []
+        self._seq = itertools.count()
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    def pause(self, seconds: float) -> None:
+        """Tạm dừng gửi request mới (ví dụ khi nhận 429 kèm Retry-After)."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def _dispatch(self) -> None:
+        self._timer = None
+        while self._waiters and self.in_flight < self.max_in_flight:
+            _, _, tokens, future = self._waiters[0]
+            if future.done():
+                heapq.heappop(self._waiters)
+                continue
+
+            wait = max(
+                self._paused_until - time.monotonic(),
+                self.request_bucket.wait_time(1),
+                self.token_bucket.wait_time(tokens),
+            )
+            if wait > 0:
+                self._timer = asyncio.get_running_loop().call_later(wait, self._dispatch)
+                return
+
+            heapq.heappop(self._waiters)
+            self.request_bucket.consume(1)
+            self.token_bucket.consume(tokens)
+            self.in_flight += 1
+            future.set_result(None)
+
+    async def acquire(self, priority: int = PRIORITY_DEFAULT, tokens: int = 0) -> None:
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), tokens, future))
+        if self._timer is not None:
+            self._timer.cancel()
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Đã được cấp slot nhưng caller bị hủy -> trả lại slot
+                self.release()
+            raise
+
+    def release(self, tokens_used: int = 0, tokens_reserved: int = 0) -> None:
+        """Trả slot; điều chỉnh token bucket theo số token thực tế (usage) so với số đã dự trù."""
+        self.in_flight -= 1
+        if tokens_used:
+            self.token_bucket.consume(tokens_used - tokens_reserved)
+        if self._timer is None:
+            self._dispatch()
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "waiting": sum(1 for *_, future in self._waiters if not future.done()),
+            "paused_for_seconds": round(max(0.0, self._paused_until - time.monotonic()), 2),
+        }
+
+
+def estimate_tokens(messages: List[dict]) -> int:
+    # ~4 ký tự / token cho prompt, cộng phần dự trù cho câu trả lời
+    return sum(len(m.get("content", "")) for m in messages) // 4 + LLM_COMPLETION_TOKENS_ESTIMATE
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def backoff_delay(attempt: int) -> float:
+    # Exponential backoff với full jitter
+    return random.uniform(0, min(LLM_BACKOFF_MAX_SECONDS, LLM_BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+
+class LLMClient:
+    """
+    Client async dùng chung cho mọi lời gọi LLM (OpenAI-compatible chat completions).
+    Giữ một connection pool keep-alive, timeout theo từng lời gọi; mọi request đi qua
+    LLMScheduler và được thử lại khi gặp 429/5xx/lỗi mạng.
+    """
+
+    def __init__(
+        self,
+        api_url: str = LLM_API_URL,
+        api_key: str = GROQ_API_KEY,
+        timeout: float = LLM_TIMEOUT_SECONDS,
+        max_connections: int = LLM_MAX_CONNECTIONS,
+        max_keepalive: int = LLM_MAX_KEEPALIVE,
+        scheduler: Optional[LLMScheduler] = None,
+        max_retries: int = LLM_MAX_RETRIES,
+    ):
+        self.api_url = api_url
+        self.api_key = api_key
+        self.timeout = timeout
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive)
+        self.scheduler = scheduler or LLMScheduler()
+        self.max_retries = max_retries
+        self.json_mode = LLM_JSON_MODE
+        self._client: Optional[httpx.AsyncClient] = None
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                headers={
+                    "Authorization": f"Bearer {self.api_key}",
+                    "Content-Type": "application/json",
+                },
+                limits=self.limits,
+                timeout=self.timeout,
+            )
+        return self._client
+
+    def _failed_response(self, status_code: int, text: str, headers, attempt: int):
+        """Xử lý response lỗi: raise nếu không nên thử lại, ngược lại trả về (error, retry_after)."""
+        error = LLMError(f"HTTP {status_code}: {text}")
+        if status_code not in RETRYABLE_STATUS:
+            raise error
+        retry_after = parse_retry_after(headers.get("retry-after"))
+        if status_code == 429:
+            self.scheduler.pause(retry_after if retry_after is not None else backoff_delay(attempt))
+        return error, retry_after
+
+    async def _acquire(self, priority: int, tokens: int) -> None:
+        queued_at = time.perf_counter()
+        await self.scheduler.acquire(priority, tokens)
+        LLM_QUEUE_SECONDS.labels(str(priority)).observe(time.perf_counter() - queued_at)
+
+    async def _wait_before_retry(self, error: LLMError, retry_after: Optional[float], attempt: int,
+                                 operation: str, model: str) -> None:
+        delay = retry_after if retry_after is not None else backoff_delay(attempt)
+        LLM_RETRIES.labels(operation, model).inc()
+        logger.warning("LLM call failed, retrying", extra={
+            "operation": operation, "model": model, "attempt": attempt + 1,
+            "error": str(error), "retry_in_seconds": round(delay, 2),
+        })
+        await asyncio.sleep(delay)
+
+    async def chat(
+        self,
+        messages: List[dict],
+        model: str = LLM_MODEL_NAME,
+        temperature: float = 0.7,
+        timeout: Optional[float] = None,
+        priority: int = PRIORITY_DEFAULT,
+        operation: str = "chat",
+        response_format: Optional[dict] = None,
+    ) -> str:
+        payload = {
+            "model": model,
+            "messages": messages,
+            "temperature": temperature,
+        }
+        if response_format and self.json_mode:
+            payload["response_format"] = response_format
+        reserved = estimate_tokens(messages)
+
+        for attempt in range(self.max_retries + 1):
+            retry_after = None
+            await self._acquire(priority, reserved)
+            used = 0
+            outcome = "error"
+            sent_at = time.perf_counter()
+            try:
+                response = await self._get_client().post(
+                    self.api_url, json=payload, timeout=timeout or self.timeout
+                )
+                if response.status_code == 200:
+                    try:
+                        data = response.json()
+                        content = data["choices"][0]["message"]["content"]
+                    except (ValueError, KeyError, IndexError, TypeError, AttributeError) as e:
+                        raise LLMError(f"Unexpected response: {response.text}") from e
+                    used = observe_llm_tokens(operation, model, data.get("usage"))
+                    outcome = "ok"
+                    return content
+
+                if response.status_code == 400 and "response_format" in payload and "response_format" in response.text:
+                    logger.warning("LLM rejected response_format, disabling JSON mode", extra={
+                        "operation": operation, "model": model, "error": response.text[:500],
+                    })
+                    self.json_mode = False
+                    del payload["response_format"]
+                    error = LLMError(f"HTTP 400: {response.text}")
+                    continue
+
+                error, retry_after = self._failed_response(
+                    response.status_code, response.text, response.headers, attempt
+                )
+            except httpx.HTTPError as e:
+                error = LLMError(f"{type(e).__name__}: {e}")
+            finally:
+                LLM_REQUEST_SECONDS.labels(operation, model, outcome).observe(time.perf_counter() - sent_at)
+                self.scheduler.release(used, reserved)
+
+            if attempt < self.max_retries:
+                await self._wait_before_retry(error, retry_after, attempt, operation, model)
+
+        raise error
+
+    async def stream_chat(
+        self,
+        messages: List[dict],
+        model: str = LLM_MODEL_NAME,
+        temperature: float = 0.7,
+        timeout: Optional[float] = None,
+        priority: int = PRIORITY_DEFAULT,
+        operation: str = "chat_stream",
+    ) -> AsyncIterator[str]:
+        """
+        Gọi chat completions ở chế độ stream (SSE) và yield từng đoạn nội dung ngay khi nhận được.
+        Chỉ thử lại khi lỗi xảy ra trước khi nhận được đoạn nội dung đầu tiên.
+        """
+        payload = {
+            "model": model,
+            "messages": messages,
+            "temperature": temperature,
+            "stream": True,
+        }
+        reserved = estimate_tokens(messages)
+
+        for attempt in range(self.max_retries + 1):
+            retry_after = None
+            started = False
+            await self._acquire(priority, reserved)
+            outcome = "error"
+            sent_at = time.perf_counter()
+            try:
+                async with self._get_client().stream(
+                    "POST", self.api_url, json=payload, timeout=timeout or self.timeout
+                ) as response:
+                    if response.status_code == 200:
+                        async for line in response.aiter_lines():
+                            if not line.startswith("data:"):
+                                continue
+                            data = line[len("data:"):].strip()
+                            if data == "[DONE]":
+                                break
+                            try:
+                                chunk = json.loads(data)
+                                # Một số provider gửi usage ở chunk cuối
+                                observe_llm_tokens(operation, model, chunk.get("usage"))
+                                delta = chunk["choices"][0].get("delta", {}).get("content")
+                            except (ValueError, KeyError, IndexError, TypeError, AttributeError):
+                                continue
+                            if delta:
+                                started = True
+                                yield delta
+                        outcome = "ok"
+                        return
+
+                    body = (await response.aread()).decode("utf-8", errors="replace")
+                    error, retry_after = self._failed_response(response.status_code, body, response.headers, attempt)
+            except httpx.HTTPError as e:
+                error = LLMError(f"{type(e).__name__}: {e}")
+                if started:
+                    raise error from e
+            finally:
+                LLM_REQUEST_SECONDS.labels(operation, model, outcome).observe(time.perf_counter() - sent_at)
+                self.scheduler.release()
+
+            if attempt < self.max_retries:
+                await self._wait_before_retry(error, retry_after, attempt, operation, model)
+
+        raise error
+
+    async def aclose(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+llm_client = LLMClient()
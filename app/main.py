@@ -1,57 +1,152 @@
-from fastapi import FastAPI, Depends, HTTPException, Path
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Depends, HTTPException, Path, Query
+from fastapi.responses import StreamingResponse, JSONResponse, Response
+from fastapi.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
-from app.db import get_db
+from app.log import configure_logging
+from app.metrics import MetricsMiddleware, render_metrics
+from app.db import get_db, get_read_db, SessionLocal, advisory_xact_lock, release_connection
+from app.singleflight import single_flight
+from app.llm import llm_client, LLMError, PRIORITY_INTERACTIVE
+from app.cache import question_cache
+from app.language import language_detector
+from app.prompts import prompt_registry
+from app.bulk import submit_bulk_generation, get_bulk_batch
+from app.grading_queue import grading_queue, enqueue_grading, get_grading_status, job_status
+from app.question_pool import question_pool_scheduler, sample_from_pool, fill_job_pool, pool_status
+from app.similarity import find_similar_test, signature_backfill
+from app.jd_digest import get_job_digest
+from app.analytics import job_analytics, tests_analytics, question_analytics
 from app.utils import (
-    get_job, get_or_create_job_test, create_question,
-    generate_questions_from_jd, evaluate_single_answer, evaluate_test_result, get_answer_details
+    get_job, create_question, upsert_job_test_questions,
+    generate_questions_from_jd, evaluate_single_answer, evaluate_test_result, get_answer_details,
+    get_answer_details_bulk, stream_questions_from_jd, save_streamed_question, publish_streamed_questions,
+    discard_streamed_questions,
+    format_stream_event, stream_test_result_grading, list_test_questions, get_recently_generated_test,
+    evaluate_test_result_once,
+    invalidate_question_evaluations, evaluation_cache_stats
 )
 from app.models import TestQuestion, JobTest, Job, QuestionAnswer, TestResult,  Application
 from app.utils import GenerateQuestionRequest, QuestionCreate, EvaluateAnswerRequest
-from typing import List
+from typing import List, Optional
+from datetime import datetime
 
-app = FastAPI(title="JD AI Interview Question API")
+configure_logging()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Nạp profile nhận diện ngôn ngữ một lần, trước khi nhận request
+    language_detector.warm_up()
+    # Nạp & biên dịch prompt template một lần
+    prompt_registry.load()
+    grading_queue.start()
+    question_pool_scheduler.start()
+    signature_backfill.start()
+    yield
+    await signature_backfill.stop()
+    await question_pool_scheduler.stop()
+    await grading_queue.stop()
+    # Đóng connection pool tới LLM khi tắt server
+    await llm_client.aclose()
+
+app = FastAPI(title="JD AI Interview Question API", lifespan=lifespan)
+app.add_middleware(MetricsMiddleware)
 
 api_prefix = "/api/v1/ai"
 
+@app.exception_handler(LLMError)
+async def llm_error_handler(request, exc: LLMError):
+    # LLM vẫn lỗi sau khi đã thử lại (rate limit, 5xx, timeout...)
+    return JSONResponse(status_code=503, content={"detail": f"LLM service unavailable: {exc}"})
+
 # 1. Generate questions from single JD
 @app.post(f"{api_prefix}/generate-interview-questions")
-def generate_interview_questions(payload: GenerateQuestionRequest, db: Session = Depends(get_db)):
-    # 1. Lấy thông tin job
-    job = get_job(db, payload.job_id)
+async def generate_interview_questions(payload: GenerateQuestionRequest, read_db: Session = Depends(get_read_db)):
+    # 1. Lấy thông tin job (từ replica nếu có), trả connection trước khi chờ LLM
+    job = get_job(read_db, payload.job_id)
     if not job:
         raise HTTPException(status_code=404, detail="Job not found")
+    read_db.close()
 
-    # 2. Gọi AI để sinh câu hỏi (kết quả là list[dict])
-    questions = generate_questions_from_jd(job.description or "")
+    return await generate_job_questions_once(job, payload.replace_existing)
+
+async def generate_job_questions_once(job: Job, replace: bool, priority: int = PRIORITY_INTERACTIVE) -> dict:
+    """
+    Sinh & lưu câu hỏi cho một job (pool, job gần trùng rồi mới gọi LLM). Dùng cho cả route sinh
+    đơn lẻ và bulk: request trùng cho cùng job và cùng replace (double-click, nhiều tab, batch)
+    dùng chung một lần sinh.
+    """
+    return await single_flight.do(
+        ("generate_questions", job.job_id, replace),
+        lambda: _generate_job_questions(job, replace, priority)
+    )
+
+async def _generate_job_questions(job: Job, replace: bool, priority: int = PRIORITY_INTERACTIVE) -> dict:
+    # Phần đọc/ghi DB chạy trong threadpool với session riêng (task dùng chung có thể chạy lâu hơn
+    # request đã tạo ra nó); event loop chỉ chờ LLM
+    job_id = job.job_id
+    requested_at = datetime.utcnow()
+    # 2. Lấy bộ câu hỏi từ pool sinh sẵn, rồi từ job gần trùng (trừ khi muốn sinh lại);
+    #    không có thì gọi AI để sinh từ digest của JD (kết quả là list[dict])
+    jd_text, lang, questions, source = await run_in_threadpool(_prepare_generation, job, replace)
+    if questions is None:
+        questions = await generate_questions_from_jd(jd_text, priority=priority, lang=lang)
+        source = "llm"
     if not questions:
         raise HTTPException(status_code=500, detail="Failed to generate questions")
 
-    # 3. Tạo hoặc lấy job_test tương ứng
-    test = get_or_create_job_test(db, payload.job_id)
-
-    # 4. Lưu từng câu hỏi vào test_questions
-    saved_questions = []
-    for idx, item in enumerate(questions):
-        q = TestQuestion(
-            test_id=test.test_id,
-            question_text=item["question_text"],
-            question_type=item["question_type"],  # "core", "problem_solving", "fit"
-            points=1.0,
-            time_limit_seconds=120,
-            order_index=idx + 1,
-            explanation="",
-            required=True
-        )
-        db.add(q)
-        saved_questions.append(q)
+    return await run_in_threadpool(_save_generated_questions, job_id, questions, source, replace, requested_at)
 
-    db.commit()
+def _save_generated_questions(job_id: int, questions: List[dict], source: str, replace: bool,
+                              requested_at: datetime) -> dict:
+    """Phần ghi của _generate_job_questions (sync, gọi qua run_in_threadpool) với session riêng."""
+    db = SessionLocal()
+    try:
+        # 3. Ghi tuần tự với process khác đang ghi câu hỏi cho cùng job (khóa nhả khi commit);
+        #    nếu process đó vừa lưu một bộ câu hỏi sau khi request này bắt đầu thì dùng lại bộ đó
+        advisory_xact_lock(db, "generate_questions", job_id)
+        test = get_recently_generated_test(db, job_id, requested_at)
+        if test:
+            return _generated_questions_response(job_id, test, list_test_questions(db, test.test_id), "shared")
+
+        # Tạo hoặc lấy job_test tương ứng và lưu toàn bộ câu hỏi trong một transaction
+        test, saved_questions = upsert_job_test_questions(db, job_id, questions, replace=replace)
+        return _generated_questions_response(job_id, test, saved_questions, source)
+    finally:
+        db.close()
+
+def _prepare_generation(job: Job, replace: bool):
+    """
+    (jd_text, lang, bộ câu hỏi dùng lại được hoặc None, nguồn) với session riêng. Hàm sync, gọi qua
+    run_in_threadpool: tra cứu digest, pool và MinHash/LSH (refresh index) không chặn event loop.
+    """
+    db = SessionLocal()
+    try:
+        digest = get_job_digest(db, job)
+        questions, source = _reusable_questions(db, job.job_id, digest.summary, replace)
+        return digest.summary, digest.lang, questions, source
+    finally:
+        db.close()
 
+def _reusable_questions(db: Session, job_id: int, jd_text: str, replace: bool):
+    """(bộ câu hỏi không cần gọi LLM, nguồn "pool" | "similar") hoặc (None, None)."""
+    questions = sample_from_pool(db, job_id, jd_text)
+    if questions is not None:
+        return questions, "pool"
+    if not replace:
+        similar = find_similar_test(db, job_id)
+        if similar and similar["questions"]:
+            return similar["questions"], "similar"
+    return None, None
+
+def _generated_questions_response(job_id: int, test: JobTest, saved_questions: List[TestQuestion], source: str) -> dict:
     return {
-        "job_id": payload.job_id,
+        "job_id": job_id,
         "test_id": test.test_id,
+        "source": source,
         "questions_saved": [
             {
+                "question_id": q.question_id,
                 "question_text": q.question_text,
                 #"question_type": q.question_type
             }
@@ -59,19 +154,85 @@ def generate_interview_questions(payload: GenerateQuestionRequest, db: Session =
         ]
     }
 
+# 1b. Generate questions from single JD, streamed as each question is complete
+@app.post(f"{api_prefix}/generate-interview-questions/stream")
+async def generate_interview_questions_stream(
+    payload: GenerateQuestionRequest,
+    format: str = Query("ndjson", pattern="^(ndjson|sse)$"),
+    db: Session = Depends(get_read_db)
+):
+    job = get_job(db, payload.job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    media_type = "text/event-stream" if format == "sse" else "application/x-ndjson"
+    return StreamingResponse(
+        _stream_interview_questions(job, payload.replace_existing, format),
+        media_type=media_type
+    )
+
+async def _stream_interview_questions(job: Job, replace: bool, fmt: str):
+    job_id = job.job_id
+    # Session riêng vì generator chạy sau khi handler đã trả về
+    db = SessionLocal()
+    # Câu hỏi được lưu nháp từng câu và chỉ gắn vào test khi stream hoàn tất: lỗi giữa chừng
+    # không để lại test với bộ câu hỏi nửa mới nửa cũ, stream rỗng không tạo/đổi test
+    saved_ids = []
+    published = False
+    try:
+        jd_text, lang, reused, _ = await run_in_threadpool(_prepare_generation, job, replace)
+        yield format_stream_event("test", {"job_id": job_id}, fmt)
 
+        items = _iterate(reused) if reused is not None else stream_questions_from_jd(jd_text, lang=lang)
+        async for item in items:
+            q = save_streamed_question(db, len(saved_ids) + 1, item)
+            saved_ids.append(q.question_id)
+            yield format_stream_event("question", {
+                "question_id": q.question_id,
+                "order_index": len(saved_ids),
+                "question_text": item["question_text"],
+                "question_type": item["question_type"],
+            }, fmt)
 
-# 2. Bulk generate for multiple jobs (example)
+        if not saved_ids:
+            yield format_stream_event("error", {"detail": "Failed to generate questions"}, fmt)
+            return
+        test = publish_streamed_questions(db, job_id, saved_ids, replace=replace)
+        published = True
+        yield format_stream_event("done", {"job_id": job_id, "test_id": test.test_id, "questions_saved": len(saved_ids)}, fmt)
+    except LLMError as e:
+        yield format_stream_event("error", {"detail": f"LLM service unavailable: {e}"}, fmt)
+    finally:
+        try:
+            if not published:
+                discard_streamed_questions(db, saved_ids)
+        finally:
+            db.close()
+
+async def _iterate(items: List[dict]):
+    for item in items:
+        yield item
+
+# 2. Bulk generate for multiple jobs (background batch)
 @app.post(f"{api_prefix}/questions/bulk-generate")
-def bulk_generate_questions(job_ids: List[int], db: Session = Depends(get_db)):
-    results = []
-    for job_id in job_ids:
-        job = get_job(db, job_id)
-        if not job:
-            continue
-        qs = generate_questions_from_jd(job.description or "")
-        results.append({"job_id": job_id, "questions": qs})
-    return {"results": results}
+async def bulk_generate_questions(job_ids: List[int], replace: bool = False):
+    batch = submit_bulk_generation(job_ids, generate_job_questions_once, replace=replace)
+    return batch.summary()
+
+@app.get(f"{api_prefix}/questions/bulk-generate/{{batch_id}}")
+def get_bulk_generation(batch_id: str):
+    batch = get_bulk_batch(batch_id)
+    if not batch:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    return {**batch.summary(), "results": batch.results}
+
+@app.get(f"{api_prefix}/questions/bulk-generate/{{batch_id}}/stream")
+def stream_bulk_generation(batch_id: str, format: str = Query("ndjson", pattern="^(ndjson|sse)$")):
+    batch = get_bulk_batch(batch_id)
+    if not batch:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    media_type = "text/event-stream" if format == "sse" else "application/x-ndjson"
+    return StreamingResponse(batch.stream(format), media_type=media_type)
 
 # 3. Customize questions (HR submit new ones)
 @app.post(f"{api_prefix}/customize-questions")
@@ -88,6 +249,9 @@ def update_question(question_id: int = Path(...), payload: QuestionCreate = Depe
     q = db.query(TestQuestion).filter(TestQuestion.question_id == question_id).first()
     if not q:
         raise HTTPException(status_code=404, detail="Question not found")
+    if q.question_text != payload.question_text:
+        # Nội dung câu hỏi đổi -> kết quả chấm cũ không còn dùng được
+        invalidate_question_evaluations(db, q.question_id)
     q.question_text = payload.question_text
     q.explanation = payload.explanation
     db.commit()
@@ -106,23 +270,144 @@ def get_question_templates():
 
 # 6. Validate answer using LLM
 @app.post(f"{api_prefix}/evaluate-single-answer")
-def evaluate_one(question_id: int, answer_id: int, db: Session = Depends(get_db)):
-    result = evaluate_single_answer(question_id, answer_id, db)
+async def evaluate_one(question_id: int, answer_id: int, db: Session = Depends(get_db)):
+    result = await evaluate_single_answer(question_id, answer_id, db)
     if "error" in result:
         raise HTTPException(status_code=404, detail=result["error"])
     return result
 
 # 7. Evaluate test result
 @app.post(f"{api_prefix}/evaluate-test-result")
-def api_evaluate_result(result_id: int, db: Session = Depends(get_db)):
+async def api_evaluate_result(result_id: int, batched: Optional[bool] = None, incremental: bool = True):
     """
     Đánh giá toàn bộ bài test theo result_id,
     chấm từng câu trả lời và cập nhật kết quả tổng thể.
+    batched=true: chấm gộp nhiều câu trong một prompt (mặc định theo EVALUATION_MODE).
+    incremental=false: chấm lại mọi câu thay vì chỉ câu mới/đã sửa/chấm lỗi.
+    Request đồng thời cho cùng result_id dùng chung một lần chấm.
+    """
+    return await evaluate_test_result_once(result_id, batched=batched, incremental=incremental)
+
+# 7b. Evaluate test result, streamed answer by answer
+@app.get(f"{api_prefix}/evaluate-test-result/{{result_id}}/stream")
+def api_evaluate_result_stream(result_id: int, format: str = Query("sse", pattern="^(ndjson|sse)$"),
+                               incremental: bool = True):
     """
-    return evaluate_test_result(result_id, db)
+    Chấm bài test và đẩy điểm/nhận xét từng câu ngay khi chấm xong (SSE hoặc NDJSON),
+    sự kiện cuối "done" chứa total_score/average_score/passed.
+    """
+    media_type = "text/event-stream" if format == "sse" else "application/x-ndjson"
+    return StreamingResponse(_stream_result_grading(result_id, format, incremental), media_type=media_type)
+
+async def _stream_result_grading(result_id: int, fmt: str, incremental: bool = True):
+    # Session riêng vì generator chạy sau khi handler đã trả về
+    db = SessionLocal()
+    try:
+        async for event, data in stream_test_result_grading(result_id, db, incremental=incremental):
+            yield format_stream_event(event, data, fmt)
+    finally:
+        db.close()
+
+# 8. Cache statistics
+@app.get(f"{api_prefix}/cache/stats")
+def get_cache_stats():
+    hits, misses = evaluation_cache_stats["hits"], evaluation_cache_stats["misses"]
+    return {
+        "question_generation": question_cache.stats(),
+        "evaluation": {
+            "backend": "database",
+            "hits": hits,
+            "misses": misses,
+            "hit_ratio": round(hits / (hits + misses), 4) if hits + misses else 0.0,
+        },
+    }
+
+# 9. Background grading queue
+@app.post(f"{api_prefix}/grading-queue/{{result_id}}", status_code=202)
+def enqueue_result_grading(result_id: int, db: Session = Depends(get_db)):
+    result = db.query(TestResult).filter(TestResult.result_id == result_id).first()
+    if not result:
+        raise HTTPException(status_code=404, detail="Result not found")
+    return job_status(enqueue_grading(db, result_id))
+
+@app.get(f"{api_prefix}/grading-queue/{{result_id}}")
+def get_result_grading_status(result_id: int, db: Session = Depends(get_db)):
+    jobs = get_grading_status(db, [result_id])
+    if not jobs:
+        raise HTTPException(status_code=404, detail="Result not queued")
+    return job_status(jobs[0])
+
+@app.get(f"{api_prefix}/grading-queue")
+def get_results_grading_status(result_ids: List[int] = Query(...), db: Session = Depends(get_db)):
+    return {"jobs": [job_status(job) for job in get_grading_status(db, result_ids)]}
+
+# 10. Question pool (câu hỏi sinh sẵn cho job đang tuyển)
+@app.get(f"{api_prefix}/question-pool/{{job_id}}")
+def get_question_pool(job_id: int, db: Session = Depends(get_read_db)):
+    return pool_status(db, job_id)
+
+@app.post(f"{api_prefix}/question-pool/{{job_id}}")
+async def fill_question_pool(job_id: int, db: Session = Depends(get_db)):
+    """Làm đầy pool của một job ngay (không chờ khung giờ warm-up)."""
+    if not get_job(db, job_id):
+        raise HTTPException(status_code=404, detail="Job not found")
+    db.close()
+    added = await fill_job_pool(job_id)
+    return {**pool_status(db, job_id), "questions_added": added}
+
+# 11. Analytics điểm (bảng thống kê được tính lại khi có bài chấm mới; ghi nên dùng primary)
+@app.get(f"{api_prefix}/analytics/jobs/{{job_id}}")
+def get_job_analytics(job_id: int, db: Session = Depends(get_db)):
+    if not get_job(db, job_id):
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job_analytics(db, job_id)
+
+@app.get(f"{api_prefix}/analytics/job-tests/{{test_id}}")
+def get_test_analytics(test_id: int, db: Session = Depends(get_db)):
+    reports = tests_analytics(db, [test_id])
+    if not reports:
+        raise HTTPException(status_code=404, detail="Test not found")
+    return reports[0]
+
+@app.get(f"{api_prefix}/analytics/questions/{{question_id}}")
+def get_question_analytics(question_id: int, db: Session = Depends(get_db)):
+    report = question_analytics(db, question_id)
+    if report is None:
+        raise HTTPException(status_code=404, detail="Question not found")
+    return report
 
 @app.get(f"{api_prefix}/test-result/{{result_id}}/answers") 
-def get_result_answers(result_id: int, db: Session = Depends(get_db)):
+def get_result_answers(result_id: int, db: Session = Depends(get_read_db)):
     return get_answer_details(result_id, db)
 
+@app.get(f"{api_prefix}/test-results/answers")
+def get_results_answers(result_ids: List[int] = Query(...), db: Session = Depends(get_read_db)):
+    return get_answer_details_bulk(result_ids, db)
+
+@app.get(f"{api_prefix}/job-tests/{{test_id}}/questions")
+def get_test_questions(test_id: int, db: Session = Depends(get_read_db)):
+    return {
+        "test_id": test_id,
+        "questions": [
+            {
+                "question_id": q.question_id,
+                "order_index": q.order_index,
+                "question_text": q.question_text,
+                "question_type": q.question_type,
+                "points": q.points
+            }
+            for q in list_test_questions(db, test_id)
+        ]
+    }
+
+# Prompt templates đang dùng và version của chúng
+@app.get(f"{api_prefix}/prompts")
+def get_prompts():
+    return {"prompts": prompt_registry.catalog()}
 
+# Prometheus metrics (LLM, cache, route, SQL, threadpool)
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    # async: collector đọc threadpool của AnyIO từ event loop
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
@@ -0,0 +1,191 @@
+import time
+from contextvars import ContextVar
+from typing import Optional
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Histogram, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+LLM_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60, 120)
+
+# --------- LLM ---------
+LLM_REQUEST_SECONDS = Histogram(
+    "llm_request_duration_seconds", "Thời gian một HTTP request tới LLM (mỗi lần thử)",
+    ["operation", "model", "outcome"], buckets=LLM_BUCKETS,
+)
+LLM_QUEUE_SECONDS = Histogram(
+    "llm_queue_wait_seconds", "Thời gian chờ slot của LLMScheduler", ["priority"], buckets=LATENCY_BUCKETS,
+)
+LLM_TOKENS = Counter("llm_tokens_total", "Token LLM đã dùng (theo usage provider trả về)", ["operation", "model", "kind"])
+LLM_RETRIES = Counter("llm_retries_total", "Số lần thử lại request LLM", ["operation", "model"])
+LLM_STRUCTURED_OUTPUT = Counter(
+    "llm_structured_output_total", "Kết quả parse JSON từ LLM (ok, repaired, invalid)", ["operation", "outcome"],
+)
+SINGLE_FLIGHT_SHARED = Counter(
+    "single_flight_shared_total", "Lời gọi được gộp vào một lời gọi đang chạy cùng key (không gọi LLM lại)", ["operation"],
+)
+
+JOB_SIMILARITY_LOOKUPS = Counter(
+    "job_similarity_lookups_total", "Tra cứu job gần trùng trước khi gọi LLM sinh câu hỏi (hit = dùng lại câu hỏi)", ["outcome"],
+)
+
+# --------- Grading ---------
+GRADING_PRESCREENED = Counter(
+    "grading_prescreened_total", "Câu trả lời được chấm 0 điểm ở bước pre-screen, không gọi LLM", ["reason"],
+)
+
+# --------- HTTP ---------
+HTTP_REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds", "Thời gian xử lý request theo route",
+    ["method", "route", "status"], buckets=LATENCY_BUCKETS,
+)
+HTTP_REQUEST_DB_QUERIES = Histogram(
+    "http_request_db_queries", "Số câu SQL trong một request", ["method", "route"],
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100, 250),
+)
+HTTP_REQUEST_DB_SECONDS = Histogram(
+    "http_request_db_seconds", "Tổng thời gian SQL trong một request", ["method", "route"], buckets=LATENCY_BUCKETS,
+)
+
+# --------- Database ---------
+DB_QUERY_SECONDS = Histogram(
+    "db_query_duration_seconds", "Thời gian một câu SQL", ["statement"], buckets=LATENCY_BUCKETS,
+)
+DB_SESSION_SECONDS = Histogram(
+    "db_session_duration_seconds", "Thời gian giữ một session của get_db", buckets=LATENCY_BUCKETS,
+)
+
+# Bộ đếm SQL của request hiện tại ({"queries": n, "seconds": s}); None ngoài request
+_request_db_stats: ContextVar[Optional[dict]] = ContextVar("request_db_stats", default=None)
+
+
+def observe_llm_tokens(operation: str, model: str, usage: Optional[dict]) -> int:
+    """Ghi nhận usage của một response LLM, trả về total_tokens."""
+    if not usage:
+        return 0
+    for kind in ("prompt", "completion"):
+        tokens = usage.get(f"{kind}_tokens")
+        if tokens:
+            LLM_TOKENS.labels(operation, model, kind).inc(tokens)
+    return usage.get("total_tokens", 0)
+
+
+def instrument_engine(engine: Engine) -> None:
+    """Đo thời gian từng câu SQL của engine, cộng dồn vào bộ đếm của request hiện tại."""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started_at", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_started_at"].pop()
+        DB_QUERY_SECONDS.labels(statement.lstrip().split(" ", 1)[0].upper()).observe(elapsed)
+        stats = _request_db_stats.get()
+        if stats is not None:
+            stats["queries"] += 1
+            stats["seconds"] += elapsed
+
+
+def start_request() -> dict:
+    # Dict dùng chung: route sync chạy trong threadpool nhận bản sao context nhưng cùng dict
+    stats = {"queries": 0, "seconds": 0.0}
+    _request_db_stats.set(stats)
+    return stats
+
+
+def observe_request(method: str, route: str, status: int, elapsed: float, stats: dict) -> None:
+    HTTP_REQUEST_SECONDS.labels(method, route, str(status)).observe(elapsed)
+    HTTP_REQUEST_DB_QUERIES.labels(method, route).observe(stats["queries"])
+    HTTP_REQUEST_DB_SECONDS.labels(method, route).observe(stats["seconds"])
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware đo thời gian mỗi request theo route template (tính đến khi gửi xong body,
+    kể cả response dạng stream) cùng số câu SQL / thời gian SQL của request đó.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = start_request()
+        started = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # Router ghi route đã khớp vào scope; dùng path template để tránh nhãn theo từng id
+            route = getattr(scope.get("route"), "path", "unmatched")
+            observe_request(scope["method"], route, status, time.perf_counter() - started, stats)
+
+
+class RuntimeCollector:
+    """
+    Số liệu đọc tại thời điểm scrape: hit/miss của các cache, threadpool của AnyIO
+    (nơi chạy route sync và Depends(get_db)) và hàng đợi của LLMScheduler.
+    """
+
+    def describe(self):
+        # Không gọi collect() lúc đăng ký (tránh import vòng app.utils -> app.llm -> app.metrics)
+        return []
+
+    def collect(self):
+        from app.cache import question_cache
+        from app.language import language_detector
+        from app.llm import llm_client
+        from app.utils import evaluation_cache_stats
+
+        caches = {
+            "question_generation": (question_cache.hits, question_cache.misses),
+            "evaluation": (evaluation_cache_stats["hits"], evaluation_cache_stats["misses"]),
+            "language_text": (language_detector._by_text.hits, language_detector._by_text.misses),
+            "language_question": (language_detector._by_question.hits, language_detector._by_question.misses),
+        }
+        hits = CounterMetricFamily("cache_hits", "Số lần cache hit", labels=["cache"])
+        misses = CounterMetricFamily("cache_misses", "Số lần cache miss", labels=["cache"])
+        ratio = GaugeMetricFamily("cache_hit_ratio", "Tỷ lệ hit của cache", labels=["cache"])
+        for name, (hit, miss) in caches.items():
+            hits.add_metric([name], hit)
+            misses.add_metric([name], miss)
+            ratio.add_metric([name], hit / (hit + miss) if hit + miss else 0.0)
+        yield hits
+        yield misses
+        yield ratio
+
+        try:
+            import anyio.to_thread
+            limiter = anyio.to_thread.current_default_thread_limiter()
+        except RuntimeError:
+            # Không chạy trong event loop
+            limiter = None
+        if limiter is not None:
+            yield GaugeMetricFamily("threadpool_busy_threads", "Số thread đang bận", value=limiter.borrowed_tokens)
+            yield GaugeMetricFamily("threadpool_max_threads", "Số thread tối đa", value=limiter.total_tokens)
+            yield GaugeMetricFamily(
+                "threadpool_waiting_tasks", "Số tác vụ chờ thread", value=limiter.statistics().tasks_waiting
+            )
+
+        scheduler = llm_client.scheduler.stats()
+        yield GaugeMetricFamily("llm_in_flight_requests", "Số request LLM đang chạy", value=scheduler["in_flight"])
+        yield GaugeMetricFamily("llm_waiting_requests", "Số request LLM đang chờ slot", value=scheduler["waiting"])
+
+
+REGISTRY.register(RuntimeCollector())
+
+
+def render_metrics() -> tuple:
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
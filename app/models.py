@@ -1,4 +1,4 @@
-from sqlalchemy import ARRAY, Column, BigInteger, Date, Integer, String, Text, ForeignKey, Boolean, DECIMAL, TIMESTAMP, JSON, VARCHAR
+from sqlalchemy import ARRAY, Column, BigInteger, Date, Float, Integer, String, Text, ForeignKey, Boolean, DECIMAL, TIMESTAMP, JSON, VARCHAR, UniqueConstraint, Index, text
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
 from datetime import datetime
@@ -7,9 +7,12 @@ from sqlalchemy.sql import func
 
 Base = declarative_base()
 
+# BIGINT trên Postgres; INTEGER trên SQLite để khóa chính tự tăng (CSDL benchmark/dev)
+BigInt = BigInteger().with_variant(Integer, "sqlite")
+
 class Job(Base):
     __tablename__ = "jobs"
-    job_id = Column(BigInteger, primary_key=True)
+    job_id = Column(BigInt, primary_key=True)
     recruiter_id = Column(BigInteger, ForeignKey("users.user_id"))
     company_id = Column(BigInteger, ForeignKey("companies.company_id", ondelete="CASCADE"))
     title = Column(String(200))
@@ -26,13 +29,18 @@ class Job(Base):
     max_experience_years = Column(Integer)
     category = Column(String(100))
     education_requirements = Column(Text)
-    language_requirements = Column(ARRAY(String))
+    language_requirements = Column(ARRAY(String).with_variant(JSON, "sqlite"))
     application_deadline = Column(Date)
     
 
 class JobTest(Base):
     __tablename__ = "job_tests"
-    test_id = Column(BigInteger, primary_key=True)
+    __table_args__ = (
+        # Mỗi job có tối đa một test active: request sinh câu hỏi đồng thời không tạo test trùng
+        Index("uq_job_tests_active_job", "job_id", unique=True,
+              postgresql_where=text("is_active"), sqlite_where=text("is_active")),
+    )
+    test_id = Column(BigInt, primary_key=True)
     job_id = Column(BigInteger, ForeignKey("jobs.job_id", ondelete="CASCADE"))
     test_name = Column(String(200))
     test_type = Column(String(30))
@@ -40,14 +48,15 @@ class JobTest(Base):
     duration_minutes = Column(Integer)
     passing_score = Column(DECIMAL(5,2))
     description = Column(Text)
-    is_active = Column(Boolean, default=True)
+    # NOT NULL: unique index uq_job_tests_active_job chỉ tính các dòng is_active = TRUE
+    is_active = Column(Boolean, nullable=False, default=True, server_default=text("true"))
     created_at = Column(TIMESTAMP, default=datetime.utcnow)
     updated_at = Column(TIMESTAMP, default=datetime.utcnow)
 
 class TestQuestion(Base):
     __tablename__ = "test_questions"
-    question_id = Column(BigInteger, primary_key=True)
-    test_id = Column(BigInteger, ForeignKey("job_tests.test_id", ondelete="CASCADE"))
+    question_id = Column(BigInt, primary_key=True)
+    test_id = Column(BigInteger, ForeignKey("job_tests.test_id", ondelete="CASCADE"), index=True)
     question_text = Column(Text)
     question_type = Column(String(30))
     points = Column(DECIMAL(5,2))
@@ -56,23 +65,39 @@ class TestQuestion(Base):
     explanation = Column(Text)
     required = Column(Boolean, default=True)
     created_at = Column(TIMESTAMP, default=datetime.utcnow)
+    # Version của prompt đã sinh câu hỏi (app/prompts), NULL với câu hỏi tạo tay
+    prompt_version = Column(String(40))
+
+    answers = relationship("QuestionAnswer", back_populates="question")
 
 class QuestionAnswer(Base):
     __tablename__ = "question_answers"
-    answer_id = Column(BigInteger, primary_key=True)
-    result_id = Column(BigInteger, ForeignKey("test_results.result_id", ondelete="CASCADE"))
-    question_id = Column(BigInteger, ForeignKey("test_questions.question_id"))
+    answer_id = Column(BigInt, primary_key=True)
+    result_id = Column(BigInteger, ForeignKey("test_results.result_id", ondelete="CASCADE"), index=True)
+    question_id = Column(BigInteger, ForeignKey("test_questions.question_id"), index=True)
     answer_text = Column(Text)
     is_correct = Column(Boolean)
     points_earned = Column(DECIMAL(5,2))
     time_taken_seconds = Column(Integer)
     submitted_at = Column(TIMESTAMP, default=datetime.utcnow)
+    # Kết quả chấm AI của từng câu (thang 100), lưu ngay khi chấm xong
+    ai_score = Column(DECIMAL(5,2))
+    comment = Column(Text)
+    suggestion = Column(Text)
+    # Hash (câu trả lời + phiên bản câu hỏi + model) của lần chấm gần nhất, để chỉ chấm lại câu đã thay đổi
+    grading_hash = Column(String(64))
+    grading_status = Column(String(20))  # graded | failed
+    # Version của prompt chấm đã cho ra điểm hiện tại
+    prompt_version = Column(String(40))
+
+    question = relationship("TestQuestion", back_populates="answers")
+    result = relationship("TestResult", back_populates="answers")
 
 class TestResult(Base):
     __tablename__ = "test_results"
-    result_id = Column(BigInteger, primary_key=True)
+    result_id = Column(BigInt, primary_key=True)
     application_id = Column(BigInteger, ForeignKey("applications.application_id", ondelete="CASCADE"))
-    test_id = Column(BigInteger, ForeignKey("job_tests.test_id"))
+    test_id = Column(BigInteger, ForeignKey("job_tests.test_id"), index=True)
     start_time = Column(TIMESTAMP)
     submit_time = Column(TIMESTAMP)
     total_score = Column(DECIMAL(5,2))
@@ -85,10 +110,12 @@ class TestResult(Base):
     feedback = Column(Text)
     created_at = Column(TIMESTAMP, default=datetime.utcnow)
 
+    answers = relationship("QuestionAnswer", back_populates="result", order_by="QuestionAnswer.answer_id")
+
 class Application(Base):
     __tablename__ = "applications"
 
-    application_id = Column(BigInteger, primary_key=True)
+    application_id = Column(BigInt, primary_key=True)
     job_id = Column(BigInteger, ForeignKey("jobs.job_id", ondelete="CASCADE"))
     candidate_id = Column(BigInteger, ForeignKey("users.user_id", ondelete="CASCADE"))
     cv_id = Column(BigInteger, ForeignKey("candidate_cvs.cv_id"))
@@ -109,7 +136,7 @@ class Application(Base):
 class User(Base):
     __tablename__ = "users"
 
-    user_id = Column(BigInteger, primary_key=True)
+    user_id = Column(BigInt, primary_key=True)
     email = Column(String(255), unique=True, nullable=False)
     password_hash = Column(String(255))
     phone = Column(String(20))
@@ -118,4 +145,108 @@ class User(Base):
     auth_provider = Column(String(20), default="LOCAL")
     is_active = Column(Boolean, default=True)
     created_at = Column(TIMESTAMP, default=func.now())
-    updated_at = Column(TIMESTAMP, default=func.now())
\ No newline at end of file
+    updated_at = Column(TIMESTAMP, default=func.now())
+
+class EvaluationCache(Base):
+    # Kết quả chấm (score/comment/suggestion) đã lưu cho cặp (câu hỏi, câu trả lời)
+    __tablename__ = "evaluation_cache"
+    __table_args__ = (
+        UniqueConstraint("question_id", "answer_hash", "model", "prompt_version", name="uq_evaluation_cache_key"),
+        # Tra cứu cache theo đúng cặp (câu hỏi, câu trả lời) của bài làm
+        Index("ix_evaluation_cache_lookup", "question_id", "answer_hash", "model"),
+    )
+
+    cache_id = Column(BigInt, primary_key=True)
+    question_id = Column(BigInteger, ForeignKey("test_questions.question_id", ondelete="CASCADE"), nullable=False, index=True)
+    answer_hash = Column(String(64), nullable=False)
+    model = Column(String(100), nullable=False)
+    prompt_version = Column(String(40), nullable=False)
+    result = Column(JSON, nullable=False)
+    created_at = Column(TIMESTAMP, default=datetime.utcnow)
+
+class GradingJob(Base):
+    # Hàng đợi chấm bài: mỗi result_id có tối đa một job
+    __tablename__ = "grading_jobs"
+
+    job_id = Column(BigInt, primary_key=True)
+    result_id = Column(BigInteger, ForeignKey("test_results.result_id", ondelete="CASCADE"), nullable=False, unique=True)
+    status = Column(String(20), nullable=False, default="queued", index=True)  # queued | running | graded | failed
+    attempts = Column(Integer, nullable=False, default=0)
+    last_error = Column(Text)
+    run_after = Column(TIMESTAMP, default=datetime.utcnow)
+    locked_at = Column(TIMESTAMP)
+    created_at = Column(TIMESTAMP, default=datetime.utcnow)
+    updated_at = Column(TIMESTAMP, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class PoolQuestion(Base):
+    # Câu hỏi sinh sẵn cho job đang tuyển (warm-up), bộ câu hỏi của test được lấy mẫu từ đây
+    __tablename__ = "question_pool"
+
+    pool_id = Column(BigInt, primary_key=True)
+    job_id = Column(BigInteger, ForeignKey("jobs.job_id", ondelete="CASCADE"), nullable=False, index=True)
+    question_text = Column(Text, nullable=False)
+    question_type = Column(String(30))
+    prompt_version = Column(String(40))
+    # Hash JD lúc sinh: JD đổi thì câu hỏi trong pool không còn dùng được
+    jd_hash = Column(String(64), nullable=False)
+    times_used = Column(Integer, nullable=False, default=0)
+    created_at = Column(TIMESTAMP, default=datetime.utcnow)
+
+class JobSignature(Base):
+    # MinHash của mô tả + yêu cầu của job (app/similarity), để tìm job gần trùng mà không tính lại
+    __tablename__ = "job_signatures"
+
+    job_id = Column(BigInt, ForeignKey("jobs.job_id", ondelete="CASCADE"), primary_key=True)
+    # Hash nội dung lúc tính: nội dung job đổi thì tính lại
+    content_hash = Column(String(64), nullable=False)
+    signature = Column(JSON, nullable=False)
+    updated_at = Column(TIMESTAMP, default=datetime.utcnow, index=True)
+
+class JobDigest(Base):
+    # Tóm tắt JD (app/jd_digest) đưa vào prompt sinh câu hỏi: tính một lần, tính lại khi job đổi
+    __tablename__ = "job_digests"
+
+    job_id = Column(BigInt, ForeignKey("jobs.job_id", ondelete="CASCADE"), primary_key=True)
+    # Hash các trường của job + version thuật toán + ngân sách token lúc tính
+    content_hash = Column(String(64), nullable=False)
+    lang = Column(String(8), nullable=False)
+    seniority = Column(String(20))  # entry | mid | senior, NULL nếu job không ghi rõ
+    summary = Column(Text, nullable=False)
+    token_estimate = Column(Integer, nullable=False)
+    updated_at = Column(TIMESTAMP, default=datetime.utcnow)
+
+class TestScoreSummary(Base):
+    # Thống kê điểm các bài làm đã chấm của một test (app/analytics), tính lại khi có bài được chấm sau lần tính trước
+    __tablename__ = "test_score_summaries"
+
+    test_id = Column(BigInt, ForeignKey("job_tests.test_id", ondelete="CASCADE"), primary_key=True)
+    results_count = Column(Integer, nullable=False, default=0)
+    graded_count = Column(Integer, nullable=False, default=0)
+    passed_count = Column(Integer, nullable=False, default=0)
+    # Tổng lũy thừa 1..3 của percentage: mean, độ lệch chuẩn, độ lệch phân phối
+    score_sum = Column(Float, nullable=False, default=0)
+    score_sq_sum = Column(Float, nullable=False, default=0)
+    score_cube_sum = Column(Float, nullable=False, default=0)
+    time_sum = Column(Float, nullable=False, default=0)
+    time_count = Column(Integer, nullable=False, default=0)
+    # Số bài theo điểm nguyên 0..100, dùng cho percentile
+    histogram = Column(JSON, nullable=False)
+    changed_at = Column(TIMESTAMP)
+    refreshed_at = Column(TIMESTAMP)
+
+class QuestionScoreSummary(Base):
+    # Thống kê điểm (ai_score) các câu trả lời đã chấm của một câu hỏi, cùng cơ chế với TestScoreSummary
+    __tablename__ = "question_score_summaries"
+
+    question_id = Column(BigInt, ForeignKey("test_questions.question_id", ondelete="CASCADE"), primary_key=True)
+    test_id = Column(BigInteger, ForeignKey("job_tests.test_id", ondelete="CASCADE"), index=True)
+    answers_count = Column(Integer, nullable=False, default=0)
+    correct_count = Column(Integer, nullable=False, default=0)
+    score_sum = Column(Float, nullable=False, default=0)
+    score_sq_sum = Column(Float, nullable=False, default=0)
+    score_cube_sum = Column(Float, nullable=False, default=0)
+    time_sum = Column(Float, nullable=False, default=0)
+    time_count = Column(Integer, nullable=False, default=0)
+    histogram = Column(JSON, nullable=False)
+    changed_at = Column(TIMESTAMP)
+    refreshed_at = Column(TIMESTAMP)
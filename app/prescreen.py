@@ -0,0 +1,93 @@
+import os
+import re
+import math
+from collections import Counter
+from typing import List, Optional, Tuple
+from .cache import normalize_text
+
+# Chấm sơ bộ tại chỗ (không gọi LLM) các câu trả lời hiển nhiên 0 điểm: quá ngắn, chép lại câu hỏi, vô nghĩa
+PRESCREEN_ENABLED = os.getenv("PRESCREEN_ENABLED", "true").lower() in ("1", "true", "yes")
+# Ít hơn số từ / ký tự (không tính khoảng trắng) này là quá ngắn để đánh giá
+PRESCREEN_MIN_WORDS = int(os.getenv("PRESCREEN_MIN_WORDS", "2"))
+PRESCREEN_MIN_CHARS = int(os.getenv("PRESCREEN_MIN_CHARS", "5"))
+# Tỷ lệ từ của câu trả lời có trong câu hỏi, từ mức này (và không dài hơn câu hỏi đáng kể) là chép lại câu hỏi
+PRESCREEN_MAX_QUESTION_OVERLAP = float(os.getenv("PRESCREEN_MAX_QUESTION_OVERLAP", "0.9"))
+# Entropy ký tự (bit/ký tự) dưới mức này là chuỗi lặp/vô nghĩa ("aaaa", "test test test"); văn bản thường ~4
+PRESCREEN_MIN_ENTROPY = float(os.getenv("PRESCREEN_MIN_ENTROPY", "2.5"))
+# Chỉ xét entropy với câu trả lời đủ dài (chuỗi ngắn tự nhiên có entropy thấp)
+PRESCREEN_ENTROPY_MIN_CHARS = int(os.getenv("PRESCREEN_ENTROPY_MIN_CHARS", "12"))
+
+# Ghi vào prompt_version của câu trả lời kèm lý do, ví dụ "prescreen-v1:too_short"
+PRESCREEN_VERSION = "prescreen-v1"
+
+_WORD = re.compile(r"\w+")
+
+MESSAGES = {
+    "vi": {
+        "too_short": "Câu trả lời quá ngắn để đánh giá.",
+        "duplicate_of_question": "Câu trả lời chỉ chép lại câu hỏi.",
+        "question_overlap": "Câu trả lời chủ yếu lặp lại nội dung câu hỏi, không đưa ra ý trả lời.",
+        "low_entropy": "Câu trả lời không có nội dung có nghĩa.",
+        "suggestion": "Hãy trả lời trực tiếp câu hỏi, nêu cách làm và ví dụ cụ thể từ kinh nghiệm.",
+    },
+    "en": {
+        "too_short": "The answer is too short to evaluate.",
+        "duplicate_of_question": "The answer only repeats the question.",
+        "question_overlap": "The answer mostly restates the question without answering it.",
+        "low_entropy": "The answer has no meaningful content.",
+        "suggestion": "Answer the question directly, explaining your approach with concrete examples from experience.",
+    },
+}
+
+
+def char_entropy(text: str) -> float:
+    """Entropy Shannon (bit/ký tự) của các ký tự không phải khoảng trắng."""
+    chars = [c for c in text if not c.isspace()]
+    if not chars:
+        return 0.0
+    total = len(chars)
+    return max(0.0, -sum(n / total * math.log2(n / total) for n in Counter(chars).values()))
+
+
+def prescreen_reason(question: str, answer: str) -> Tuple[Optional[str], dict]:
+    """Lý do câu trả lời được cho 0 điểm không cần LLM (None = gửi LLM chấm) và các đặc trưng đã tính."""
+    answer_norm, question_norm = normalize_text(answer), normalize_text(question)
+    answer_words, question_words = _WORD.findall(answer_norm), _WORD.findall(question_norm)
+    chars = sum(1 for c in answer_norm if not c.isspace())
+    question_vocab = set(question_words)
+    overlap = (sum(1 for w in answer_words if w in question_vocab) / len(answer_words)) if answer_words else 0.0
+    entropy = char_entropy(answer_norm)
+    features = {"words": len(answer_words), "chars": chars, "question_overlap": round(overlap, 3),
+                "entropy": round(entropy, 3)}
+
+    if len(answer_words) < PRESCREEN_MIN_WORDS or chars < PRESCREEN_MIN_CHARS:
+        return "too_short", features
+    if answer_words == question_words:
+        return "duplicate_of_question", features
+    if overlap >= PRESCREEN_MAX_QUESTION_OVERLAP and len(answer_words) <= len(question_words) * 1.2:
+        return "question_overlap", features
+    if chars >= PRESCREEN_ENTROPY_MIN_CHARS and entropy < PRESCREEN_MIN_ENTROPY:
+        return "low_entropy", features
+    return None, features
+
+
+def prescreen_answers(items: List[tuple], langs: List[str]) -> List[Optional[dict]]:
+    """
+    Một lượt qua mọi cặp (câu hỏi, câu trả lời) của bài làm: trả về kết quả chấm 0 điểm
+    (cùng dạng với generate_evaluation, kèm "prescreen" = lý do và đặc trưng) hoặc None nếu cần LLM chấm.
+    """
+    results = []
+    for (question, answer), lang in zip(items, langs):
+        reason, features = prescreen_reason(question, answer)
+        if reason is None:
+            results.append(None)
+            continue
+        messages = MESSAGES.get(lang, MESSAGES["en"])
+        results.append({
+            "score": 0,
+            "comment": messages[reason],
+            "suggestion": messages["suggestion"],
+            "prompt_version": f"{PRESCREEN_VERSION}:{reason}",
+            "prescreen": {"reason": reason, **features},
+        })
+    return results
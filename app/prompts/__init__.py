@@ -0,0 +1,81 @@
+import os
+import hashlib
+from string import Formatter
+from typing import Dict, List, Tuple
+
+# Thư mục chứa template dạng "<operation>.<lang>.txt" (cú pháp str.format, "{{" / "}}" cho dấu ngoặc)
+PROMPTS_DIR = os.getenv("PROMPTS_DIR") or os.path.join(os.path.dirname(__file__), "templates")
+DEFAULT_PROMPT_LANG = "en"
+
+
+class PromptTemplate:
+    """Template đã được tách sẵn thành các đoạn (literal, field) để render chỉ còn là nối chuỗi."""
+
+    def __init__(self, operation: str, lang: str, text: str, parts: Tuple[str, ...] = ()):
+        self.operation = operation
+        self.lang = lang
+        self.text = text
+        # Hash ổn định của nội dung (kể cả template con, ví dụ evaluate_batch_item): đổi template -> đổi version
+        digest = hashlib.sha256("\x1f".join((text,) + parts).encode("utf-8")).hexdigest()[:12]
+        self.version = f"{operation}-{lang}-{digest}"
+        self._parts: List[Tuple[str, str]] = []
+        for literal, field, spec, conversion in Formatter().parse(text):
+            if spec or conversion:
+                raise ValueError(f"Prompt {operation}.{lang}: không hỗ trợ format spec cho {{{field}}}")
+            self._parts.append((literal, field))
+        self.fields = {field for _, field in self._parts if field}
+
+    def render(self, **values) -> str:
+        return "".join(literal + (str(values[field]) if field else "") for literal, field in self._parts)
+
+
+class PromptRegistry:
+    """Nạp toàn bộ template một lần (lúc khởi động), chọn theo (operation, lang), fallback về tiếng Anh."""
+
+    def __init__(self, directory: str = PROMPTS_DIR):
+        self.directory = directory
+        self._templates: Dict[Tuple[str, str], PromptTemplate] = {}
+
+    def load(self) -> None:
+        texts = {}
+        for filename in sorted(os.listdir(self.directory)):
+            name, ext = os.path.splitext(filename)
+            if ext != ".txt" or name.count(".") != 1:
+                continue
+            with open(os.path.join(self.directory, filename), encoding="utf-8") as f:
+                texts[tuple(name.split("."))] = f.read()
+
+        templates = {}
+        for (operation, lang), text in texts.items():
+            # "<operation>_<phần>" là template con của "<operation>" cùng ngôn ngữ
+            parts = tuple(texts[key] for key in sorted(texts) if key[1] == lang and key[0].startswith(operation + "_"))
+            templates[(operation, lang)] = PromptTemplate(operation, lang, text, parts)
+        self._templates = templates
+
+    def get(self, operation: str, lang: str = DEFAULT_PROMPT_LANG) -> PromptTemplate:
+        if not self._templates:
+            self.load()
+        template = self._templates.get((operation, lang)) or self._templates.get((operation, DEFAULT_PROMPT_LANG))
+        if template is None:
+            raise KeyError(f"Không có prompt cho operation '{operation}'")
+        return template
+
+    def render(self, operation: str, lang: str = DEFAULT_PROMPT_LANG, **values) -> str:
+        return self.get(operation, lang).render(**values)
+
+    def versions(self, *operations: str) -> List[str]:
+        """Version hiện tại của mọi ngôn ngữ cho các operation (dùng để lọc cache)."""
+        if not self._templates:
+            self.load()
+        return [t.version for (operation, _), t in self._templates.items() if operation in operations]
+
+    def catalog(self) -> List[dict]:
+        if not self._templates:
+            self.load()
+        return [
+            {"operation": t.operation, "lang": t.lang, "version": t.version, "fields": sorted(t.fields)}
+            for t in self._templates.values()
+        ]
+
+
+prompt_registry = PromptRegistry()
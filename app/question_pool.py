@@ -0,0 +1,241 @@
+import os
+import random
+import asyncio
+import logging
+from datetime import date, datetime
+from typing import List, Optional
+from sqlalchemy import exists, func, insert, or_
+from sqlalchemy.orm import Session
+from app.db import SessionLocal
+from app.cache import normalize_text, content_key
+from app.llm import PRIORITY_BULK
+from app.models import Job, JobTest, PoolQuestion
+from app.prompts import prompt_registry
+from app.utils import get_job, generate_questions_from_jd
+from app.jd_digest import get_job_digest
+
+logger = logging.getLogger(__name__)
+
+# Số câu hỏi giữ sẵn cho mỗi job (mỗi lần gọi LLM sinh ~5 câu)
+QUESTION_POOL_SIZE = int(os.getenv("QUESTION_POOL_SIZE", "15"))
+# Số job được làm đầy song song (0 = tắt warm-up tự động trong process này)
+QUESTION_POOL_WARMUP_CONCURRENCY = int(os.getenv("QUESTION_POOL_WARMUP_CONCURRENCY", "2"))
+# Khung giờ thấp điểm theo giờ server, "bắt đầu-kết thúc" (có thể qua nửa đêm, ví dụ "22-6"); để trống = luôn chạy
+QUESTION_POOL_OFFPEAK_HOURS = os.getenv("QUESTION_POOL_OFFPEAK_HOURS", "0-6")
+QUESTION_POOL_SCAN_INTERVAL_SECONDS = float(os.getenv("QUESTION_POOL_SCAN_INTERVAL_SECONDS", "600"))
+# Số job tối đa được làm đầy trong một lượt quét
+QUESTION_POOL_SCAN_LIMIT = int(os.getenv("QUESTION_POOL_SCAN_LIMIT", "50"))
+
+# Cơ cấu một bộ câu hỏi lấy từ pool: 3 chuyên môn, 1 giải quyết vấn đề, 1 phù hợp
+TEST_QUESTION_MIX = (("core", 3), ("problem_solving", 1), ("fit", 1))
+
+
+def jd_hash(jd_text: str) -> str:
+    return content_key(normalize_text(jd_text))
+
+def in_offpeak_window(now: Optional[datetime] = None, window: str = QUESTION_POOL_OFFPEAK_HOURS) -> bool:
+    if not window.strip():
+        return True
+    start, end = (int(part) for part in window.split("-"))
+    hour = (now or datetime.now()).hour
+    return start <= hour < end if start <= end else hour >= start or hour < end
+
+
+# --------- Lấy mẫu ---------
+def sample_from_pool(db: Session, job_id: int, jd_text: str, rng: random.Random = random) -> Optional[List[dict]]:
+    """
+    Lấy một bộ câu hỏi theo TEST_QUESTION_MIX từ pool của job (không gọi LLM): ưu tiên câu ít được
+    dùng nhất, cùng mức thì chọn ngẫu nhiên. Trả về None nếu pool chưa đủ câu cho mọi loại.
+    jd_text là digest của job (cùng nội dung đã dùng để sinh pool).
+    Câu hỏi của JD/prompt cũ bị xóa khỏi pool để lượt warm-up sau sinh lại. Commit trước khi trả về.
+    """
+    digest = jd_hash(jd_text)
+    versions = set(prompt_registry.versions("generate_questions"))
+    rows = db.query(PoolQuestion).filter(PoolQuestion.job_id == job_id).all()
+
+    stale = [row.pool_id for row in rows if row.jd_hash != digest or row.prompt_version not in versions]
+    if stale:
+        db.query(PoolQuestion).filter(PoolQuestion.pool_id.in_(stale)).delete(synchronize_session=False)
+    stale = set(stale)
+
+    by_type = {}
+    for row in rows:
+        if row.pool_id not in stale:
+            by_type.setdefault(row.question_type, []).append(row)
+
+    picked = []
+    for question_type, count in TEST_QUESTION_MIX:
+        candidates = sorted(by_type.get(question_type, []), key=lambda row: (row.times_used, rng.random()))
+        if len(candidates) < count:
+            db.commit()
+            return None
+        picked.extend(candidates[:count])
+
+    questions = []
+    for row in picked:
+        row.times_used += 1
+        questions.append({
+            "question_text": row.question_text,
+            "question_type": row.question_type,
+            "prompt_version": row.prompt_version
+        })
+    db.commit()
+    return questions
+
+def pool_status(db: Session, job_id: int) -> dict:
+    counts = (
+        db.query(PoolQuestion.question_type, func.count(PoolQuestion.pool_id))
+        .filter(PoolQuestion.job_id == job_id)
+        .group_by(PoolQuestion.question_type)
+        .all()
+    )
+    by_type = {question_type: count for question_type, count in counts}
+    return {"job_id": job_id, "size": sum(by_type.values()), "target_size": QUESTION_POOL_SIZE, "by_type": by_type}
+
+
+# --------- Làm đầy ---------
+async def fill_job_pool(job_id: int, size: int = QUESTION_POOL_SIZE) -> int:
+    """
+    Sinh thêm câu hỏi cho pool của job đến khi đủ `size` câu (bỏ câu trùng), trả về số câu đã thêm.
+    Không giữ connection DB trong lúc chờ LLM.
+    """
+    db = SessionLocal()
+    try:
+        job = get_job(db, job_id)
+        digest = get_job_digest(db, job) if job else None
+        jd_text = digest.summary if digest else ""
+        if not jd_text:
+            return 0
+        lang = digest.lang
+        digest = jd_hash(jd_text)
+        versions = prompt_registry.versions("generate_questions")
+
+        # Câu hỏi của JD/prompt cũ
+        db.query(PoolQuestion).filter(
+            PoolQuestion.job_id == job_id,
+            or_(PoolQuestion.jd_hash != digest, PoolQuestion.prompt_version.notin_(versions)),
+        ).delete(synchronize_session=False)
+        seen = {
+            normalize_text(text)
+            for text, in db.query(PoolQuestion.question_text).filter(PoolQuestion.job_id == job_id)
+        }
+        db.commit()
+    finally:
+        db.close()
+
+    added = []
+    # Mỗi lần gọi ~5 câu, cho thêm một lần bù câu trùng
+    for _ in range(-(-(size - len(seen)) // 5) + 1):
+        if len(seen) >= size:
+            break
+        questions = await generate_questions_from_jd(jd_text, priority=PRIORITY_BULK, use_cache=False, lang=lang)
+        if not questions:
+            break
+        for item in questions:
+            key = normalize_text(item["question_text"])
+            if key not in seen:
+                seen.add(key)
+                added.append(item)
+
+    if not added:
+        return 0
+    db = SessionLocal()
+    try:
+        db.execute(insert(PoolQuestion), [
+            {
+                "job_id": job_id,
+                "question_text": item["question_text"],
+                "question_type": item["question_type"],
+                "prompt_version": item["prompt_version"],
+                "jd_hash": digest,
+                "times_used": 0,
+                "created_at": datetime.utcnow(),
+            }
+            for item in added
+        ])
+        db.commit()
+    finally:
+        db.close()
+    return len(added)
+
+def jobs_needing_pool(db: Session, limit: int = QUESTION_POOL_SCAN_LIMIT, size: int = QUESTION_POOL_SIZE) -> List[int]:
+    """Job đang tuyển (application_deadline chưa qua), chưa có test active và pool chưa đủ câu."""
+    pooled = (
+        db.query(func.count(PoolQuestion.pool_id))
+        .filter(PoolQuestion.job_id == Job.job_id)
+        .correlate(Job)
+        .scalar_subquery()
+    )
+    has_active_test = exists().where(JobTest.job_id == Job.job_id, JobTest.is_active.is_(True))
+    rows = (
+        db.query(Job.job_id)
+        .filter(Job.application_deadline >= date.today(), ~has_active_test, pooled < size)
+        .order_by(Job.application_deadline, Job.job_id)
+        .limit(limit)
+        .all()
+    )
+    return [job_id for job_id, in rows]
+
+async def warm_up(limit: int = QUESTION_POOL_SCAN_LIMIT, concurrency: int = QUESTION_POOL_WARMUP_CONCURRENCY) -> dict:
+    """Một lượt quét: làm đầy pool cho các job cần, tối đa `concurrency` job cùng lúc."""
+    db = SessionLocal()
+    try:
+        job_ids = jobs_needing_pool(db, limit)
+    finally:
+        db.close()
+
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def fill(job_id: int) -> int:
+        async with semaphore:
+            try:
+                return await fill_job_pool(job_id)
+            except Exception:
+                logger.exception("Question pool fill failed", extra={"job_id": job_id})
+                return 0
+
+    added = await asyncio.gather(*(fill(job_id) for job_id in job_ids))
+    return {"jobs": len(job_ids), "questions_added": sum(added)}
+
+
+# --------- Scheduler ---------
+async def run_scheduler(stop: asyncio.Event) -> None:
+    while not stop.is_set():
+        if in_offpeak_window():
+            try:
+                summary = await warm_up()
+                if summary["jobs"]:
+                    logger.info("Question pool warm-up", extra=summary)
+            except Exception:
+                logger.exception("Question pool warm-up error")
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=QUESTION_POOL_SCAN_INTERVAL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+
+
+class QuestionPoolScheduler:
+    """Định kỳ làm đầy question pool trong khung giờ thấp điểm (khởi động/dừng cùng app)."""
+
+    def __init__(self, concurrency: int = QUESTION_POOL_WARMUP_CONCURRENCY):
+        self.concurrency = concurrency
+        self._stop: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self.concurrency <= 0:
+            return
+        self._stop = asyncio.Event()
+        self._task = asyncio.create_task(run_scheduler(self._stop))
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._stop.set()
+        # Lượt warm-up đang chờ LLM thì hủy luôn: pool của từng job đã được commit riêng
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+
+question_pool_scheduler = QuestionPoolScheduler()
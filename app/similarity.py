@@ -0,0 +1,304 @@
+import os
+import re
+import random
+import asyncio
+import hashlib
+import threading
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Set, Tuple
+from sqlalchemy import exists
+from sqlalchemy.orm import Session
+from sqlalchemy.exc import IntegrityError
+from app.db import SessionLocal
+from app.cache import normalize_text, content_key
+from app.metrics import JOB_SIMILARITY_LOOKUPS
+from app.models import Job, JobSignature, JobTest, TestQuestion
+from app.utils import list_test_questions
+
+logger = logging.getLogger(__name__)
+
+# Độ tương đồng Jaccard (shingle 3 từ của mô tả + yêu cầu) tối thiểu để dùng lại bộ câu hỏi của job khác; 0 = tắt
+JOB_SIMILARITY_THRESHOLD = float(os.getenv("JOB_SIMILARITY_THRESHOLD", "0.8"))
+# Số band LSH (ước của MINHASH_NUM_PERM): nhiều band hơn = bắt được cặp ít giống hơn nhưng nhiều ứng viên hơn
+JOB_SIMILARITY_BANDS = int(os.getenv("JOB_SIMILARITY_BANDS", "16"))
+# Số ứng viên (theo độ tương đồng ước lượng) được kiểm tra lại bằng Jaccard chính xác
+JOB_SIMILARITY_CANDIDATES = int(os.getenv("JOB_SIMILARITY_CANDIDATES", "5"))
+# Số job đã có test nhưng chưa có signature được tính bổ sung mỗi transaction của tác vụ nền
+JOB_SIMILARITY_BACKFILL_BATCH = int(os.getenv("JOB_SIMILARITY_BACKFILL_BATCH", "200"))
+# Chu kỳ tác vụ nền tính bổ sung signature (chạy ngay khi khởi động); 0 = tắt ở process này
+JOB_SIMILARITY_BACKFILL_INTERVAL_SECONDS = float(os.getenv("JOB_SIMILARITY_BACKFILL_INTERVAL_SECONDS", "300"))
+
+# Đổi số hàm băm hoặc seed thì signature cũ không còn so sánh được: phải xóa bảng job_signatures
+MINHASH_NUM_PERM = 64
+MINHASH_SEED = 1
+SHINGLE_SIZE = 3
+# Sai số ước lượng của MinHash ~ 1/sqrt(MINHASH_NUM_PERM): ứng viên thấp hơn ngưỡng quá mức này bị bỏ sớm
+ESTIMATE_MARGIN = 0.15
+# Đọc lại các signature cập nhật gần lần đồng bộ trước (transaction của process khác commit muộn)
+SYNC_OVERLAP = timedelta(seconds=60)
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+_WORD = re.compile(r"\w+")
+
+_rng = random.Random(MINHASH_SEED)
+_PERMUTATIONS = [
+    (_rng.randrange(1, _MERSENNE_PRIME), _rng.randrange(0, _MERSENNE_PRIME)) for _ in range(MINHASH_NUM_PERM)
+]
+
+
+# --------- MinHash ---------
+def job_text(job: Job) -> str:
+    return "\n".join(part for part in (job.description, job.requirements) if part)
+
+def shingles(text: str) -> Set[str]:
+    words = _WORD.findall(normalize_text(text))
+    if len(words) <= SHINGLE_SIZE:
+        return {" ".join(words)} if words else set()
+    return {" ".join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+def minhash(shingle_set: Set[str]) -> List[int]:
+    """Signature MinHash: với mỗi hoán vị (a*x + b) mod p, giá trị nhỏ nhất trên các shingle."""
+    hashes = [int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "little") for s in shingle_set]
+    if not hashes:
+        return [_MAX_HASH] * MINHASH_NUM_PERM
+    return [min(((a * h + b) % _MERSENNE_PRIME) & _MAX_HASH for h in hashes) for a, b in _PERMUTATIONS]
+
+def jaccard(a: Set[str], b: Set[str]) -> float:
+    return len(a & b) / len(a | b) if a or b else 0.0
+
+def estimated_similarity(a: List[int], b: List[int]) -> float:
+    return sum(1 for x, y in zip(a, b) if x == y) / len(a)
+
+
+# --------- Index ---------
+class SimilarityIndex:
+    """
+    Index LSH (chia signature thành band, job trùng ít nhất một band là ứng viên) trong process.
+    Nguồn dữ liệu là bảng job_signatures: refresh() chỉ nạp các signature mới/đổi kể từ lần trước,
+    nên index được dựng dần và thấy cả signature do process khác ghi. Được dùng từ các thread của
+    threadpool (find_similar_test chạy ngoài event loop) nên mọi thao tác giữ một lock.
+    """
+
+    def __init__(self, bands: int = JOB_SIMILARITY_BANDS):
+        if MINHASH_NUM_PERM % bands:
+            raise ValueError(f"JOB_SIMILARITY_BANDS phải là ước của {MINHASH_NUM_PERM}")
+        self.bands = bands
+        self.rows = MINHASH_NUM_PERM // bands
+        self._signatures: Dict[int, List[int]] = {}
+        self._buckets: Dict[Tuple[int, tuple], Set[int]] = {}
+        self._synced_at: Optional[datetime] = None
+        self._lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return len(self._signatures)
+
+    def _band_keys(self, signature: List[int]) -> List[Tuple[int, tuple]]:
+        return [(band, tuple(signature[band * self.rows:(band + 1) * self.rows])) for band in range(self.bands)]
+
+    def add(self, job_id: int, signature: List[int]) -> None:
+        if len(signature) != MINHASH_NUM_PERM:
+            return
+        with self._lock:
+            self.remove(job_id)
+            self._signatures[job_id] = signature
+            for key in self._band_keys(signature):
+                self._buckets.setdefault(key, set()).add(job_id)
+
+    def remove(self, job_id: int) -> None:
+        with self._lock:
+            signature = self._signatures.pop(job_id, None)
+            if signature is None:
+                return
+            for key in self._band_keys(signature):
+                bucket = self._buckets.get(key)
+                if bucket is not None:
+                    bucket.discard(job_id)
+                    if not bucket:
+                        del self._buckets[key]
+
+    def query(self, signature: List[int], exclude: Optional[int] = None,
+              limit: int = JOB_SIMILARITY_CANDIDATES) -> List[Tuple[int, float]]:
+        """Các job chung ít nhất một band, sắp theo độ tương đồng ước lượng giảm dần."""
+        with self._lock:
+            candidates = set()
+            for key in self._band_keys(signature):
+                candidates |= self._buckets.get(key, set())
+            candidates.discard(exclude)
+            scored = [(job_id, estimated_similarity(signature, self._signatures[job_id])) for job_id in candidates]
+        scored.sort(key=lambda item: (-item[1], item[0]))
+        return scored[:limit]
+
+    def refresh(self, db: Session) -> None:
+        # Giữ lock cả lúc đọc: lần refresh đầu (nạp toàn bộ bảng) chỉ chạy một lần dù nhiều request đồng thời
+        with self._lock:
+            started = datetime.utcnow()
+            query = db.query(JobSignature.job_id, JobSignature.signature)
+            if self._synced_at is not None:
+                query = query.filter(JobSignature.updated_at >= self._synced_at - SYNC_OVERLAP)
+            for job_id, signature in query:
+                self.add(job_id, signature)
+            self._synced_at = started
+
+
+def store_signature(db: Session, job_id: int, text: str, index: SimilarityIndex,
+                    shingle_set: Optional[Set[str]] = None) -> List[int]:
+    """Signature của job: dùng lại bản đã lưu nếu nội dung không đổi, ngược lại tính lại và lưu (commit)."""
+    digest = content_key(normalize_text(text))
+    row = db.get(JobSignature, job_id)
+    if row is not None and row.content_hash == digest and len(row.signature) == MINHASH_NUM_PERM:
+        index.add(job_id, row.signature)
+        return row.signature
+
+    signature = minhash(shingles(text) if shingle_set is None else shingle_set)
+    _save_signature(db, job_id, digest, signature, row)
+    db.commit()
+    index.add(job_id, signature)
+    return signature
+
+def _save_signature(db: Session, job_id: int, digest: str, signature: List[int],
+                    row: Optional[JobSignature] = None) -> None:
+    # Chưa commit
+    if row is None:
+        try:
+            with db.begin_nested():
+                db.add(JobSignature(job_id=job_id, content_hash=digest, signature=signature,
+                                    updated_at=datetime.utcnow()))
+        except IntegrityError:
+            # Process khác vừa lưu signature của job này
+            pass
+    else:
+        row.content_hash, row.signature, row.updated_at = digest, signature, datetime.utcnow()
+
+def backfill_signatures(db: Session, limit: int = JOB_SIMILARITY_BACKFILL_BATCH) -> int:
+    """
+    Tính signature cho tối đa `limit` job đã có test active nhưng chưa có signature (chỉ job này mới có
+    câu hỏi để dùng lại) và lưu trong một commit. Không sửa index: refresh() của mỗi process nạp về sau.
+    """
+    has_test = exists().where(JobTest.job_id == Job.job_id, JobTest.is_active.is_(True))
+    has_signature = exists().where(JobSignature.job_id == Job.job_id)
+    jobs = db.query(Job).filter(has_test, ~has_signature).order_by(Job.job_id).limit(limit).all()
+    for job in jobs:
+        text = job_text(job)
+        _save_signature(db, job.job_id, content_key(normalize_text(text)), minhash(shingles(text)))
+    db.commit()
+    return len(jobs)
+
+def backfill_all_signatures(limit: int = JOB_SIMILARITY_BACKFILL_BATCH) -> int:
+    """Chạy backfill_signatures theo từng lô đến khi hết job thiếu signature (session riêng)."""
+    db = SessionLocal()
+    try:
+        total = 0
+        while True:
+            count = backfill_signatures(db, limit)
+            total += count
+            if count < max(1, limit):
+                return total
+    finally:
+        db.close()
+
+
+# --------- Tra cứu ---------
+def find_similar_test(db: Session, job_id: int, index: Optional[SimilarityIndex] = None,
+                      threshold: float = JOB_SIMILARITY_THRESHOLD) -> Optional[dict]:
+    """
+    Tìm job gần trùng nhất (Jaccard >= threshold) có test active đã có câu hỏi, trả về
+    {"job_id", "test_id", "similarity", "questions"} với questions cùng dạng generate_questions_from_jd,
+    hoặc None. Trong request chỉ tính/lưu signature của chính job; signature của các job cũ do
+    SignatureBackfill tính ở nền. Tính MinHash và refresh index tốn CPU/IO: gọi từ threadpool
+    (như _prepare_generation), không trực tiếp trên event loop.
+    """
+    if threshold <= 0:
+        return None
+    index = index or job_similarity_index
+    job = db.get(Job, job_id)
+    text = job_text(job) if job else ""
+    shingle_set = shingles(text)
+    if not shingle_set:
+        return None
+
+    signature = store_signature(db, job_id, text, index, shingle_set)
+    index.refresh(db)
+    candidates = [
+        candidate_id for candidate_id, estimate in index.query(signature, exclude=job_id)
+        if estimate >= threshold - ESTIMATE_MARGIN
+    ]
+
+    best = None
+    if candidates:
+        has_questions = exists().where(TestQuestion.test_id == JobTest.test_id)
+        tests = {
+            test.job_id: test
+            for test in db.query(JobTest).filter(
+                JobTest.job_id.in_(candidates), JobTest.is_active.is_(True), has_questions
+            )
+        }
+        jobs = {job.job_id: job for job in db.query(Job).filter(Job.job_id.in_(list(tests)))}
+        for candidate_id in candidates:
+            candidate = jobs.get(candidate_id)
+            if candidate is None:
+                continue
+            # Jaccard chính xác trên nội dung hiện tại: signature cũ của job ứng viên đã sửa không gây dùng lại sai
+            similarity = jaccard(shingle_set, shingles(job_text(candidate)))
+            if similarity >= threshold and (best is None or similarity > best[0]):
+                best = (similarity, candidate_id, tests[candidate_id])
+
+    if best is None:
+        JOB_SIMILARITY_LOOKUPS.labels("miss").inc()
+        return None
+    JOB_SIMILARITY_LOOKUPS.labels("hit").inc()
+    similarity, similar_job_id, test = best
+    logger.info("Reusing questions of similar job", extra={
+        "job_id": job_id, "similar_job_id": similar_job_id, "test_id": test.test_id, "similarity": round(similarity, 3),
+    })
+    return {
+        "job_id": similar_job_id,
+        "test_id": test.test_id,
+        "similarity": similarity,
+        "questions": [
+            {"question_text": q.question_text, "question_type": q.question_type, "prompt_version": q.prompt_version}
+            for q in list_test_questions(db, test.test_id)
+        ],
+    }
+
+
+# --------- Backfill nền ---------
+class SignatureBackfill:
+    """Định kỳ tính signature cho các job cũ chưa có (khởi động/dừng cùng app), ngoài luồng xử lý request."""
+
+    def __init__(self, interval: float = JOB_SIMILARITY_BACKFILL_INTERVAL_SECONDS):
+        self.interval = interval
+        self._stop: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self.interval <= 0 or JOB_SIMILARITY_THRESHOLD <= 0:
+            return
+        self._stop = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                # Tính MinHash tốn CPU: chạy trong thread để không chặn event loop
+                count = await asyncio.to_thread(backfill_all_signatures)
+                if count:
+                    logger.info("Job signatures backfilled", extra={"jobs": count})
+            except Exception:
+                logger.exception("Job signature backfill error")
+            try:
+                await asyncio.wait_for(self._stop.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._stop.set()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+
+job_similarity_index = SimilarityIndex()
+signature_backfill = SignatureBackfill()
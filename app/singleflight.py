@@ -0,0 +1,39 @@
+import asyncio
+from typing import Awaitable, Callable, Dict, Hashable, TypeVar
+from app.metrics import SINGLE_FLIGHT_SHARED
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    """
+    Gộp các lời gọi đồng thời cùng key trong process: lời gọi đầu tiên chạy `fn` trong một task riêng,
+    các lời gọi đến khi task chưa xong chờ và nhận chung kết quả (hoặc exception).
+    Task không bị hủy theo caller, nên `fn` phải tự mở session DB thay vì dùng session của request.
+    """
+
+    def __init__(self):
+        self._calls: Dict[Hashable, asyncio.Task] = {}
+
+    async def do(self, key: tuple, fn: Callable[[], Awaitable[T]]) -> T:
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.create_task(fn())
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+        else:
+            SINGLE_FLIGHT_SHARED.labels(str(key[0])).inc()
+        return await asyncio.shield(task)
+
+    def _forget(self, key: tuple, task: asyncio.Task) -> None:
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled():
+            # Mọi caller đã bỏ đi: tránh cảnh báo "exception was never retrieved"
+            task.exception()
+
+    def in_flight(self) -> int:
+        return len(self._calls)
+
+
+single_flight = SingleFlight()
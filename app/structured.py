@@ -0,0 +1,194 @@
+import os
+import re
+import json
+import logging
+from typing import Any, Callable, List, Optional, Type, TypeVar
+from pydantic import BaseModel, ConfigDict, Field, ValidationError, field_validator
+from .llm import LLM_MODEL_NAME, LLMError, PRIORITY_DEFAULT, llm_client
+from .metrics import LLM_STRUCTURED_OUTPUT
+from .prompts import prompt_registry
+
+logger = logging.getLogger(__name__)
+
+# Số lần gửi lại response sai cấu trúc cho model sửa (0 = không hỏi lại)
+LLM_REPAIR_ATTEMPTS = int(os.getenv("LLM_REPAIR_ATTEMPTS", "1"))
+JSON_RESPONSE_FORMAT = {"type": "json_object"}
+QUESTION_TYPES = ("core", "problem_solving", "fit")
+
+T = TypeVar("T")
+M = TypeVar("M", bound=BaseModel)
+
+
+class StructuredOutputError(LLMError):
+    """Response của LLM không parse/validate được thành cấu trúc mong đợi."""
+
+
+# --------- Schemas ---------
+class GeneratedQuestion(BaseModel):
+    model_config = ConfigDict(str_strip_whitespace=True)
+
+    question: str = Field(min_length=1)
+    # Loại lạ/thiếu -> None, caller suy ra theo thứ tự câu hỏi
+    type: Optional[str] = None
+
+    @field_validator("type", mode="before")
+    @classmethod
+    def _known_type(cls, value):
+        return value if value in QUESTION_TYPES else None
+
+
+class Evaluation(BaseModel):
+    score: int = Field(ge=0, le=100)
+    comment: str = ""
+    suggestion: str = ""
+
+    @field_validator("comment", "suggestion", mode="before")
+    @classmethod
+    def _empty_text(cls, value):
+        return "" if value is None else value
+
+
+class BatchEvaluationItem(Evaluation):
+    index: int
+
+
+class BatchEvaluation(BaseModel):
+    evaluations: List[BatchEvaluationItem]
+
+
+def validate(model: Type[M], data: Any) -> M:
+    """model.model_validate nhưng lỗi được gom thành StructuredOutputError (nội dung dùng cho prompt sửa lỗi)."""
+    try:
+        return model.model_validate(data)
+    except ValidationError as e:
+        details = "; ".join(
+            f"{'.'.join(str(part) for part in error['loc']) or 'root'}: {error['msg']}" for error in e.errors()[:5]
+        )
+        raise StructuredOutputError(f"JSON does not match the schema ({details})") from e
+
+
+# --------- Extract ---------
+_decoder = json.JSONDecoder()
+_JSON_START = re.compile(r"[\[{]")
+
+def extract_json(text: str) -> Any:
+    """
+    Giá trị JSON (object/array) đầu tiên trong response: bỏ qua lời dẫn, markdown fence ```json
+    và phần text thừa phía sau.
+    """
+    for match in _JSON_START.finditer(text or ""):
+        try:
+            return _decoder.raw_decode(text, match.start())[0]
+        except ValueError:
+            continue
+    raise StructuredOutputError("Response does not contain a valid JSON object")
+
+
+class JsonArrayStream:
+    """
+    Parse tăng dần mảng JSON đầu tiên trong response (kể cả khi nằm trong object, ví dụ {"questions": [...]}):
+    feed() nhận từng đoạn text và trả về các phần tử (object/array/string) vừa đóng.
+    Lời dẫn, fence được bỏ qua; response bị cắt giữa chừng vẫn giữ được các phần tử đã hoàn tất.
+    """
+
+    def __init__(self):
+        self.depth = 0
+        self.array_depth: Optional[int] = None
+        self.done = False
+        self._found = 0
+        self._in_string = False
+        self._escape = False
+        self._item: Optional[List[str]] = None
+
+    def feed(self, text: str) -> list:
+        items = []
+        for char in text:
+            if self.done:
+                break
+            if self._item is not None:
+                self._item.append(char)
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                    if self._item is not None and self.depth == self.array_depth:
+                        self._finish(items)
+                continue
+
+            # Ngoài JSON: chỉ chờ dấu mở ngoặc đầu tiên
+            if self.depth == 0 and char not in "{[":
+                continue
+
+            at_item_level = self._item is None and self.depth == self.array_depth
+            if char == '"':
+                self._in_string = True
+                if at_item_level:
+                    self._item = [char]
+            elif char in "{[":
+                if at_item_level:
+                    self._item = [char]
+                self.depth += 1
+                if char == "[" and self.array_depth is None:
+                    self.array_depth = self.depth
+            elif char in "}]":
+                self.depth -= 1
+                if self.array_depth is not None and self.depth < self.array_depth:
+                    # Mảng rỗng (thường là "[...]" trong lời dẫn) -> tìm mảng tiếp theo
+                    self.done = self._found > 0
+                    self.array_depth = None
+                elif self._item is not None and self.depth == self.array_depth:
+                    self._finish(items)
+        return items
+
+    def _finish(self, items: list) -> None:
+        text, self._item = "".join(self._item), None
+        try:
+            items.append(json.loads(text))
+            self._found += 1
+        except ValueError:
+            pass
+
+
+# --------- LLM ---------
+async def chat_structured(
+    messages: List[dict],
+    parse: Callable[[str], T],
+    model: str = LLM_MODEL_NAME,
+    temperature: float = 0.3,
+    priority: int = PRIORITY_DEFAULT,
+    operation: str = "chat",
+    lang: str = "en",
+) -> T:
+    """
+    Gọi LLM ở JSON mode rồi parse response bằng `parse` (raise StructuredOutputError nếu sai).
+    Response sai được gửi lại cho model kèm lỗi để sửa (tối đa LLM_REPAIR_ATTEMPTS lần) —
+    rẻ hơn gọi lại từ đầu vì model đã có sẵn ngữ cảnh; vẫn sai thì raise StructuredOutputError.
+    """
+    messages = list(messages)
+    for attempt in range(LLM_REPAIR_ATTEMPTS + 1):
+        content = await llm_client.chat(
+            messages, model=model, temperature=temperature, priority=priority,
+            operation=operation if attempt == 0 else f"{operation}_repair",
+            response_format=JSON_RESPONSE_FORMAT,
+        )
+        try:
+            result = parse(content)
+        except StructuredOutputError as e:
+            error = e
+            logger.warning("Invalid structured output", extra={
+                "operation": operation, "attempt": attempt + 1, "error": str(e), "content": content[:2000],
+            })
+            messages += [
+                {"role": "assistant", "content": content},
+                {"role": "user", "content": prompt_registry.render("repair_json", lang, errors=str(e))},
+            ]
+            continue
+        LLM_STRUCTURED_OUTPUT.labels(operation, "repaired" if attempt else "ok").inc()
+        return result
+
+    LLM_STRUCTURED_OUTPUT.labels(operation, "invalid").inc()
+    raise error
@@ -1,21 +1,43 @@
-from typing import List, Optional
+from typing import AsyncIterator, List, Optional
 from pydantic import BaseModel
-from sqlalchemy.orm import Session
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import func, insert, update
+from sqlalchemy.orm import Session, joinedload
+from sqlalchemy.exc import IntegrityError
 import re
-from .models import Job, JobTest, TestQuestion, QuestionAnswer, TestResult, Application
+import logging
+from .models import Job, JobTest, TestQuestion, QuestionAnswer, TestResult, Application, EvaluationCache
 import os
-import requests
-from langdetect import detect
+import asyncio
 import json
 from datetime import datetime
-
-LLM_API_URL = os.getenv("LLM_API_URL", "https://api.groq.com/openai/v1/chat/completions")
-LLM_MODEL_NAME = os.getenv("LLM_MODEL_NAME", "llama3-8b-8192")
-GROQ_API_KEY = os.getenv("GROQ_API_KEY", "")
+from .llm import (
+    LLM_API_URL, LLM_MODEL_NAME, GROQ_API_KEY, LLMError, llm_client,
+    PRIORITY_INTERACTIVE, PRIORITY_DEFAULT, PRIORITY_BULK
+)
+from .cache import question_cache, normalize_text, content_key
+from .language import language_detector
+from .prompts import prompt_registry
+from .db import SessionLocal, advisory_xact_lock, release_connection
+from .singleflight import single_flight
+from .prescreen import PRESCREEN_ENABLED, prescreen_answers
+from .analytics import mark_scores_changed
+from .metrics import GRADING_PRESCREENED
+from .structured import (
+    StructuredOutputError, GeneratedQuestion, Evaluation, BatchEvaluation, JsonArrayStream,
+    chat_structured, extract_json, validate
+)
+
+logger = logging.getLogger(__name__)
+
+# Số câu trả lời được chấm song song tối đa cho một bài test
+GRADING_CONCURRENCY = int(os.getenv("GRADING_CONCURRENCY", "5"))
 
 # --------- Pydantic Schemas ---------
 class GenerateQuestionRequest(BaseModel):
     job_id: int
+    # True: thay bộ câu hỏi hiện có của test theo order_index thay vì thêm mới
+    replace_existing: bool = False
 
 class QuestionCreate(BaseModel):
     test_id: int
@@ -27,316 +49,781 @@ class EvaluateAnswerRequest(BaseModel):
     result_id: int
 
 # --------- Language Detection ---------
-def detect_language(text: str) -> str:
-    try:
-        lang = detect(text)
-        return 'vi' if lang == 'vi' else 'en'
-    except:
-        return 'en'
-
-# --------- Prompt Builder ---------
-def get_prompt(jd: str, lang: str) -> str:
-    if lang == 'vi':
-        return f"""
-            Bạn là chuyên gia tuyển dụng. Dưới đây là mô tả công việc:
-            \"\"\"{jd}\"\"\"
-
-            **Nhiệm vụ**:
-            1. Xác định mức độ kinh nghiệm yêu cầu cho vị trí này (ít kinh nghiệm, trung bình, hoặc cao cấp) dựa trên nội dung JD.
-            2. Dựa vào mức độ đó, tạo 5 câu hỏi phỏng vấn chuyên sâu và phù hợp **bằng TIẾNG VIỆT**, để đánh giá:
-               - Kỹ năng chuyên môn chính - **3 câu**.
-               - Khả năng giải quyết vấn đề hoặc xử lý tình huống thực tế - **1 câu**.
-               - Sự phù hợp với vai trò và tổ chức - **1 câu**.
-
-            **Định nghĩa mức độ kinh nghiệm**:
-            - **Ít kinh nghiệm (Entry-level, dưới 2 năm)**:
-              - Ứng viên mới ra trường hoặc có ít kinh nghiệm.
-              - Nên hỏi về: kiến thức nền tảng, công cụ cơ bản, quy trình đơn giản, hiểu biết lý thuyết.
-            - **Kinh nghiệm trung bình (2–5 năm)**:
-              - Đã làm việc thực tế, có khả năng giải quyết vấn đề độc lập.
-              - Nên hỏi về: kinh nghiệm triển khai, phân tích tình huống thực tế, cải tiến công việc.
-            - **Kinh nghiệm cao (Senior, trên 5 năm)**:
-              - Có khả năng ra quyết định, tối ưu hệ thống, hoặc lãnh đạo nhóm.
-              - Nên hỏi về: chiến lược, tầm nhìn hệ thống, kinh nghiệm quản lý hoặc mentoring.
-
-            **Yêu cầu**:
-            - Mỗi câu hỏi phải rõ ràng, tránh chung chung.
-            - Trả lời hoàn toàn bằng **tiếng Việt**, trả về 1 danh sách câu hỏi không cần dịch hay giải thích gì thêm.
-        """
-    else:
-        return f"""
-            You are a professional recruiter. Carefully read the following job description:
-            \"\"\"{jd}\"\"\"
-
-            **Your task**:
-            1. Determine the required experience level (entry-level, mid-level, or senior-level) based on the JD.
-            2. Generate **5 highly relevant interview questions** tailored to that level, aiming to assess:
-               - Core technical or functional skills - **3 questions**.
-               - Real-world problem solving - **1 question**.
-               - Fit for the role and organization - **1 question**.
-
-            **Define the experience levels**:
-            - **Entry-level (under 2 years)**:
-              - Recent graduates or junior professionals.
-              - Ask about: basic concepts, common tools, understanding of workflows, theoretical knowledge.
-            - **Mid-level (2–5 years)**:
-              - Experienced in implementation, troubleshooting, working independently.
-              - Ask about: hands-on experience, applied scenarios, improvements they've contributed.
-            - **Senior-level (5+ years)**:
-              - Decision-makers, system optimizers, team leads.
-              - Ask about: strategy, architecture, leadership, mentoring, long-term impact.
-
-            **Guidelines**:
-            - Make each question precise and insightful (avoid vague/generic ones).
-            - Without explanation or translation or formatting. Only plain list the 5 questions clearly and concisely, based on the job description.
-        """
+def detect_language(text: str, default: str = 'en') -> str:
+    return language_detector.detect(text, default)
 
-# --------- AI Services ---------
+# Câu trả lời ngắn hơn mức này không đủ để nhận diện -> dùng ngôn ngữ của câu hỏi
+SHORT_ANSWER_CHARS = 20
 
-def generate_questions_from_jd(jd_text: str, model: str = LLM_MODEL_NAME) -> List[str]:
-    if not jd_text:
-        return []
+def evaluation_languages(items: List[tuple]) -> List[str]:
+    """Ngôn ngữ prompt chấm điểm cho cả lô (question_id, question_text, answer_text)."""
+    langs = language_detector.detect_many([answer or question for _, question, answer in items], default="vi")
+    return [
+        language_detector.detect_question(question_id, question, default="vi")
+        if len((answer or "").strip()) < SHORT_ANSWER_CHARS else lang
+        for (question_id, question, answer), lang in zip(items, langs)
+    ]
 
-    lang = detect_language(jd_text)
-    prompt = get_prompt(jd_text, lang)
+# --------- Prompt Builder ---------
+# Template nằm trong app/prompts/templates, version là hash nội dung (dùng cho cache key & lưu cùng kết quả)
+def get_prompt(jd: str, lang: str) -> str:
+    return prompt_registry.render("generate_questions", lang, jd=jd)
 
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {GROQ_API_KEY}"
-    }
+def question_prompt_version(lang: str) -> str:
+    return prompt_registry.get("generate_questions", lang).version
 
-    payload = {
-        "model": model,
-        "messages": [
-            {"role": "system", "content": "You are a helpful AI assistant."},
-            {"role": "user", "content": prompt}
-        ],
-        "temperature": 0.7
-    }
+# --------- AI Services ---------
 
+def parse_question_line(line: str) -> Optional[str]:
+    """Trả về nội dung câu hỏi nếu dòng là một câu hỏi (kết thúc bằng "?"), bỏ gạch đầu dòng / số thứ tự."""
+    line = line.strip().strip("-• ").strip()
+    if not line.endswith("?"):
+        return None
+    return re.sub(r"^\d+\.\s*", "", line).strip()
+
+def question_type_for(index: int) -> str:
+    # 3 câu chuyên môn, 1 câu giải quyết vấn đề, còn lại là mức độ phù hợp
+    if index < 3:
+        return "core"
+    if index == 3:
+        return "problem_solving"
+    return "fit"
+
+def question_item(value, count: int, prompt_version: str) -> Optional[dict]:
+    """
+    Validate một phần tử câu hỏi của response JSON (object hoặc string).
+    Thiếu/sai "type" thì suy ra theo số câu hỏi đã nhận trước đó (không theo số dòng).
+    """
+    if isinstance(value, str):
+        value = {"question": value}
     try:
-        response = requests.post(LLM_API_URL, headers=headers, json=payload)
-        response.raise_for_status()
-        content = response.json().get("choices", [{}])[0].get("message", {}).get("content", "")
-        lines = [line.strip("-• ").strip() for line in content.splitlines() if line.strip()]
-
-        questions = []
-        for i, line in enumerate(lines):
-            if not line.endswith("?"):
-                continue
-            question_text = re.sub(r"^\d+\.\s*", "", line).strip()
-
-            if i < 3:
-                q_type = "core"
-            elif i == 3:
-                q_type = "problem_solving"
-            else:
-                q_type = "fit"
+        question = validate(GeneratedQuestion, value)
+    except StructuredOutputError:
+        return None
+    return {
+        "question_text": question.question,
+        "question_type": question.type or question_type_for(count),
+        "prompt_version": prompt_version
+    }
 
+def parse_question_lines(content: str, prompt_version: str) -> List[dict]:
+    """Fallback khi model trả danh sách dạng text: mỗi dòng kết thúc bằng "?" là một câu hỏi."""
+    questions = []
+    for line in content.splitlines():
+        question_text = parse_question_line(line)
+        if question_text:
             questions.append({
                 "question_text": question_text,
-                "question_type": q_type
+                "question_type": question_type_for(len(questions)),
+                "prompt_version": prompt_version
             })
-
-        return questions
-
-    except Exception as e:
-        print("❌ Error calling Groq API:", e)
+    return questions
+
+def parse_questions(content: str, prompt_version: str) -> List[dict]:
+    """Câu hỏi trong response: mảng JSON (kể cả trong fence hoặc bị cắt giữa chừng), không có thì parse theo dòng."""
+    questions = []
+    for value in JsonArrayStream().feed(content):
+        item = question_item(value, len(questions), prompt_version)
+        if item:
+            questions.append(item)
+    questions = questions or parse_question_lines(content, prompt_version)
+    if not questions:
+        raise StructuredOutputError('No questions found, expected {"questions": [{"type": ..., "question": ...}]}')
+    return questions
+
+def _question_messages(jd_text: str, lang: str) -> List[dict]:
+    return [
+        {"role": "system", "content": "You are a helpful AI assistant."},
+        {"role": "user", "content": get_prompt(jd_text, lang)}
+    ]
+
+async def generate_questions_from_jd(jd_text: str, model: str = LLM_MODEL_NAME,
+                                     priority: int = PRIORITY_INTERACTIVE, use_cache: bool = True,
+                                     lang: Optional[str] = None) -> List[str]:
+    """
+    Sinh câu hỏi từ JD (thường là digest của job, xem app/jd_digest). Lỗi gọi LLM (sau khi đã thử lại)
+    được raise dưới dạng LLMError; response không có câu hỏi nào (kể cả sau khi hỏi lại để sửa) thì trả về [].
+    use_cache=False: luôn gọi LLM để có bộ câu hỏi mới (dùng khi làm đầy question pool).
+    lang: ngôn ngữ đã biết của JD, None thì nhận diện từ jd_text.
+    """
+    if not jd_text:
         return []
-    
-# --------- Evaluation Functions ---------
 
-def get_review_prompt(question: str, answer: str, lang: str = LLM_MODEL_NAME) -> str:
-    if lang == "vi":
-        return f"""
-## 🧑 Vai trò (Role)
-Bạn là chuyên gia nhân sự cấp cao, nhiều kinh nghiệm phỏng vấn ứng viên.
-
-## 📄 Bối cảnh (Context)
-- Câu hỏi phỏng vấn: {question}
-- Câu trả lời của ứng viên: {answer}
-
-## 📝 Hướng dẫn (Instructions)
-1. Đánh giá câu trả lời dựa trên mức độ phù hợp với câu hỏi, tính chính xác, độ rõ ràng.
-2. Viết **nhận xét ngắn gọn** (1–3 câu) giúp ứng viên hiểu điểm mạnh & điểm yếu.
-3. Chấm điểm câu trả lời trên **thang điểm 100** (0 là hoàn toàn sai, 100 là rất tốt). nếu câu trả lời trống, trả về 0. nếu câu trả lời đúng với câu hỏi, trả về chính xác 100.
-4. Đưa ra 1–2 gợi ý cải thiện, nếu cần.
-
-## 📦 Định dạng (Format)
-Trả về JSON đúng cấu trúc sau, không giải thích thêm, không thêm thông tin khác ngoài JSON:
-
-{{
-  "score": <số nguyên từ 0 đến 100>,
-  "comment": "<nhận xét>",
-  "suggestion": "<gợi ý cải thiện nếu có>"
-}}
-
-Trả lời **hoàn toàn bằng tiếng Việt**.
-"""
-    else:
-        return f"""
-## 🧑 Role
-You are a senior HR professional with extensive experience interviewing candidates.
-
-## 📄 Context
-- Interview question: {question}
-- Candidate's answer: {answer}
-
-## 📝 Instructions
-1. Evaluate the answer based on its relevance, accuracy, and clarity.
-2. Write a **brief comment** (1–3 sentences) summarizing strengths and weaknesses.
-3. Give a score from 0 to 100 (0 = completely wrong/no answer, 100 = excellent). if the answer is empty, return 0. if the answer is correct, return exactly 100.
-4. Provide 1–2 suggestions for improvement, if applicable.
+    lang = lang or detect_language(jd_text)
+    prompt_version = question_prompt_version(lang)
 
-## 📦 Format
-Return a JSON object matching the exact structure below. Do not include explanations or extra text:
+    cache_key = content_key(normalize_text(jd_text), lang, model, prompt_version)
+    cached = question_cache.get(cache_key) if use_cache else None
+    if cached is not None:
+        return cached
 
-{{
-  "score": <integer 0-100>,
-  "comment": "<brief feedback>",
-  "suggestion": "<improvement advice if any>"
-}}
+    try:
+        questions = await chat_structured(
+            _question_messages(jd_text, lang), lambda content: parse_questions(content, prompt_version),
+            model=model, temperature=0.7, priority=priority, operation="generate_questions", lang=lang
+        )
+    except StructuredOutputError:
+        return []
 
-Respond entirely in English.
-"""
+    question_cache.set(cache_key, questions)
+    return questions
 
-def generate_evaluation(question: str, answer: str, model: str = LLM_MODEL_NAME) -> dict:
-    try:
-        lang = detect(answer or question)
-    except:
-        lang = "vi"
+async def stream_questions_from_jd(jd_text: str, model: str = LLM_MODEL_NAME,
+                                   priority: int = PRIORITY_INTERACTIVE, lang: Optional[str] = None) -> AsyncIterator[dict]:
+    """
+    Như generate_questions_from_jd nhưng dùng chế độ stream của LLM:
+    yield từng câu hỏi ngay khi phần tử JSON chứa nó đóng lại.
+    """
+    if not jd_text:
+        return
+
+    lang = lang or detect_language(jd_text)
+    prompt_version = question_prompt_version(lang)
+
+    cache_key = content_key(normalize_text(jd_text), lang, model, prompt_version)
+    cached = question_cache.get(cache_key)
+    if cached is not None:
+        for item in cached:
+            yield item
+        return
+
+    # Stream không dùng response_format (nhiều provider không hỗ trợ JSON mode khi stream)
+    questions = []
+    parser = JsonArrayStream()
+    content = ""
+    async for delta in llm_client.stream_chat(
+        _question_messages(jd_text, lang), model=model, temperature=0.7, priority=priority,
+        operation="stream_questions"
+    ):
+        content += delta
+        for value in parser.feed(delta):
+            item = question_item(value, len(questions), prompt_version)
+            if item:
+                questions.append(item)
+                yield item
+
+    if not questions:
+        # Model trả danh sách dạng text thay vì JSON
+        questions = parse_question_lines(content, prompt_version)
+        for item in questions:
+            yield item
+
+    if questions:
+        question_cache.set(cache_key, questions)
+
+def format_stream_event(event: str, data: dict, fmt: str = "ndjson") -> str:
+    """Định dạng một sự kiện stream dưới dạng NDJSON (mặc định) hoặc SSE."""
+    if fmt == "sse":
+        return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+    return json.dumps({"event": event, **data}, ensure_ascii=False, default=str) + "\n"
+    
+# --------- Evaluation Functions ---------
+def get_review_prompt(question: str, answer: str, lang: str = "en") -> str:
+    return prompt_registry.render("evaluate_answer", lang, question=question, answer=answer)
+
+def parse_evaluation(content: str) -> dict:
+    """Kết quả chấm một câu: {"score": 0–100, "comment", "suggestion"}; sai cấu trúc thì raise StructuredOutputError."""
+    return validate(Evaluation, extract_json(content)).model_dump()
+
+async def generate_evaluation(question: str, answer: str, model: str = LLM_MODEL_NAME,
+                              priority: int = PRIORITY_DEFAULT, lang: Optional[str] = None) -> dict:
+    """
+    Chấm một câu trả lời. Nếu LLM lỗi (sau khi đã thử lại) hoặc vẫn trả về JSON sai sau khi được hỏi lại
+    thì raise LLMError — không trả về {} để tránh câu trả lời bị chấm 0 điểm một cách âm thầm.
+    """
+    if lang is None:
+        lang = detect_language(answer or question, default="vi")
 
     prompt = get_review_prompt(question, answer, lang)
+    prompt_version = prompt_registry.get("evaluate_answer", lang).version
 
-    response = requests.post(
-        "https://api.groq.com/openai/v1/chat/completions",
-        headers={
-            "Authorization": f"Bearer {GROQ_API_KEY}",
-            "Content-Type": "application/json",
-        },
-        json={
-            "model": model,
-            "messages": [
-                {"role": "system", "content": "You are a helpful interview assistant."},
-                {"role": "user", "content": prompt},
-            ],
-            "temperature": 0.3
-        }
-    )
+    messages = [
+        {"role": "system", "content": "You are a helpful interview assistant."},
+        {"role": "user", "content": prompt},
+    ]
 
-    if response.status_code != 200:
-        print("❌ Error calling API:", response.text)
+    result = await chat_structured(
+        messages, parse_evaluation, model=model, temperature=0.3, priority=priority,
+        operation="evaluate_answer", lang=lang
+    )
+    result["prompt_version"] = prompt_version
+    return result
+
+# --------- Batched Evaluation ---------
+# single: mỗi câu trả lời một request; batch: chấm nhiều câu trong một prompt
+EVALUATION_MODE = os.getenv("EVALUATION_MODE", "single")
+# Giới hạn độ dài (ký tự) phần câu hỏi + câu trả lời trong một prompt chấm gộp
+EVALUATION_BATCH_MAX_CHARS = int(os.getenv("EVALUATION_BATCH_MAX_CHARS", "12000"))
+
+def get_batch_review_prompt(items: List[tuple], lang: str = "en") -> str:
+    item_template = prompt_registry.get("evaluate_batch_item", lang)
+    blocks = "\n".join(
+        item_template.render(index=i, question=question, answer=answer)
+        for i, (question, answer) in enumerate(items, start=1)
+    )
+    return prompt_registry.render("evaluate_batch", lang, count=len(items), blocks=blocks)
+
+def parse_batch_evaluation(content: str, count: int) -> List[dict]:
+    """
+    Kiểm tra chặt response của prompt chấm gộp: đúng `count` phần tử, mỗi index 1..count
+    xuất hiện đúng một lần, score là số nguyên 0–100. Trả về list theo thứ tự index,
+    sai thì raise StructuredOutputError.
+    """
+    items = validate(BatchEvaluation, extract_json(content)).evaluations
+    by_index = {item.index: item for item in items}
+    if len(items) != count or sorted(by_index) != list(range(1, count + 1)):
+        raise StructuredOutputError(
+            f"Expected exactly {count} evaluations with index 1..{count} each once, "
+            f"got indexes {[item.index for item in items]}"
+        )
+    return [by_index[i].model_dump(exclude={"index"}) for i in range(1, count + 1)]
+
+def chunk_evaluation_items(items: List[tuple], max_chars: int = EVALUATION_BATCH_MAX_CHARS) -> List[List[tuple]]:
+    """Chia các cặp (câu hỏi, câu trả lời) thành các nhóm vừa với giới hạn độ dài prompt."""
+    chunks, current, size = [], [], 0
+    for question, answer in items:
+        length = len(question) + len(answer)
+        if current and size + length > max_chars:
+            chunks.append(current)
+            current, size = [], 0
+        current.append((question, answer))
+        size += length
+    if current:
+        chunks.append(current)
+    return chunks
+
+async def generate_batch_evaluation(items: List[tuple], model: str = LLM_MODEL_NAME,
+                                    max_concurrency: int = GRADING_CONCURRENCY,
+                                    priority: int = PRIORITY_DEFAULT) -> List[dict]:
+    """
+    Chấm nhiều cặp (câu hỏi, câu trả lời) bằng một (hoặc vài) prompt gộp.
+    Nhóm nào trả về JSON sai cấu trúc / sai số phần tử (kể cả sau khi hỏi lại để sửa) sẽ được chấm lại từng câu;
+    câu nào vẫn lỗi thì phần tử tương ứng là LLMError thay vì dict. Nhóm lỗi gọi API (429, 5xx, timeout
+    sau khi đã thử lại) không chấm lại từng câu — N lời gọi nữa tới cùng endpoint đang lỗi — mà mọi
+    phần tử của nhóm là lỗi đó.
+    """
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
+
+    async def grade_one(question, answer):
+        async with semaphore:
+            try:
+                return await generate_evaluation(question, answer, model, priority)
+            except LLMError as e:
+                return e
+
+    async def grade_chunk(chunk):
+        lang = detect_language(" ".join(answer or question for question, answer in chunk))
+        messages = [
+            {"role": "system", "content": "You are a helpful interview assistant."},
+            {"role": "user", "content": get_batch_review_prompt(chunk, lang)},
+        ]
+        try:
+            async with semaphore:
+                parsed = await chat_structured(
+                    messages, lambda content: parse_batch_evaluation(content, len(chunk)), model=model,
+                    temperature=0.3, priority=priority, operation="evaluate_batch", lang=lang
+                )
+            prompt_version = prompt_registry.get("evaluate_batch", lang).version
+            parsed = [{**evaluation, "prompt_version": prompt_version} for evaluation in parsed]
+        except StructuredOutputError:
+            logger.warning("Batch evaluation invalid, falling back to single calls", extra={"answers": len(chunk)})
+            parsed = await asyncio.gather(*(grade_one(question, answer) for question, answer in chunk))
+        except LLMError as e:
+            logger.error("Batch evaluation call failed", extra={"error": str(e), "answers": len(chunk)})
+            parsed = [e] * len(chunk)
+        return parsed
+
+    results = await asyncio.gather(*(grade_chunk(chunk) for chunk in chunk_evaluation_items(items)))
+    return [evaluation for chunk_results in results for evaluation in chunk_results]
+
+# --------- Evaluation Cache ---------
+evaluation_cache_stats = {"hits": 0, "misses": 0}
+
+def answer_hash(answer_text: str) -> str:
+    return content_key(normalize_text(answer_text))
+
+def get_cached_evaluations(db: Session, pairs: list, model: str = LLM_MODEL_NAME) -> dict:
+    """
+    Tra cứu kết quả chấm đã lưu cho danh sách (question_id, answer_text) bằng một query.
+    Trả về dict {(question_id, answer_hash): result}.
+    """
+    keys = {(question_id, answer_hash(answer_text)) for question_id, answer_text in pairs}
+    if not keys:
         return {}
 
-    content = response.json()["choices"][0]["message"]["content"]
+    rows = (
+        db.query(EvaluationCache)
+        .filter(
+            EvaluationCache.question_id.in_({question_id for question_id, _ in keys}),
+            # Câu hỏi có nhiều câu trả lời đã chấm: chỉ đọc các hash của bài làm này
+            EvaluationCache.answer_hash.in_({digest for _, digest in keys}),
+            EvaluationCache.model == model,
+            # Chỉ dùng kết quả của các prompt chấm hiện hành
+            EvaluationCache.prompt_version.in_(prompt_registry.versions("evaluate_answer", "evaluate_batch")),
+        )
+        .all()
+    )
+    found = {
+        (row.question_id, row.answer_hash): {**row.result, "prompt_version": row.prompt_version}
+        for row in rows if (row.question_id, row.answer_hash) in keys
+    }
 
+    evaluation_cache_stats["hits"] += len(found)
+    evaluation_cache_stats["misses"] += len(keys) - len(found)
+    return found
+
+def store_evaluation(db: Session, question_id: int, answer_text: str, result: dict,
+                     model: str = LLM_MODEL_NAME) -> None:
+    """
+    Lưu kết quả chấm vào cache (chưa commit), theo prompt_version của kết quả.
+    Bỏ qua nếu kết quả rỗng hoặc đã có bản ghi trùng.
+    """
+    if not result or "score" not in result:
+        return
     try:
-        return json.loads(content)
-    except Exception as e:
-        print("❌ Error parsing JSON:", e)
-        print("🔎 Content returned:", content)
-        return {}
-
-def evaluate_single_answer(question_id: int, answer_id: int, db) -> dict:
-    from app.models import TestQuestion, QuestionAnswer
-
-    question = db.query(TestQuestion).filter(TestQuestion.question_id == question_id).first()
-    answer = db.query(QuestionAnswer).filter(QuestionAnswer.answer_id == answer_id).first()
-
-    if not question:
-        return {"error": "Không tìm thấy câu hỏi"}
-    if not answer:
-        return {"error": "Không tìm thấy câu trả lời"}
+        with db.begin_nested():
+            db.add(EvaluationCache(
+                question_id=question_id,
+                answer_hash=answer_hash(answer_text),
+                model=model,
+                prompt_version=result.get("prompt_version", ""),
+                result=result,
+            ))
+    except IntegrityError:
+        pass
+
+def invalidate_question_evaluations(db: Session, question_ids) -> int:
+    """Xóa kết quả chấm đã lưu của một hoặc nhiều câu hỏi (khi nội dung câu hỏi thay đổi). Chưa commit."""
+    if isinstance(question_ids, int):
+        question_ids = [question_ids]
+    return (
+        db.query(EvaluationCache)
+        .filter(EvaluationCache.question_id.in_(question_ids))
+        .delete(synchronize_session=False)
+    )
 
-    if not answer.answer_text:
-        return {"error": "Câu trả lời trống"}
+def grading_hash(question: TestQuestion, answer: QuestionAnswer, model: str = LLM_MODEL_NAME) -> str:
+    """Hash của những gì quyết định điểm một câu: nội dung câu trả lời, phiên bản câu hỏi (nội dung + điểm) và model."""
+    return content_key(
+        normalize_text(answer.answer_text), normalize_text(question.question_text),
+        str(float(question.points or 1.0)), model
+    )
 
-    eval_result = generate_evaluation(question.question_text, answer.answer_text)
+def needs_grading(question: TestQuestion, answer: QuestionAnswer, model: str = LLM_MODEL_NAME) -> bool:
+    """Câu trả lời mới, đã sửa (câu trả lời/câu hỏi/model) hoặc lần chấm trước bị lỗi."""
+    return answer.grading_status != "graded" or answer.grading_hash != grading_hash(question, answer, model)
 
-    # Tính điểm
+def _apply_evaluation(question: TestQuestion, answer: QuestionAnswer, eval_result: dict,
+                      model: str = LLM_MODEL_NAME) -> float:
+    """Ghi điểm/nhận xét của một câu trả lời vào bản ghi (chưa commit). Trả về điểm thang 100."""
     score = eval_result.get("score", 0)
     points = float(question.points or 1.0)
-    earned = round(score / 100 * points, 2)
 
-    # Cập nhật vào DB
-    answer.points_earned = earned
+    answer.ai_score = score
+    answer.points_earned = round(score / 100 * points, 2)
     answer.is_correct = score >= 70
+    answer.comment = eval_result.get("comment", "")
+    answer.suggestion = eval_result.get("suggestion", "")
     answer.submitted_at = datetime.utcnow()
-    db.add(answer)
-    db.commit()
+    answer.grading_hash = grading_hash(question, answer, model)
+    answer.grading_status = "graded"
+    answer.prompt_version = eval_result.get("prompt_version")
+    return score
 
+def _mark_grading_failed(answer: QuestionAnswer) -> None:
+    # Giữ điểm cũ (nếu có) nhưng đánh dấu để lần chấm sau gửi lại câu này
+    answer.grading_status = "failed"
+
+def _answer_event(question: TestQuestion, answer: QuestionAnswer) -> dict:
     return {
-        "answer_id": answer_id,
-        "question": question.question_text,
-        "answer": answer.answer_text,
-        "score": score,
-        "earned_points": earned,
-        "comment": eval_result.get("comment", ""),
-        "suggestion": eval_result.get("suggestion", "")
+        "answer_id": answer.answer_id,
+        "question_id": question.question_id,
+        "order_index": question.order_index,
+        "score": float(answer.ai_score),
+        "earned_points": float(answer.points_earned),
+        "is_correct": answer.is_correct,
+        "comment": answer.comment,
+        "suggestion": answer.suggestion
     }
 
-
-def evaluate_test_result(result_id: int, db) -> dict:
+def _load_gradable_answers(db: Session, result_id: int):
+    """Trả về (result, [(question, answer)]) của một bài làm, hoặc dict {"error": ...}."""
     result = db.query(TestResult).filter(TestResult.result_id == result_id).first()
     if not result:
         return {"error": "Không tìm thấy bài làm."}
 
-    answers = db.query(QuestionAnswer).filter(QuestionAnswer.result_id == result_id).all()
-    if not answers:
-        return {"error": "Bài làm không có câu trả lời nào."}
+    # Lấy câu trả lời cùng câu hỏi trong một query
+    answers = (
+        db.query(QuestionAnswer)
+        .options(joinedload(QuestionAnswer.question))
+        .filter(QuestionAnswer.result_id == result_id)
+        .all()
+    )
 
-    scores = []
-    feedback_list = []
+    # Chỉ giữ các cặp (câu hỏi, câu trả lời) cần chấm
+    pairs = [(ans.question, ans) for ans in answers if ans.question and ans.answer_text]
+    if not pairs:
+        return {"error": "Bài làm không có câu trả lời nào."}
+    return result, pairs
+
+def _prescreen(pairs: list) -> dict:
+    """
+    Chấm sơ bộ các cặp (câu hỏi, câu trả lời) không cần LLM: trả về {answer_id: kết quả 0 điểm}
+    cho câu trả lời quá ngắn, chép lại câu hỏi hoặc vô nghĩa. Lý do được log và lưu trong prompt_version.
+    """
+    if not PRESCREEN_ENABLED or not pairs:
+        return {}
+    langs = [language_detector.detect_question(q.question_id, q.question_text, default="vi") for q, _ in pairs]
+    results = prescreen_answers([(q.question_text, ans.answer_text) for q, ans in pairs], langs)
 
-    for ans in answers:
-        question = db.query(TestQuestion).filter(TestQuestion.question_id == ans.question_id).first()
-        if not question or not ans.answer_text:
+    screened = {}
+    for (question, ans), eval_result in zip(pairs, results):
+        if eval_result is None:
             continue
-
-        eval_result = generate_evaluation(question.question_text, ans.answer_text)
-
-        # Chấm điểm
-        score = eval_result.get("score", 0)
-        points = float(question.points or 1.0)
-        earned = round(score / 100 * points, 2)
-
-        ans.points_earned = earned
-        ans.is_correct = score >= 70
-        ans.submitted_at = datetime.utcnow()
-        db.add(ans)
-
-        scores.append(score)  # <-- Chấm theo thang điểm 100, lưu để tính trung bình
-        feedback_list.append(f"Q{question.order_index}: {eval_result.get('comment', '')}")
-
-    db.commit()
-
-    # Tổng & trung bình
-    total_score = round(sum(scores), 2)
-    average_score = round(total_score / len(scores), 2)
+        screened[ans.answer_id] = eval_result
+        GRADING_PRESCREENED.labels(eval_result["prescreen"]["reason"]).inc()
+        logger.info("Answer pre-screened, LLM skipped", extra={
+            "answer_id": ans.answer_id, "question_id": question.question_id, **eval_result["prescreen"],
+        })
+    return screened
+
+def _split_cached(db: Session, pairs: list):
+    """Tách các cặp đã có kết quả chấm trong cache: trả về (cached, misses)."""
+    cached = get_cached_evaluations(db, [(question.question_id, ans.answer_text) for question, ans in pairs])
+    misses = [(question, ans) for question, ans in pairs
+              if (question.question_id, answer_hash(ans.answer_text)) not in cached]
+    return cached, misses
+
+def _finalize_result(db: Session, result: TestResult, pairs: List[tuple]) -> dict:
+    """
+    Cập nhật kết quả tổng thể từ điểm đã lưu của từng câu (ai_score, comment) và commit.
+    """
+    # Feedback sắp xếp theo thứ tự câu hỏi
+    pairs = sorted(pairs, key=lambda pair: pair[0].order_index or 0)
+    feedback_list = [f"Q{question.order_index}: {ans.comment or ''}" for question, ans in pairs]
+
+    # Tổng & trung bình bằng aggregate SQL trên các câu đã chấm của bài (flush để gồm cả điểm vừa chấm)
+    db.flush()
+    count, total = (
+        db.query(func.count(QuestionAnswer.answer_id), func.sum(QuestionAnswer.ai_score))
+        .join(QuestionAnswer.question)
+        .filter(QuestionAnswer.result_id == result.result_id,
+                QuestionAnswer.answer_text.isnot(None), QuestionAnswer.answer_text != "")
+        .one()
+    )
+    total_score = round(float(total or 0), 2)
+    average_score = round(total_score / count, 2) if count else 0.0
 
     # Đánh giá đạt hay không: trung bình >= 60
     passing_score = 60
     passed = average_score >= passing_score
 
-    # Cập nhật test_results
     result.total_score = total_score
     result.percentage = average_score
     result.passed = passed
     result.graded_at = datetime.utcnow()
     result.feedback = "\n".join(feedback_list)
     db.add(result)
+    mark_scores_changed(db, result.test_id, [question.question_id for question, _ in pairs])
     db.commit()
 
     return {
-        "result_id": result_id,
+        "result_id": result.result_id,
         "total_score": total_score,
         "average_score": average_score,
         "passed": passed,
         "feedback": feedback_list
     }
 
+async def evaluate_single_answer(question_id: int, answer_id: int, db) -> dict:
+    from app.models import TestQuestion, QuestionAnswer
+
+    question = db.query(TestQuestion).filter(TestQuestion.question_id == question_id).first()
+    answer = db.query(QuestionAnswer).filter(QuestionAnswer.answer_id == answer_id).first()
+
+    if not question:
+        return {"error": "Không tìm thấy câu hỏi"}
+    if not answer:
+        return {"error": "Không tìm thấy câu trả lời"}
+
+    if not answer.answer_text:
+        return {"error": "Câu trả lời trống"}
+
+    eval_result = _prescreen([(question, answer)]).get(answer.answer_id)
+    if eval_result is None:
+        key = (question.question_id, answer_hash(answer.answer_text))
+        eval_result = get_cached_evaluations(db, [(question.question_id, answer.answer_text)]).get(key)
+    if eval_result is None:
+        lang = evaluation_languages([(question.question_id, question.question_text, answer.answer_text)])[0]
+        release_connection(db)
+        eval_result = await generate_evaluation(
+            question.question_text, answer.answer_text, priority=PRIORITY_INTERACTIVE, lang=lang
+        )
+        store_evaluation(db, question.question_id, answer.answer_text, eval_result)
+
+    # Tính điểm & cập nhật vào DB
+    score = _apply_evaluation(question, answer, eval_result)
+    response = {
+        "answer_id": answer_id,
+        "question": question.question_text,
+        "answer": answer.answer_text,
+        "score": score,
+        "earned_points": answer.points_earned,
+        "comment": answer.comment,
+        "suggestion": answer.suggestion
+    }
+    db.add(answer)
+    mark_scores_changed(db, question_ids=[question.question_id])
+    db.commit()
+    return response
+
+
+async def evaluate_test_result(result_id: int, db, max_concurrency: int = GRADING_CONCURRENCY,
+                               batched: Optional[bool] = None, priority: int = PRIORITY_DEFAULT,
+                               incremental: bool = True) -> dict:
+    """
+    Chấm các câu trả lời của một bài làm và cập nhật kết quả tổng thể.
+    incremental=True: chỉ gửi lại câu mới, đã sửa hoặc lần trước chấm lỗi; các câu khác giữ điểm đã lưu.
+    Câu nào không chấm được do LLM lỗi thì không bị cho 0 điểm: các câu đã chấm vẫn được lưu,
+    còn kết quả tổng thể chỉ được cập nhật khi mọi câu đều chấm xong (trả về "error" + "failed_answer_ids").
+    Phần đọc và phần ghi DB chạy trong threadpool: chờ pool connection hay query chậm không chặn event loop.
+    """
+    if batched is None:
+        batched = EVALUATION_MODE == "batch"
+
+    loaded = await run_in_threadpool(_prepare_result_grading, db, result_id, incremental)
+    if isinstance(loaded, dict):
+        return loaded
+    result, pairs, pending, screened, cached, misses = loaded
+
+    if batched and len(misses) > 1:
+        # Chấm gộp các câu còn lại trong một (hoặc vài) prompt
+        fresh = await generate_batch_evaluation(
+            [(question.question_text, ans.answer_text) for question, ans in misses],
+            max_concurrency=max_concurrency,
+            priority=priority
+        )
+    else:
+        # Gọi LLM song song cho các câu còn lại (giới hạn bởi max_concurrency)
+        semaphore = asyncio.Semaphore(max(1, max_concurrency))
+        langs = evaluation_languages([(q.question_id, q.question_text, ans.answer_text) for q, ans in misses])
+
+        async def grade(question, ans, lang):
+            async with semaphore:
+                try:
+                    return await generate_evaluation(
+                        question.question_text, ans.answer_text, priority=priority, lang=lang
+                    )
+                except LLMError as e:
+                    return e
+
+        fresh = await asyncio.gather(*(grade(question, ans, lang) for (question, ans), lang in zip(misses, langs)))
+
+    fresh_by_answer = {ans.answer_id: evaluation for (_, ans), evaluation in zip(misses, fresh)}
+    return await run_in_threadpool(
+        _save_result_grading, db, result, pairs, pending, screened, cached, fresh_by_answer
+    )
+
+def _prepare_result_grading(db: Session, result_id: int, incremental: bool):
+    """
+    Phần đọc của evaluate_test_result: (result, pairs, pending, screened, cached, misses),
+    hoặc {"error": ...} nếu không có bài làm. Trả connection trước khi caller chờ LLM.
+    """
+    loaded = _load_gradable_answers(db, result_id)
+    if isinstance(loaded, dict):
+        return loaded
+    result, pairs = loaded
+
+    pending = [(question, ans) for question, ans in pairs if not incremental or needs_grading(question, ans)]
+
+    # Câu trả lời hiển nhiên 0 điểm được chấm tại chỗ, không gửi LLM
+    screened = _prescreen(pending)
+
+    # Câu trả lời đã chấm trước đó (cùng câu hỏi, cùng nội dung) lấy lại từ cache
+    cached, misses = _split_cached(db, [(q, ans) for q, ans in pending if ans.answer_id not in screened])
+
+    # Không giữ connection trong lúc chờ LLM: điểm được ghi sau đó trong một transaction ngắn
+    release_connection(db)
+    return result, pairs, pending, screened, cached, misses
+
+def _save_result_grading(db: Session, result: TestResult, pairs: list, pending: list, screened: dict,
+                         cached: dict, fresh_by_answer: dict) -> dict:
+    """Phần ghi của evaluate_test_result: lưu điểm từng câu rồi kết quả tổng thể trong một transaction."""
+    result_id = result.result_id
+    failed = []
+
+    # Ghi điểm & kết quả tổng thể tuần tự với process khác đang ghi cùng bài làm (khóa nhả khi commit)
+    advisory_xact_lock(db, "evaluate_test_result", result_id)
+
+    for question, ans in pending:
+        if ans.answer_id in screened:
+            eval_result = screened[ans.answer_id]
+        elif ans.answer_id in fresh_by_answer:
+            eval_result = fresh_by_answer[ans.answer_id]
+        else:
+            eval_result = cached[(question.question_id, answer_hash(ans.answer_text))]
+
+        if isinstance(eval_result, LLMError):
+            _mark_grading_failed(ans)
+            failed.append(ans.answer_id)
+            continue
+
+        # Chấm điểm (thang 100)
+        _apply_evaluation(question, ans, eval_result)
+        if ans.answer_id in fresh_by_answer:
+            store_evaluation(db, question.question_id, ans.answer_text, eval_result)
+
+    if failed:
+        # Giữ điểm các câu đã chấm được, chưa cập nhật kết quả tổng thể
+        db.commit()
+        return {
+            "error": "Không chấm được một số câu trả lời do lỗi LLM, vui lòng thử lại.",
+            "result_id": result_id,
+            "failed_answer_ids": failed
+        }
+
+    # Cập nhật test_results từ điểm đã lưu của mọi câu (cùng một commit với điểm từng câu)
+    return _finalize_result(db, result, pairs)
+
+async def evaluate_test_result_once(result_id: int, batched: Optional[bool] = None,
+                                    priority: int = PRIORITY_DEFAULT, incremental: bool = True) -> dict:
+    """
+    evaluate_test_result với session riêng, gộp các lần chấm đồng thời cho cùng result_id trong process
+    (single_flight). Giữa các process chỉ phần ghi chạy tuần tự (advisory_xact_lock); lần chấm
+    incremental sau đó chỉ gửi LLM các câu còn thiếu.
+    """
+    async def run() -> dict:
+        db = SessionLocal()
+        try:
+            return await evaluate_test_result(result_id, db, batched=batched, priority=priority, incremental=incremental)
+        finally:
+            db.close()
+
+    # Chỉ gộp các lần chấm cùng chế độ: lần chấm lại toàn bộ không được nhận kết quả của lần incremental
+    return await single_flight.do(("evaluate_test_result", result_id, incremental, batched), run)
+
+async def stream_test_result_grading(result_id: int, db, max_concurrency: int = GRADING_CONCURRENCY,
+                                     priority: int = PRIORITY_INTERACTIVE,
+                                     incremental: bool = True) -> AsyncIterator[tuple]:
+    """
+    Chấm bài làm và phát (event, data) cho từng câu ngay khi chấm xong, cuối cùng là kết quả tổng thể.
+    Mỗi câu được commit ngay khi có điểm nên client ngắt kết nối giữa chừng cũng không mất phần đã chấm.
+    Luôn chấm từng câu một prompt (không gộp) để có tiến độ theo từng câu. Mọi lần ghi giữ cùng
+    advisory_xact_lock với evaluate_test_result nên không xen kẽ với một lần chấm khác của bài làm.
+    """
+    loaded = _load_gradable_answers(db, result_id)
+    if isinstance(loaded, dict):
+        yield "error", {"result_id": result_id, "detail": loaded["error"]}
+        return
+    result, pairs = loaded
+    total = len(pairs)
+    completed = 0
+    failed = []
+
+    def progress(data: dict) -> dict:
+        nonlocal completed
+        completed += 1
+        return {**data, "completed": completed, "total": total}
+
+    def save(question, ans, eval_result, fresh):
+        advisory_xact_lock(db, "evaluate_test_result", result_id)
+        _apply_evaluation(question, ans, eval_result)
+        if fresh:
+            store_evaluation(db, question.question_id, ans.answer_text, eval_result)
+        event = progress(_answer_event(question, ans))
+        release_connection(db)
+        return event
+
+    # Câu đã chấm và không đổi phát lại điểm đã lưu, câu có trong cache được phát ngay
+    unchanged, pending = [], []
+    for question, ans in pairs:
+        if incremental and not needs_grading(question, ans):
+            unchanged.append((question, ans))
+        else:
+            pending.append((question, ans))
+
+    # Câu trả lời hiển nhiên 0 điểm được chấm tại chỗ, không gửi LLM
+    screened = _prescreen(pending)
+    pending = [(question, ans) for question, ans in pending if ans.answer_id not in screened]
+    cached, misses = _split_cached(db, pending)
+    # Đọc xong: không giữ connection trong lúc chờ client nhận sự kiện hay chờ LLM
+    release_connection(db)
+
+    for question, ans in unchanged:
+        yield "answer", progress(_answer_event(question, ans))
+    for question, ans in pairs:
+        if ans.answer_id in screened:
+            yield "answer", save(question, ans, screened[ans.answer_id], fresh=False)
+
+    for question, ans in pending:
+        key = (question.question_id, answer_hash(ans.answer_text))
+        if key in cached:
+            yield "answer", save(question, ans, cached[key], fresh=False)
+
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
+    langs = evaluation_languages([(q.question_id, q.question_text, ans.answer_text) for q, ans in misses])
+
+    async def grade(question, ans, lang):
+        async with semaphore:
+            try:
+                evaluation = await generate_evaluation(
+                    question.question_text, ans.answer_text, priority=priority, lang=lang
+                )
+            except LLMError as e:
+                evaluation = e
+        return question, ans, evaluation
+
+    tasks = [asyncio.create_task(grade(question, ans, lang)) for (question, ans), lang in zip(misses, langs)]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            question, ans, evaluation = await next_done
+            if isinstance(evaluation, LLMError):
+                advisory_xact_lock(db, "evaluate_test_result", result_id)
+                _mark_grading_failed(ans)
+                failed.append(ans.answer_id)
+                event = progress({
+                    "answer_id": ans.answer_id,
+                    "question_id": question.question_id,
+                    "detail": str(evaluation)
+                })
+                release_connection(db)
+                yield "answer_error", event
+                continue
+            yield "answer", save(question, ans, evaluation, fresh=True)
+    finally:
+        # Client ngắt kết nối: hủy các câu chưa chấm xong, các câu đã chấm đã được commit
+        for task in tasks:
+            task.cancel()
+
+    if failed:
+        yield "error", {
+            "result_id": result_id,
+            "detail": "Không chấm được một số câu trả lời do lỗi LLM, vui lòng thử lại.",
+            "failed_answer_ids": failed
+        }
+        return
+
+    # Tổng hợp từ điểm đã lưu, tuần tự với phần ghi của evaluate_test_result cho cùng bài làm
+    advisory_xact_lock(db, "evaluate_test_result", result_id)
+    yield "done", _finalize_result(db, result, pairs)
 
 
+
+def _answer_detail(answer: QuestionAnswer) -> dict:
+    question = answer.question
+    return {
+        "question_id": answer.question_id,
+        "question_text": question.question_text if question else None,
+        "answer_id": answer.answer_id,
+        "answer_text": answer.answer_text,
+        "score": answer.points_earned,
+        "is_correct": answer.is_correct,
+        "submitted_at": answer.submitted_at,
+        "comment": answer.comment or "",
+        "suggestion": answer.suggestion or "",
+        "prompt_version": answer.prompt_version
+    }
+
 def get_answer_details(result_id: int, db: Session):
     result = db.query(TestResult).filter(TestResult.result_id == result_id).first()
     if not result:
@@ -344,6 +831,7 @@ def get_answer_details(result_id: int, db: Session):
 
     answers = (
         db.query(QuestionAnswer)
+        .options(joinedload(QuestionAnswer.question))
         .filter(QuestionAnswer.result_id == result_id)
         .order_by(QuestionAnswer.answer_id)
         .all()
@@ -352,25 +840,40 @@ def get_answer_details(result_id: int, db: Session):
     if not answers:
         return {"error": "Không có câu trả lời nào."}
 
-    details = []
-    for answer in answers:
-        question = db.query(TestQuestion).filter(TestQuestion.question_id == answer.question_id).first()
-        details.append({
-            "question_id": question.question_id,
-            "question_text": question.question_text,
-            "answer_id": answer.answer_id,
-            "answer_text": answer.answer_text,
-            "score": answer.points_earned,
-            "is_correct": answer.is_correct,
-            "submitted_at": answer.submitted_at,
-            "comment": getattr(answer, "comment", ""),        
-            "suggestion": getattr(answer, "suggestion", "")   
-        })
-
     return {
         "result_id": result_id,
         "test_id": result.test_id,
-        "questions_and_answers": details
+        "questions_and_answers": [_answer_detail(answer) for answer in answers]
+    }
+
+def get_answer_details_bulk(result_ids: List[int], db: Session) -> dict:
+    """Chi tiết câu hỏi & câu trả lời của nhiều bài làm, dùng 2 query cho toàn bộ danh sách."""
+    result_ids = list(dict.fromkeys(result_ids))
+    results = db.query(TestResult).filter(TestResult.result_id.in_(result_ids)).all()
+
+    answers = (
+        db.query(QuestionAnswer)
+        .options(joinedload(QuestionAnswer.question))
+        .filter(QuestionAnswer.result_id.in_([r.result_id for r in results]))
+        .order_by(QuestionAnswer.result_id, QuestionAnswer.answer_id)
+        .all()
+    ) if results else []
+
+    by_result = {}
+    for answer in answers:
+        by_result.setdefault(answer.result_id, []).append(_answer_detail(answer))
+
+    found = {r.result_id: r for r in results}
+    return {
+        "results": [
+            {
+                "result_id": result_id,
+                "test_id": found[result_id].test_id,
+                "questions_and_answers": by_result.get(result_id, [])
+            }
+            for result_id in result_ids if result_id in found
+        ],
+        "missing_result_ids": [result_id for result_id in result_ids if result_id not in found]
     }
 
 
@@ -378,14 +881,199 @@ def get_answer_details(result_id: int, db: Session):
 def get_job(db: Session, job_id: int) -> Optional[Job]:
     return db.query(Job).filter(Job.job_id == job_id).first()
 
-def get_or_create_job_test(db: Session, job_id: int) -> JobTest:
-    test = db.query(JobTest).filter(JobTest.job_id == job_id).first()
+def get_or_create_job_test(db: Session, job_id: int, commit: bool = True) -> JobTest:
+    test = db.query(JobTest).filter(JobTest.job_id == job_id, JobTest.is_active.is_(True)).first()
     if test:
         return test
     test = JobTest(job_id=job_id, test_name="Auto Generated Test")
-    db.add(test); db.commit(); db.refresh(test)
+    try:
+        with db.begin_nested():
+            db.add(test)
+    except IntegrityError:
+        # Request/process khác vừa tạo test active cho job (unique index uq_job_tests_active_job)
+        return db.query(JobTest).filter(JobTest.job_id == job_id, JobTest.is_active.is_(True)).one()
+    if commit:
+        db.commit(); db.refresh(test)
     return test
 
+def get_recently_generated_test(db: Session, job_id: int, since: datetime) -> Optional[JobTest]:
+    """Test của job có bộ câu hỏi được sinh/lưu từ thời điểm `since` (bởi request hoặc process khác)."""
+    return (db.query(JobTest)
+              .filter(JobTest.job_id == job_id, JobTest.is_active.is_(True), JobTest.updated_at >= since)
+              .first())
+
+def _question_row(test_id: int, order_index: int, item: dict) -> dict:
+    return {
+        "test_id": test_id,
+        "question_text": item["question_text"],
+        "question_type": item.get("question_type"),  # "core", "problem_solving", "fit"
+        "points": item.get("points", 1.0),
+        "time_limit_seconds": item.get("time_limit_seconds", 120),
+        "order_index": order_index,
+        "explanation": item.get("explanation", ""),
+        "required": item.get("required", True),
+        "prompt_version": item.get("prompt_version"),
+    }
+
+def _answered_question_ids(db: Session, question_ids: List[int]) -> set:
+    if not question_ids:
+        return set()
+    return {
+        question_id for (question_id,) in
+        db.query(QuestionAnswer.question_id).filter(QuestionAnswer.question_id.in_(question_ids)).distinct()
+    }
+
+def _remove_test_questions(db: Session, question_ids: List[int]) -> int:
+    """
+    Gỡ câu hỏi khỏi test (chưa commit): câu chưa có câu trả lời bị xóa; câu đã có câu trả lời
+    (question_answers còn tham chiếu) được tách khỏi test (test_id = NULL) để giữ lịch sử bài làm.
+    """
+    if not question_ids:
+        return 0
+    answered = _answered_question_ids(db, question_ids)
+    unanswered = [question_id for question_id in question_ids if question_id not in answered]
+    if unanswered:
+        db.query(TestQuestion).filter(TestQuestion.question_id.in_(unanswered)).delete(synchronize_session=False)
+    if answered:
+        (db.query(TestQuestion)
+           .filter(TestQuestion.question_id.in_(answered))
+           .update({TestQuestion.test_id: None}, synchronize_session=False))
+    return len(question_ids)
+
+def upsert_job_test_questions(db: Session, job_id: int, questions: List[dict], replace: bool = False):
+    """
+    Tạo (nếu chưa có) job_test của job và lưu toàn bộ câu hỏi trong một transaction,
+    dùng INSERT ... RETURNING dạng executemany thay vì add/commit từng câu.
+
+    replace=False: thêm các câu hỏi với order_index 1..n.
+    replace=True: thay bộ câu hỏi của test theo order_index — câu cùng order_index (câu có question_id
+    nhỏ nhất nếu trùng) chưa có câu trả lời được cập nhật, giữ nguyên question_id; câu đã có câu trả lời
+    mà nội dung đổi không bị sửa mà được gỡ khỏi test và thay bằng câu mới (câu trả lời cũ vẫn trỏ
+    đúng câu hỏi đã trả lời). Các câu còn lại bị gỡ khỏi test (_remove_test_questions).
+
+    Trả về (test, danh sách TestQuestion theo thứ tự của `questions`).
+    """
+    try:
+        test = get_or_create_job_test(db, job_id, commit=False)
+        rows = [_question_row(test.test_id, idx + 1, item) for idx, item in enumerate(questions)]
+
+        to_insert = rows
+        updated_ids = {}
+        if replace:
+            existing = {}
+            extra_ids = []
+            for q in (db.query(TestQuestion)
+                        .filter(TestQuestion.test_id == test.test_id)
+                        .order_by(TestQuestion.question_id)):
+                # Dữ liệu cũ có thể có nhiều câu cùng order_index: giữ câu đầu, gỡ các câu thừa.
+                # Câu hỏi tạo tay (order_index NULL) giữ nguyên
+                if q.order_index is None:
+                    continue
+                if q.order_index in existing:
+                    extra_ids.append(q.question_id)
+                else:
+                    existing[q.order_index] = q
+            answered = _answered_question_ids(db, [q.question_id for q in existing.values()])
+            to_update = []
+            changed_ids = []
+            for row in rows:
+                current = existing.get(row["order_index"])
+                if current is None:
+                    continue
+                if current.question_text != row["question_text"]:
+                    if current.question_id in answered:
+                        # Giữ câu hỏi ứng viên đã trả lời; order_index này nhận câu mới
+                        extra_ids.append(current.question_id)
+                        continue
+                    changed_ids.append(current.question_id)
+                to_update.append({"question_id": current.question_id, **row})
+                updated_ids[row["order_index"]] = current.question_id
+
+            if changed_ids:
+                invalidate_question_evaluations(db, changed_ids)
+            if to_update:
+                db.execute(update(TestQuestion), to_update)
+
+            new_indexes = {row["order_index"] for row in rows}
+            extra_ids += [q.question_id for order_index, q in existing.items() if order_index not in new_indexes]
+            _remove_test_questions(db, extra_ids)
+
+            to_insert = [row for row in rows if row["order_index"] not in updated_ids]
+
+        question_ids = dict(updated_ids)
+        if to_insert:
+            created = db.execute(
+                insert(TestQuestion).returning(TestQuestion.question_id, sort_by_parameter_order=True),
+                to_insert
+            ).scalars().all()
+            question_ids.update({row["order_index"]: qid for row, qid in zip(to_insert, created)})
+
+        test_id = test.test_id
+        test.updated_at = datetime.utcnow()
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+    # Nạp lại test & câu hỏi sau commit bằng 2 query (tránh refresh từng object)
+    test = db.query(JobTest).filter(JobTest.test_id == test_id).first()
+    saved = {
+        q.question_id: q
+        for q in db.query(TestQuestion).filter(TestQuestion.question_id.in_(question_ids.values())).all()
+    }
+    return test, [saved[question_ids[row["order_index"]]] for row in rows]
+
+def save_streamed_question(db: Session, order_index: int, item: dict) -> TestQuestion:
+    """
+    Lưu ngay một câu hỏi vừa sinh (chế độ stream) ở dạng nháp: chưa gắn vào test (test_id NULL)
+    nên bộ câu hỏi hiện tại của test không đổi đến khi publish_streamed_questions.
+    """
+    q = TestQuestion(**_question_row(None, order_index, item))
+    db.add(q)
+    # Commit không expire q: caller đọc q.question_id rồi chờ LLM mà không mở lại transaction
+    release_connection(db)
+    return q
+
+def publish_streamed_questions(db: Session, job_id: int, question_ids: List[int], replace: bool = False) -> JobTest:
+    """
+    Gắn các câu hỏi nháp của một lần stream vào job_test của job (tạo nếu chưa có) trong một transaction.
+    replace=True: các câu hỏi cũ có order_index bị gỡ khỏi test (_remove_test_questions) cùng lúc.
+    """
+    try:
+        # Ghi tuần tự với các lần sinh câu hỏi khác của cùng job (khóa nhả khi commit)
+        advisory_xact_lock(db, "generate_questions", job_id)
+        test = get_or_create_job_test(db, job_id, commit=False)
+        if replace:
+            _remove_test_questions(db, [
+                question_id for (question_id,) in
+                db.query(TestQuestion.question_id)
+                  .filter(TestQuestion.test_id == test.test_id, TestQuestion.order_index.isnot(None))
+            ])
+        (db.query(TestQuestion)
+           .filter(TestQuestion.question_id.in_(question_ids), TestQuestion.test_id.is_(None))
+           .update({TestQuestion.test_id: test.test_id}, synchronize_session=False))
+        test.updated_at = datetime.utcnow()
+        release_connection(db)
+    except Exception:
+        db.rollback()
+        raise
+    return test
+
+def discard_streamed_questions(db: Session, question_ids: List[int]) -> None:
+    """Xóa các câu hỏi nháp của một lần stream không hoàn tất (lỗi LLM, client ngắt kết nối)."""
+    if not question_ids:
+        return
+    (db.query(TestQuestion)
+       .filter(TestQuestion.question_id.in_(question_ids), TestQuestion.test_id.is_(None))
+       .delete(synchronize_session=False))
+    db.commit()
+
+def list_test_questions(db: Session, test_id: int) -> List[TestQuestion]:
+    return (db.query(TestQuestion)
+              .filter(TestQuestion.test_id == test_id)
+              .order_by(TestQuestion.order_index, TestQuestion.question_id)
+              .all())
+
 def create_question(db: Session, test_id: int, question_text: str, explanation: str = "") -> TestQuestion:
     q = TestQuestion(test_id=test_id, question_text=question_text, explanation=explanation)
     db.add(q); db.commit(); db.refresh(q)
@@ -0,0 +1,95 @@
+"""
+Server giả lập LLM API (OpenAI-compatible chat completions) cho benchmark.
+
+    MOCK_LLM_LATENCY_MS=300 uvicorn bench.mock_llm:app --port 9100
+
+Trả lời theo loại prompt của app: JSON "questions" (sinh câu hỏi từ JD),
+JSON chấm một câu, hoặc JSON "evaluations" cho prompt chấm gộp. Hỗ trợ "stream": true.
+"""
+import os
+import re
+import json
+import random
+import asyncio
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+MOCK_LLM_LATENCY_MS = float(os.getenv("MOCK_LLM_LATENCY_MS", "300"))
+MOCK_LLM_JITTER_MS = float(os.getenv("MOCK_LLM_JITTER_MS", "100"))
+# Tỷ lệ request trả 500 / 429 (0..1)
+MOCK_LLM_ERROR_RATE = float(os.getenv("MOCK_LLM_ERROR_RATE", "0"))
+MOCK_LLM_429_RATE = float(os.getenv("MOCK_LLM_429_RATE", "0"))
+MOCK_LLM_RETRY_AFTER = os.getenv("MOCK_LLM_RETRY_AFTER", "1")
+# Tỷ lệ response bọc trong markdown fence kèm lời dẫn (0..1), để đo parse/sửa JSON
+MOCK_LLM_FENCE_RATE = float(os.getenv("MOCK_LLM_FENCE_RATE", "0"))
+MOCK_LLM_SEED = os.getenv("MOCK_LLM_SEED")
+
+app = FastAPI(title="Mock LLM")
+rng = random.Random(int(MOCK_LLM_SEED) if MOCK_LLM_SEED else None)
+stats = {"requests": 0, "ok": 0, "errors": 0, "rate_limited": 0, "prompt_tokens": 0, "completion_tokens": 0}
+
+
+def _evaluation() -> dict:
+    return {"score": rng.randint(30, 100), "comment": "Câu trả lời đúng trọng tâm.", "suggestion": "Nêu thêm ví dụ."}
+
+def _content_for(prompt: str) -> str:
+    if '"evaluations"' in prompt:
+        count = max([int(i) for i in re.findall(r"^### (?:Item|Câu) (\d+)", prompt, re.M)] or [1])
+        return json.dumps({"evaluations": [{"index": i, **_evaluation()} for i in range(1, count + 1)]})
+    if '"score"' in prompt:
+        return json.dumps(_evaluation())
+    topics = [("core", "system design"), ("core", "testing"), ("core", "databases"),
+              ("problem_solving", "an incident you handled"), ("fit", "why this team")]
+    return json.dumps({"questions": [{"type": kind, "question": f"Can you describe your experience with {topic}?"}
+                                     for kind, topic in topics]})
+
+def _usage(prompt: str, content: str) -> dict:
+    prompt_tokens, completion_tokens = len(prompt) // 4, len(content) // 4
+    stats["prompt_tokens"] += prompt_tokens
+    stats["completion_tokens"] += completion_tokens
+    return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens}
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    stats["requests"] += 1
+    payload = await request.json()
+    await asyncio.sleep(max(0.0, rng.gauss(MOCK_LLM_LATENCY_MS, MOCK_LLM_JITTER_MS)) / 1000)
+
+    roll = rng.random()
+    if roll < MOCK_LLM_429_RATE:
+        stats["rate_limited"] += 1
+        return JSONResponse(status_code=429, content={"error": "rate limited"},
+                            headers={"Retry-After": MOCK_LLM_RETRY_AFTER})
+    if roll < MOCK_LLM_429_RATE + MOCK_LLM_ERROR_RATE:
+        stats["errors"] += 1
+        return JSONResponse(status_code=500, content={"error": "mock failure"})
+
+    stats["ok"] += 1
+    # Cả hội thoại: lời nhắc sửa JSON của app nằm sau prompt gốc
+    prompt = "\n".join(m["content"] for m in payload["messages"] if m["role"] == "user")
+    content = _content_for(prompt)
+    if rng.random() < MOCK_LLM_FENCE_RATE:
+        content = f"Here is the result:\n```json\n{content}\n```"
+    model = payload.get("model", "mock")
+
+    if payload.get("stream"):
+        async def events():
+            for piece in re.findall(r".{1,24}", content, re.S):
+                yield f"data: {json.dumps({'choices': [{'delta': {'content': piece}}]})}\n\n"
+                await asyncio.sleep(0.005)
+            yield f"data: {json.dumps({'choices': [], 'usage': _usage(prompt, content)})}\n\n"
+            yield "data: [DONE]\n\n"
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    return {
+        "model": model,
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+        "usage": _usage(prompt, content),
+    }
+
+
+@app.get("/stats")
+def get_stats():
+    return stats
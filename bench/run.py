@@ -0,0 +1,236 @@
+"""
+Benchmark các route của app/main.py với LLM giả lập và dữ liệu sinh sẵn.
+
+    python -m bench.run --database-url sqlite:///bench.sqlite3 --jobs 20 --results-per-test 10 \\
+        --concurrency 16 --requests 200 --mock-latency-ms 300
+
+Các bước: khởi động bench.mock_llm và app (uvicorn, process riêng), seed dữ liệu,
+chạy từng kịch bản với `concurrency` client đồng thời, rồi báo cáo p50/p95/p99, requests/s,
+số lời gọi LLM cho mỗi bài được chấm và số câu SQL mỗi request (đọc từ /metrics của app).
+Cuối cùng kiểm tra nội dung các câu hỏi đã có câu trả lời không bị đổi (ví dụ bởi generate với
+replace_existing); có câu bị đổi thì thoát với mã lỗi 1.
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import itertools
+import subprocess
+from typing import Callable, Dict, List, Optional
+import httpx
+from prometheus_client.parser import text_string_to_metric_families
+
+API = "/api/v1/ai"
+
+
+# --------- Kịch bản ---------
+class Scenario:
+    def __init__(self, name: str, method: str, route: str, build: Callable[[dict], dict]):
+        self.name = name
+        self.method = method
+        # Route template, trùng với nhãn route trong /metrics
+        self.route = route
+        self.build = build
+
+def make_scenarios(ids: dict, rng: random.Random, full_regrade: bool) -> Dict[str, Scenario]:
+    results = itertools.cycle(ids["result_ids"])
+    return {
+        "generate": Scenario(
+            "generate", "POST", f"{API}/generate-interview-questions",
+            lambda _: {"url": f"{API}/generate-interview-questions",
+                       "json": {"job_id": rng.choice(ids["job_ids"]), "replace_existing": True}},
+        ),
+        "evaluate": Scenario(
+            "evaluate", "POST", f"{API}/evaluate-test-result",
+            lambda _: {"url": f"{API}/evaluate-test-result",
+                       "params": {"result_id": next(results), "incremental": str(not full_regrade).lower()}},
+        ),
+        "answers": Scenario(
+            "answers", "GET", f"{API}/test-result/{{result_id}}/answers",
+            lambda _: {"url": f"{API}/test-result/{rng.choice(ids['result_ids'])}/answers"},
+        ),
+    }
+
+
+# --------- Đo ---------
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(p / 100 * len(ordered)) - 1))]
+
+def db_query_totals(metrics_text: str) -> Dict[tuple, tuple]:
+    """{(method, route): (tổng số câu SQL, số request)} từ histogram http_request_db_queries."""
+    totals: Dict[tuple, list] = {}
+    for family in text_string_to_metric_families(metrics_text):
+        if family.name != "http_request_db_queries":
+            continue
+        for sample in family.samples:
+            key = (sample.labels.get("method"), sample.labels.get("route"))
+            if sample.name.endswith("_sum"):
+                totals.setdefault(key, [0.0, 0.0])[0] = sample.value
+            elif sample.name.endswith("_count"):
+                totals.setdefault(key, [0.0, 0.0])[1] = sample.value
+    return {key: tuple(value) for key, value in totals.items()}
+
+async def run_scenario(client: httpx.AsyncClient, scenario: Scenario, requests: int, concurrency: int,
+                       mock_url: str) -> dict:
+    latencies: List[float] = []
+    statuses: Dict[int, int] = {}
+    graded = 0
+    remaining = itertools.count()
+
+    async def worker():
+        nonlocal graded
+        while next(remaining) < requests:
+            spec = scenario.build(None)
+            started = time.perf_counter()
+            try:
+                response = await client.request(scenario.method, **spec)
+                status = response.status_code
+            except httpx.HTTPError:
+                response, status = None, 0
+            latencies.append(time.perf_counter() - started)
+            statuses[status] = statuses.get(status, 0) + 1
+            if scenario.name == "evaluate" and status == 200 and "error" not in response.json():
+                graded += 1
+
+    before_llm = (await client.get(f"{mock_url}/stats")).json()
+    before_db = db_query_totals((await client.get("/metrics")).text)
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    after_llm = (await client.get(f"{mock_url}/stats")).json()
+    after_db = db_query_totals((await client.get("/metrics")).text)
+
+    key = (scenario.method, scenario.route)
+    queries, counted = (a - b for a, b in zip(after_db.get(key, (0, 0)), before_db.get(key, (0, 0))))
+    llm_calls = after_llm["requests"] - before_llm["requests"]
+    return {
+        "scenario": scenario.name,
+        "requests": len(latencies),
+        "statuses": statuses,
+        "rps": round(len(latencies) / elapsed, 2),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 1),
+        "llm_calls": llm_calls,
+        "llm_calls_per_graded_test": round(llm_calls / graded, 2) if graded else None,
+        "db_queries_per_request": round(queries / counted, 2) if counted else None,
+    }
+
+
+# --------- Process ---------
+def start_server(target: str, port: int, env: dict) -> subprocess.Popen:
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", target, "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        env={**os.environ, **env},
+    )
+
+async def wait_ready(url: str, timeout: float = 30) -> None:
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while True:
+            try:
+                if (await client.get(url)).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"Server không sẵn sàng: {url}")
+            await asyncio.sleep(0.2)
+
+
+async def main(args) -> List[dict]:
+    os.environ["DATABASE_URL"] = args.database_url
+    from sqlalchemy import create_engine
+    from bench.seed import seed, load_ids, answered_question_texts
+
+    engine = create_engine(args.database_url)
+    if not args.no_seed:
+        print("seed:", seed(engine, args.jobs, args.questions_per_test, args.results_per_test, args.seed))
+    ids = load_ids(engine)
+    answered = answered_question_texts(engine)
+    engine.dispose()
+
+    mock_url = f"http://127.0.0.1:{args.mock_port}"
+    app_url = f"http://127.0.0.1:{args.app_port}"
+    mock = start_server("bench.mock_llm:app", args.mock_port, {
+        "MOCK_LLM_LATENCY_MS": str(args.mock_latency_ms),
+        "MOCK_LLM_JITTER_MS": str(args.mock_jitter_ms),
+        "MOCK_LLM_ERROR_RATE": str(args.mock_error_rate),
+        "MOCK_LLM_429_RATE": str(args.mock_429_rate),
+        "MOCK_LLM_SEED": str(args.seed),
+    })
+    app = start_server("app.main:app", args.app_port, {
+        "DATABASE_URL": args.database_url,
+        "LLM_API_URL": f"{mock_url}/v1/chat/completions",
+        "GROQ_API_KEY": "bench",
+        # Không giới hạn phía client trừ khi được đặt sẵn trong môi trường
+        "LLM_REQUESTS_PER_MINUTE": os.getenv("LLM_REQUESTS_PER_MINUTE", "0"),
+        "LLM_TOKENS_PER_MINUTE": os.getenv("LLM_TOKENS_PER_MINUTE", "0"),
+        "LLM_BACKOFF_MAX_SECONDS": os.getenv("LLM_BACKOFF_MAX_SECONDS", "2"),
+        "GRADING_WORKERS": "0",
+        "QUESTION_POOL_WARMUP_CONCURRENCY": "0",
+        "LOG_LEVEL": "WARNING",
+    })
+    try:
+        await wait_ready(f"{mock_url}/stats")
+        await wait_ready(f"{app_url}/metrics")
+
+        rng = random.Random(args.seed)
+        scenarios = make_scenarios(ids, rng, args.full_regrade)
+        reports = []
+        limits = httpx.Limits(max_connections=args.concurrency + 2)
+        async with httpx.AsyncClient(base_url=app_url, timeout=args.timeout, limits=limits) as client:
+            for name in args.scenarios.split(","):
+                report = await run_scenario(client, scenarios[name], args.requests, args.concurrency, mock_url)
+                reports.append(report)
+                print(json.dumps(report, ensure_ascii=False) if args.json else format_report(report))
+    finally:
+        for process in (app, mock):
+            process.terminate()
+            process.wait()
+
+    engine = create_engine(args.database_url)
+    after = answered_question_texts(engine)
+    engine.dispose()
+    changed = sorted(question_id for question_id, text in answered.items() if after.get(question_id) != text)
+    print(f"answered questions changed: {len(changed)}/{len(answered)}" + (f" {changed[:10]}" if changed else ""))
+    if changed:
+        raise SystemExit(1)
+    return reports
+
+def format_report(report: dict) -> str:
+    return (
+        f"{report['scenario']:<9} n={report['requests']:<5} rps={report['rps']:<8} "
+        f"p50={report['p50_ms']}ms p95={report['p95_ms']}ms p99={report['p99_ms']}ms "
+        f"status={report['statuses']} llm_calls/test={report['llm_calls_per_graded_test']} "
+        f"db_queries/req={report['db_queries_per_request']}"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", default=os.getenv("BENCH_DATABASE_URL", "sqlite:///bench.sqlite3"))
+    parser.add_argument("--no-seed", action="store_true", help="dùng dữ liệu đã có")
+    parser.add_argument("--jobs", type=int, default=20)
+    parser.add_argument("--questions-per-test", type=int, default=5)
+    parser.add_argument("--results-per-test", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--scenarios", default="answers,generate,evaluate")
+    parser.add_argument("--requests", type=int, default=200, help="số request mỗi kịch bản")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--full-regrade", action="store_true", help="evaluate với incremental=false")
+    parser.add_argument("--mock-latency-ms", type=float, default=300)
+    parser.add_argument("--mock-jitter-ms", type=float, default=100)
+    parser.add_argument("--mock-error-rate", type=float, default=0.0)
+    parser.add_argument("--mock-429-rate", type=float, default=0.0)
+    parser.add_argument("--mock-port", type=int, default=9100)
+    parser.add_argument("--app-port", type=int, default=9000)
+    parser.add_argument("--json", action="store_true", help="in mỗi báo cáo thành một dòng JSON")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,121 @@
+"""
+Sinh dữ liệu benchmark: jobs, job_tests, test_questions, test_results, question_answers.
+
+    DATABASE_URL=sqlite:///bench.sqlite3 python -m bench.seed --jobs 50 --results-per-test 20
+
+Chỉ chạy trên CSDL dành riêng cho benchmark: bảng còn thiếu sẽ được tạo (kể cả bảng
+tối thiểu cho các khóa ngoại ngoài phạm vi app như companies, candidate_cvs).
+"""
+import argparse
+import random
+from datetime import datetime, timedelta
+from sqlalchemy import BigInteger, Column, Table, insert, select
+
+SKILLS = ["Python", "PostgreSQL", "FastAPI", "Docker", "Kubernetes", "React", "Kafka", "Redis", "AWS", "CI/CD"]
+LEVELS = ["entry", "mid", "senior"]
+
+
+def ensure_schema(engine) -> None:
+    from app.models import Base
+
+    # Bảng tham chiếu bởi khóa ngoại nhưng không thuộc app
+    for name, pk in (("companies", "company_id"), ("candidate_cvs", "cv_id")):
+        if name not in Base.metadata.tables:
+            Table(name, Base.metadata, Column(pk, BigInteger, primary_key=True))
+    Base.metadata.create_all(engine)
+
+
+def job_description(rng: random.Random, n: int) -> str:
+    skills = ", ".join(rng.sample(SKILLS, 4))
+    level = rng.choice(LEVELS)
+    return (f"Job #{n}: we are hiring a {level} backend engineer. "
+            f"You will build and operate services using {skills}. "
+            f"Requirements: {rng.randint(1, 8)} years of experience, ownership, clear communication.")
+
+
+def seed(engine, jobs: int = 20, questions_per_test: int = 5, results_per_test: int = 10, seed_value: int = 42) -> dict:
+    """Chèn dữ liệu theo lô (executemany), trả về số bản ghi đã tạo."""
+    from app.models import Job, JobTest, TestQuestion, TestResult, QuestionAnswer
+
+    ensure_schema(engine)
+    rng = random.Random(seed_value)
+    now = datetime.utcnow()
+
+    with engine.begin() as conn:
+        job_ids = conn.execute(
+            insert(Job).returning(Job.job_id, sort_by_parameter_order=True),
+            [{"title": f"Backend Engineer {n}", "description": job_description(rng, n)} for n in range(jobs)],
+        ).scalars().all()
+
+        test_ids = conn.execute(
+            insert(JobTest).returning(JobTest.test_id, sort_by_parameter_order=True),
+            [{"job_id": job_id, "test_name": f"Test for job {job_id}", "is_active": True,
+              "created_at": now, "updated_at": now} for job_id in job_ids],
+        ).scalars().all()
+
+        question_rows = [
+            {"test_id": test_id, "order_index": i, "points": 1,
+             "question_text": f"Question {i} for test {test_id}: explain how you would use {rng.choice(SKILLS)}?",
+             "question_type": "core" if i <= 3 else ("problem_solving" if i == 4 else "fit"),
+             "created_at": now}
+            for test_id in test_ids for i in range(1, questions_per_test + 1)
+        ]
+        question_ids = conn.execute(
+            insert(TestQuestion).returning(TestQuestion.question_id, sort_by_parameter_order=True), question_rows
+        ).scalars().all()
+        questions_by_test = {}
+        for row, question_id in zip(question_rows, question_ids):
+            questions_by_test.setdefault(row["test_id"], []).append(question_id)
+
+        result_rows = [
+            {"test_id": test_id, "start_time": now - timedelta(minutes=30), "submit_time": now, "status": "submitted"}
+            for test_id in test_ids for _ in range(results_per_test)
+        ]
+        result_ids = conn.execute(
+            insert(TestResult).returning(TestResult.result_id, sort_by_parameter_order=True), result_rows
+        ).scalars().all()
+
+        answer_rows = [
+            {"result_id": result_id, "question_id": question_id, "submitted_at": now,
+             "answer_text": f"Candidate {result_id} answer to {question_id}: I used {rng.choice(SKILLS)} "
+                            f"to ship a feature, measured the impact and iterated {rng.randint(1, 9)} times."}
+            for row, result_id in zip(result_rows, result_ids)
+            for question_id in questions_by_test[row["test_id"]]
+        ]
+        conn.execute(insert(QuestionAnswer), answer_rows)
+
+    return {"jobs": len(job_ids), "tests": len(test_ids), "questions": len(question_ids),
+            "results": len(result_ids), "answers": len(answer_rows)}
+
+
+def load_ids(engine) -> dict:
+    """job_id và result_id hiện có, để bench chọn mục tiêu cho request."""
+    from app.models import Job, TestResult
+
+    with engine.connect() as conn:
+        return {
+            "job_ids": conn.execute(select(Job.job_id)).scalars().all(),
+            "result_ids": conn.execute(select(TestResult.result_id)).scalars().all(),
+        }
+
+def answered_question_texts(engine) -> dict:
+    """{question_id: question_text} của các câu hỏi đã có câu trả lời (phải giữ nguyên qua mọi kịch bản)."""
+    from app.models import TestQuestion, QuestionAnswer
+
+    answered = select(QuestionAnswer.question_id).distinct()
+    with engine.connect() as conn:
+        return dict(conn.execute(
+            select(TestQuestion.question_id, TestQuestion.question_text).where(TestQuestion.question_id.in_(answered))
+        ).all())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--jobs", type=int, default=20)
+    parser.add_argument("--questions-per-test", type=int, default=5)
+    parser.add_argument("--results-per-test", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    from app.db import engine
+    print(seed(engine, args.jobs, args.questions_per_test, args.results_per_test, args.seed))